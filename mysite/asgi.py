@@ -0,0 +1,25 @@
+"""
+ASGI config for mysite project.
+
+It exposes the ASGI callable as a module-level variable named ``application``.
+Django 2.2 has no ASGI handler of its own, see novelrecorder.asgi. The Procfile serves mysite.wsgi; to keep the
+event streams open instead, serve this with an ASGI server, e.g.:
+
+    uvicorn mysite.asgi:application
+    gunicorn mysite.asgi:application -k uvicorn.workers.UvicornWorker
+
+Each worker then has NOVELRECORDER_ASGI_THREADS threads, each with its own database connections - more with
+NOVELRECORDER_CONCURRENT_QUERIES=1 (see mysite.settings), so mind the connection limit of the database.
+"""
+
+import os
+
+from django.core.wsgi import get_wsgi_application
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'mysite.settings')
+
+wsgi_application = get_wsgi_application()
+
+from novelrecorder.asgi import ASGIHandler  # noqa: E402 - needs the apps loaded
+
+application = ASGIHandler(wsgi_application, threads=int(os.environ.get('NOVELRECORDER_ASGI_THREADS', '16')))
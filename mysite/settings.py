@@ -10,8 +10,10 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/2.2/ref/settings/
 """
 
+import dj_database_url
 import django_heroku
 import os
+import tempfile
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -41,11 +43,15 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'novelrecorder.middleware.QueryInstrumentationMiddleware',
+    'novelrecorder.profiling.ProfilingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'novelrecorder.db_routers.ReplicaRoutingMiddleware',
+    'novelrecorder.sharding.ShardRoutingMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -127,10 +133,50 @@ REST_FRAMEWORK = {
     'PAGE_SIZE': 10,
     'EXCEPTION_HANDLER': 'novelrecorder.yd_exceptions.custom_exception_handler',
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework.authentication.BasicAuthentication',
+        # Scripts should use tokens (manage.py create_token): Basic runs the PBKDF2 password hash on every request.
+        'novelrecorder.authentication.NovelUserTokenAuthentication',
         'rest_framework.authentication.SessionAuthentication',
+        'rest_framework.authentication.BasicAuthentication',
     ],
 }
+
+# Instrumentation
+# Raise rather than log a warning when a view goes over its query_budgets. Turned on for the tests.
+QUERY_BUDGET_STRICT = False
+
+# Profiles are always taken for requests with a valid X-Novelrecorder-Profile header (see manage.py profile_token),
+# and for SAMPLE_RATE of the other novelrecorder requests if ENABLED. Listed at /novelrecorder/profile_list/.
+PROFILER = {
+    'ENABLED': os.environ.get('NOVELRECORDER_PROFILER_ENABLED') == '1',
+    'SAMPLE_RATE': float(os.environ.get('NOVELRECORDER_PROFILER_SAMPLE_RATE', '0.01')),
+    'DIRECTORY': os.path.join(BASE_DIR, 'profiles'),
+    'MAX_PROFILES': 200,
+}
+
+# Metrics of every gunicorn worker on the host are written here and summed up by /metrics.
+# Set NOVELRECORDER_METRICS_TOKEN to require "Authorization: Bearer <token>" for scraping.
+METRICS_DIRECTORY = os.environ.get('NOVELRECORDER_METRICS_DIRECTORY', os.path.join(tempfile.gettempdir(), 'novelrecorder_metrics'))
+METRICS_TOKEN = os.environ.get('NOVELRECORDER_METRICS_TOKEN')
+
+# Run the independent queries of a view on a thread pool, see novelrecorder.query_utils.run_concurrently. Each thread
+# of the pool has connections of its own, on top of those of the worker's threads.
+CONCURRENT_QUERIES = os.environ.get('NOVELRECORDER_CONCURRENT_QUERIES') == '1'
+CONCURRENT_QUERY_THREADS = 8
+
+# Server-Sent Events of the changes of a novel, see novelrecorder.events.
+EVENT_STREAM = {
+    'POLL_INTERVAL': 2,
+    'HEARTBEAT_INTERVAL': 15,
+    'MAX_DURATION': 300,
+}
+
+# The content of the descriptions of at least THRESHOLD bytes is stored compressed, see novelrecorder.compression
+# (manage.py compress_descriptions converts the existing ones).
+CONTENT_COMPRESSION = {
+    'THRESHOLD': 1024,
+    'LEVEL': 6,
+}
+
 # Allow all host hosts/domain names for this site
 ALLOWED_HOSTS = ['*']
 
@@ -153,3 +199,35 @@ except Exception as e:
   pass
 
 django_heroku.settings(locals())
+
+# Read replicas, e.g. NOVELRECORDER_REPLICA_URLS=postgres://...,postgres://... (or two SQLite files locally:
+# sqlite:////path/to/replica.sqlite3 with a copy of the primary). See novelrecorder.db_routers.
+DATABASE_REPLICAS = []
+for index, url in enumerate(filter(None, os.environ.get('NOVELRECORDER_REPLICA_URLS', '').split(','))):
+    DATABASE_REPLICAS.append('replica%s' % (index + 1))
+    DATABASES[DATABASE_REPLICAS[-1]] = dict(dj_database_url.parse(url, conn_max_age=600), TEST={'MIRROR': 'default'})
+REPLICA_STICKY_SECONDS = 10  # Reads stay on the primary for this long after a write by the same client
+
+# Shards besides 'default' for the content of the novels, e.g. NOVELRECORDER_SHARD_URLS=postgres://...,postgres://...
+# (or SQLite files locally). Rebalanced by the rebalance_shards command. See novelrecorder.sharding.
+DATABASE_SHARDS = []
+for index, url in enumerate(filter(None, os.environ.get('NOVELRECORDER_SHARD_URLS', '').split(','))):
+    DATABASE_SHARDS = DATABASE_SHARDS or ['default']
+    DATABASE_SHARDS.append('shard%s' % (index + 1))
+    DATABASES[DATABASE_SHARDS[-1]] = dj_database_url.parse(url, conn_max_age=600)
+DATABASE_ROUTERS = ['novelrecorder.sharding.ShardRouter', 'novelrecorder.db_routers.ReplicaRouter']
+
+# A cache shared by the processes of the host (e.g. the gunicorn workers) rather than one per process, in an SQLite
+# file, e.g. NOVELRECORDER_CACHE_PATH=/var/tmp/novelrecorder-cache.sqlite3. See novelrecorder.caching.
+if os.environ.get('NOVELRECORDER_CACHE_PATH'):
+    CACHES = {'default': {
+        'BACKEND': 'novelrecorder.caching.SQLiteCache',
+        'LOCATION': os.environ['NOVELRECORDER_CACHE_PATH'],
+        'OPTIONS': {'MAX_BYTES': int(os.environ.get('NOVELRECORDER_CACHE_MAX_BYTES', 64 * 1024 * 1024))},
+    }}
+
+# django_heroku replaces LOGGING, so add the app logger (e.g. request instrumentation) back afterwards.
+LOGGING['loggers']['novelrecorder'] = {
+    'handlers': ['console'],
+    'level': 'INFO',
+}
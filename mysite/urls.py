@@ -23,8 +23,10 @@ urlpatterns = [
     path('', redirect_novelRecorder),
     path('api-auth/', include('rest_framework.urls', namespace='rest_framework')),
     path('novelrecorder/', include('novelrecorder.urls')),
+    path('api/v1/', include('novelrecorder.api_urls', namespace='api_v1')),
     path('admin/', admin.site.urls),
     # Add Django site authentication urls (for login, logout, password management)
     path('accounts/', include('django.contrib.auth.urls')),
     path('accounts/register/', views.UserRegisterView.as_view(), name='register'),
+    path('metrics', views.metrics_view, name='metrics'),
 ]
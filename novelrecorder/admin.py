@@ -10,3 +10,13 @@ admin.site.register(models.Character)
 admin.site.register(models.Relationship)
 admin.site.register(models.Description)
 admin.site.register(models.NovelUserPermissionModel)
+
+
+@admin.register(models.NovelUserToken)
+class NovelUserTokenAdmin(admin.ModelAdmin):
+    # Tokens are created with manage.py create_token, which shows the key once.
+    list_display = ['name', 'user', 'key_prefix', 'scopes', 'time_created', 'time_revoked']
+    readonly_fields = ['user', 'key_prefix', 'key_hash', 'time_created']
+
+    def has_add_permission(self, request):
+        return False
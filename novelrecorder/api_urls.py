@@ -0,0 +1,15 @@
+from rest_framework import routers
+
+from novelrecorder import api_views
+
+app_name = 'novelrecorder_api'
+
+router = routers.DefaultRouter()
+router.register('novels', api_views.NovelViewSet, basename='novel')
+router.register('characters', api_views.CharacterViewSet, basename='character')
+router.register('relationships', api_views.RelationshipViewSet, basename='relationship')
+router.register('descriptions', api_views.DescriptionViewSet, basename='description')
+router.register('permissions', api_views.NovelUserPermissionModelViewSet, basename='permission')
+router.register('jobs', api_views.JobViewSet, basename='job')
+
+urlpatterns = router.urls
@@ -0,0 +1,311 @@
+from django.db.models import ProtectedError
+from rest_framework import status, viewsets, serializers
+from rest_framework.decorators import action
+from rest_framework.exceptions import NotFound, PermissionDenied
+from rest_framework.generics import get_object_or_404
+from rest_framework.pagination import CursorPagination
+from rest_framework.permissions import IsAuthenticated, IsAuthenticatedOrReadOnly
+from rest_framework.renderers import JSONRenderer
+from rest_framework.response import Response
+
+from novelrecorder import changelog, cloning, deletion, jobs, revisions, sharding
+from novelrecorder.batch import NovelBatch, DescriptionFormset
+from novelrecorder.constants import CHANGE_LOG_PAGE_SIZE, CHANGE_LOG_MAX_PAGE_SIZE, DESCRIPTION_REVISION_PAGE_SIZE, \
+    DESCRIPTION_REVISION_MAX_PAGE_SIZE
+from novelrecorder.models import Novel, Character, Relationship, Description, DescriptionRevision, \
+    NovelUserPermissionModel, Job
+from novelrecorder.permissions import NovelUserPermission, readable_filter, visible_permissions_filter
+from novelrecorder.query_utils import apply_query_plan
+from novelrecorder.serializers import NovelApiSerializer, CharacterApiSerializer, CharacterCreateApiSerializer, \
+    RelationshipApiSerializer, RelationshipCreateApiSerializer, DescriptionApiSerializer, \
+    DescriptionUpdateApiSerializer, NovelUserPermissionModelApiSerializer, NovelUserPermissionModelUpdateApiSerializer
+
+
+# Keyset pagination on the id: the cost of a page doesn't grow with how far into the list it is.
+class IdCursorPagination(CursorPagination):
+    ordering = 'id'
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+
+
+# Whether the request asks for its work to be queued as a background job (?background=1), see novelrecorder.jobs.
+def is_background(request):
+    return request.query_params.get('background') in ('1', 'true')
+
+
+def get_job_response(job):
+    return Response(jobs.serialize_job(job), status=status.HTTP_202_ACCEPTED)
+
+
+# ?limit= of the change log and snapshot pages, within bounds. Raises ValueError if it isn't a number.
+def get_change_log_limit(request):
+    return min(max(int(request.query_params.get('limit', CHANGE_LOG_PAGE_SIZE)), 1), CHANGE_LOG_MAX_PAGE_SIZE)
+
+
+# JSON counterparts of the HTML views. Lists only show what the user can read, the object permissions are
+# NovelUserPermission's, and creating requires write permission on the object the new one belongs to.
+class CustomNovelViewSet(viewsets.ModelViewSet):
+    renderer_classes = [JSONRenderer]
+    permission_classes = [IsAuthenticatedOrReadOnly, NovelUserPermission]
+    pagination_class = IdCursorPagination
+    _model_class = None
+    _novel_lookup = ''  # The path from the model to its novel, for filtering by readable novels
+    _select_related = []
+    _create_serializer = None
+    _update_serializer = None
+    _filter_fields = []  # Query params filtering the list by equality, e.g. ?novel=1
+
+    # Routed by the pk or the filter/create params, see novelrecorder.sharding.
+    def initial(self, request, *args, **kwargs):
+        sharding.activate_for_request(self._model_class, kwargs, request.query_params, request.data)
+        super().initial(request, *args, **kwargs)
+
+    def get_queryset(self):
+        queryset = self._model_class.objects.filter(self.get_readable_filter())
+        for field in self._filter_fields:
+            value = self.request.query_params.get(field)
+            if value is not None:
+                queryset = queryset.filter(**{field: value})
+        return apply_query_plan(queryset, select_related=self._select_related)
+
+    def get_readable_filter(self):
+        return readable_filter(self.request.user, self._novel_lookup)
+
+    # With shards, a list of the content of the novels is of the shard of the novel it's filtered by, see
+    # novelrecorder.sharding - one across the shards isn't served, rather than one of whichever shard.
+    def list(self, request, *args, **kwargs):
+        if self._model_class in sharding.SHARDED_MODELS and sharding.is_enabled() and \
+                sharding.get_active_shard() is None:
+            routing = [field for field in self._filter_fields if field in dict(sharding.ROUTING_PARAMS)]
+            raise serializers.ValidationError(
+                {'detail': 'The novels are sharded, filter the list by %s.' % ' or '.join(routing)})
+        return super().list(request, *args, **kwargs)
+
+    def get_serializer_class(self):
+        if self.action == 'create' and self._create_serializer:
+            return self._create_serializer
+        if self.action in ['update', 'partial_update'] and self._update_serializer:
+            return self._update_serializer
+        return self.serializer_class
+
+    # The object the new one would belong to, whose write permission is required to create it.
+    def get_create_parent(self, validated_data):
+        raise NotImplementedError('Class %s.get_create_parent is not implemented.' % self.__class__.__name__)
+
+    def perform_create(self, serializer):
+        parent = self.get_create_parent(serializer.validated_data)
+        if parent is not None and not NovelUserPermission().custom_has_object_permission(self.request.user, True, parent):
+            raise PermissionDenied(NovelUserPermission.message)
+        with changelog.recording_changes():
+            serializer.save()
+
+    def perform_update(self, serializer):
+        with changelog.recording_changes():
+            serializer.save()
+
+    def perform_destroy(self, instance):
+        try:
+            with changelog.recording_changes():
+                instance.delete()
+        except ProtectedError:
+            raise serializers.ValidationError({'detail': '%s is still referred to, e.g. by relationships.' % instance})
+
+
+class NovelViewSet(CustomNovelViewSet):
+    _model_class = Novel
+    _novel_lookup = 'id'
+    serializer_class = NovelApiSerializer
+    _filter_fields = ['author']
+
+    def get_create_parent(self, validated_data):
+        return None  # Anyone logged in can create a novel
+
+    # Many creates, updates and deletes of the novel's characters, relationships and descriptions in one
+    # transaction. The permissions are checked per operation, so not through get_object.
+    @action(detail=True, methods=['post'])
+    def batch(self, request, pk=None):
+        novel = get_object_or_404(self.get_queryset(), pk=pk)
+        batch = NovelBatch(novel, request.user, request.data.get('operations') if hasattr(request.data, 'get') else None)
+        batch.validate()
+        return Response({'results': batch.apply()})
+
+    # The changes of the novel after ?since=<seq> for clients to sync incrementally, see novelrecorder.changelog -
+    # the ones of the permissions only for who manages them.
+    @action(detail=True, methods=['get'])
+    def changes(self, request, pk=None):
+        novel = self.get_object()
+        try:
+            since = max(int(request.query_params.get('since', 0)), 0)
+            limit = get_change_log_limit(request)
+        except ValueError:
+            raise serializers.ValidationError({'detail': 'since and limit are numbers.'})
+        return Response(changelog.get_changes_since(
+            novel, since, limit, NovelUserPermission().may_manage_permissions(request.user, novel)))
+
+    # A page of the novel as it is from ?after=<the next of the previous page>, for clients whose changes have been
+    # compacted away to sync from, see novelrecorder.changelog.get_snapshot_page.
+    @action(detail=True, methods=['get'])
+    def snapshot(self, request, pk=None):
+        novel = self.get_object()
+        try:
+            return Response(changelog.get_snapshot_page(
+                novel, request.query_params.get('after'), get_change_log_limit(request),
+                NovelUserPermission().may_manage_permissions(request.user, novel)))
+        except ValueError:
+            raise serializers.ValidationError({'detail': 'after is the next of a page, and limit a number.'})
+
+    # With everything in it, see novelrecorder.deletion - by its author only. Gives what's deleted, or the job
+    # deleting it with ?background=1.
+    def destroy(self, request, *args, **kwargs):
+        novel = self.get_object()
+        if novel.author_id != request.user.pk:
+            raise PermissionDenied('Only the author of a novel can delete it.')
+        if is_background(request):
+            return get_job_response(jobs.enqueue('delete_novel', {'novel_id': novel.pk}, request.user))
+        total, counts = deletion.delete_novel(novel)
+        return Response({'deleted': total, 'objects': counts})
+
+    # A copy of the novel (named ?name= or after it) as a new novel of the user, see novelrecorder.cloning, or the
+    # job making it with ?background=1. Reading the novel is enough, so not through get_object.
+    @action(detail=True, methods=['post'])
+    def clone(self, request, pk=None):
+        novel = get_object_or_404(self.get_queryset(), pk=pk)
+        name = request.data.get('name') if hasattr(request.data, 'get') else None
+        if name and Novel.objects.filter(author=request.user, name=name).exists():
+            raise serializers.ValidationError({'name': 'You have a novel of this name already.'})
+        if is_background(request):
+            return get_job_response(jobs.enqueue('clone_novel', {'novel_id': novel.pk, 'user_id': request.user.pk,
+                                                                  'name': name}, request.user))
+        clone = cloning.clone_novel(novel, request.user, name=name)
+        return Response(self.get_serializer(clone).data, status=status.HTTP_201_CREATED)
+
+
+# The descriptions of the character or relationship edited at once, see batch.DescriptionFormset:
+# POST {"descriptions": [{"id": ..., "title": ..., "content": ...}]} - all written or none.
+class DescriptionBulkEditMixin(object):
+    # Reading the owner is enough, DescriptionFormset checks the edit of each description (which a user granted
+    # NUP_DESCRIPTION_ONLY can make).
+    @action(detail=True, methods=['post'], url_path='descriptions')
+    def edit_descriptions(self, request, pk=None):
+        owner = get_object_or_404(self.get_queryset(), pk=pk)
+        if not NovelUserPermission().custom_has_object_permission(request.user, False, owner):
+            raise PermissionDenied(NovelUserPermission.message)
+        formset = DescriptionFormset(owner, request.user,
+                                     request.data.get('descriptions') if hasattr(request.data, 'get') else None)
+        if not formset.is_valid():
+            raise serializers.ValidationError({'errors': formset.errors})
+        return Response({'updated': [description.pk for description in formset.save()]})
+
+
+class CharacterViewSet(DescriptionBulkEditMixin, CustomNovelViewSet):
+    _model_class = Character
+    _novel_lookup = 'novel'
+    _select_related = ['novel']
+    serializer_class = CharacterApiSerializer
+    _create_serializer = CharacterCreateApiSerializer
+    _filter_fields = ['novel']
+
+    def get_create_parent(self, validated_data):
+        return validated_data['novel']
+
+    # With its relationships and the descriptions of both, see novelrecorder.deletion. Gives what's deleted.
+    def destroy(self, request, *args, **kwargs):
+        total, counts = deletion.delete_character(self.get_object())
+        return Response({'deleted': total, 'objects': counts})
+
+
+class RelationshipViewSet(DescriptionBulkEditMixin, CustomNovelViewSet):
+    _model_class = Relationship
+    _novel_lookup = 'character1__novel'
+    _select_related = ['character1__novel']
+    serializer_class = RelationshipApiSerializer
+    _create_serializer = RelationshipCreateApiSerializer
+    _filter_fields = ['character1', 'character2']
+    http_method_names = ['get', 'post', 'delete', 'head', 'options']  # Nothing to update on a relationship itself
+
+    def get_create_parent(self, validated_data):
+        return validated_data['character1']
+
+
+class DescriptionViewSet(CustomNovelViewSet):
+    _model_class = Description
+    _select_related = ['character__novel', 'relationship__character1__novel', 'blob']
+    serializer_class = DescriptionApiSerializer
+    _update_serializer = DescriptionUpdateApiSerializer
+    _filter_fields = ['character', 'relationship']
+
+    def get_readable_filter(self):
+        return readable_filter(self.request.user, 'character__novel') | \
+            readable_filter(self.request.user, 'relationship__character1__novel')
+
+    def get_create_parent(self, validated_data):
+        return validated_data.get('character') or validated_data.get('relationship')
+
+    def perform_destroy(self, instance):
+        if instance.getOwner().getPrimaryDescription().pk == instance.pk:
+            raise serializers.ValidationError({'detail': "You can't delete a primary description."})
+        super().perform_destroy(instance)
+
+    # The revisions of the description, the latest first, see novelrecorder.revisions. ?before=<number> gives the
+    # ones before it, e.g. the number of the last one of the previous page.
+    @action(detail=True, methods=['get'], url_path='revisions')
+    def history(self, request, pk=None):
+        description = self.get_object()
+        try:
+            before = request.query_params.get('before')
+            before = int(before) if before is not None else None
+            limit = min(max(int(request.query_params.get('limit', DESCRIPTION_REVISION_PAGE_SIZE)), 1),
+                        DESCRIPTION_REVISION_MAX_PAGE_SIZE)
+        except ValueError:
+            raise serializers.ValidationError({'detail': 'before and limit are numbers.'})
+        return Response(revisions.get_history(description, before, limit))
+
+    # A revision with its title and content as they were.
+    @action(detail=True, methods=['get'], url_path=r'revisions/(?P<number>[0-9]+)')
+    def revision(self, request, pk=None, number=None):
+        description = self.get_object()
+        try:
+            revision = revisions.get_revision(description, int(number))
+        except DescriptionRevision.DoesNotExist:
+            raise NotFound('Description %s has no revision %s.' % (description.pk, number))
+        return Response(revisions.serialize_revision(revision, with_content=True))
+
+
+class NovelUserPermissionModelViewSet(CustomNovelViewSet):
+    _model_class = NovelUserPermissionModel
+    _novel_lookup = 'novel'
+    _select_related = ['novel']
+    serializer_class = NovelUserPermissionModelApiSerializer
+    _update_serializer = NovelUserPermissionModelUpdateApiSerializer
+    _filter_fields = ['novel', 'user']
+
+    # Not everyone reading the novel sees who is granted what
+    def get_readable_filter(self):
+        return super().get_readable_filter() & visible_permissions_filter(self.request.user)
+
+    def get_create_parent(self, validated_data):
+        return validated_data['novel']
+
+
+# The background jobs of the user (everyone's for staff) and their progress, see novelrecorder.jobs. ?status= filters
+# them. Read from the primary, where the workers write.
+class JobViewSet(viewsets.GenericViewSet):
+    renderer_classes = [JSONRenderer]
+    permission_classes = [IsAuthenticated]
+    pagination_class = IdCursorPagination
+
+    def get_queryset(self):
+        queryset = Job.objects.using(sharding.PRIMARY)
+        if not self.request.user.is_staff:
+            queryset = queryset.filter(user=self.request.user)
+        job_status = self.request.query_params.get('status')
+        if job_status is not None:
+            queryset = queryset.filter(status=job_status)
+        return queryset
+
+    def list(self, request):
+        page = self.paginate_queryset(self.get_queryset())
+        return self.get_paginated_response([jobs.serialize_job(job) for job in page])
+
+    def retrieve(self, request, pk=None):
+        return Response(jobs.serialize_job(self.get_object()))
@@ -3,3 +3,7 @@ from django.apps import AppConfig
 
 class NovelRecorderConfig(AppConfig):
     name = 'novelrecorder'
+
+    def ready(self):
+        from novelrecorder import changelog  # Connects the change log signals
+        from novelrecorder import revisions  # And the revision history's
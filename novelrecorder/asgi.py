@@ -0,0 +1,212 @@
+import asyncio
+import io
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from importlib import import_module
+
+from django.conf import settings
+from django.contrib.auth import get_user
+from django.core.handlers.wsgi import WSGIRequest
+from django.db import close_old_connections
+from django.urls import resolve, Resolver404
+
+from novelrecorder import changelog, events
+from novelrecorder.models import Novel
+from novelrecorder.permissions import NovelUserPermission
+
+# An ASGI application for Django 2.2, which has no ASGI support of its own (see mysite/asgi.py).
+#
+# The views still run synchronously, on a thread pool, with their responses streamed back chunk by chunk as they
+# are produced. The event streams of novel_events are served on the event loop instead, so an idle stream only
+# costs a coroutine rather than a thread.
+
+EVENTS_URL_NAME = 'novel_events'
+
+
+def build_environ(scope, body):
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', ''),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': str(server[0]),
+        'SERVER_PORT': str(server[1]),
+        'REMOTE_ADDR': client[0],
+        'SERVER_PROTOCOL': 'HTTP/%s' % scope.get('http_version', '1.1'),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        key = name if name in ('CONTENT_TYPE', 'CONTENT_LENGTH') else 'HTTP_' + name
+        environ[key] = environ[key] + ',' + value if key in environ else value
+    return environ
+
+
+class RequestBodyTooLarge(Exception):
+    pass
+
+
+# The body of the request, or None if the client disconnected. Raises RequestBodyTooLarge past max_size bytes, the
+# body being read into memory before the view - so before Django checks DATA_UPLOAD_MAX_MEMORY_SIZE itself.
+async def read_body(receive, max_size=None):
+    chunks, size = [], 0
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return None
+        chunk = message.get('body', b'')
+        size += len(chunk)
+        if max_size is not None and size > max_size:
+            raise RequestBodyTooLarge()
+        chunks.append(chunk)
+        if not message.get('more_body', False):
+            return b''.join(chunks)
+
+
+class ASGIHandler(object):
+    def __init__(self, wsgi_application, threads=16):
+        self.wsgi_application = wsgi_application
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='novelrecorder-asgi')
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        if scope['type'] != 'http':
+            raise ValueError('Only HTTP is served, not %s.' % scope['type'])
+        try:
+            body = await read_body(receive, settings.DATA_UPLOAD_MAX_MEMORY_SIZE)
+        except RequestBodyTooLarge:
+            await send({'type': 'http.response.start', 'status': 413,
+                        'headers': [(b'content-type', b'text/plain; charset=utf-8')]})
+            await send({'type': 'http.response.body', 'body': b'Request body too large.', 'more_body': False})
+            return
+        if body is None:
+            return
+        environ = build_environ(scope, body)
+        if scope['method'] == 'GET' and self.is_event_stream(scope['path']):
+            if await self.stream_events(environ, receive, send):
+                return
+        await self.run_wsgi(environ, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    @staticmethod
+    def is_event_stream(path):
+        try:
+            return resolve(path).url_name == EVENTS_URL_NAME
+        except Resolver404:
+            return False
+
+    async def run_in_thread(self, function, *args):
+        return await asyncio.get_event_loop().run_in_executor(self.executor, function, *args)
+
+    # The Django view runs on the thread pool and hands the chunks of its response over to the event loop.
+    async def run_wsgi(self, environ, send):
+        loop = asyncio.get_event_loop()
+        queue = asyncio.Queue()
+
+        def put(message):
+            loop.call_soon_threadsafe(queue.put_nowait, message)
+
+        def start_response(status, headers, exc_info=None):
+            put({'type': 'http.response.start', 'status': int(status.split(' ', 1)[0]),
+                 'headers': [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]})
+
+        def run():
+            try:
+                response = self.wsgi_application(environ, start_response)
+                try:
+                    for chunk in response:
+                        if chunk:
+                            put({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+                finally:
+                    if hasattr(response, 'close'):
+                        response.close()
+            finally:
+                put({'type': 'http.response.body', 'body': b'', 'more_body': False})
+
+        future = loop.run_in_executor(self.executor, run)
+        while True:
+            message = await queue.get()
+            await send(message)
+            if message['type'] == 'http.response.body' and not message['more_body']:
+                break
+        await future
+
+    # Runs on the thread pool: the novel of the stream, where it starts from and whether it has the changes of the
+    # permissions, or None if the request isn't allowed, in which case the view answers it.
+    @staticmethod
+    def open_event_stream(environ):
+        close_old_connections()
+        try:
+            request = WSGIRequest(environ)
+            request.session = import_module(settings.SESSION_ENGINE).SessionStore(
+                request.COOKIES.get(settings.SESSION_COOKIE_NAME))
+            novel = Novel.objects.filter(pk=resolve(request.path_info).kwargs['pk']).first()
+            user = get_user(request)
+            if novel is None or not NovelUserPermission().custom_has_object_permission(user, True, novel):
+                return None
+            since = events.get_last_event_id(request)
+            return novel, novel.change_seq if since is None else since, \
+                NovelUserPermission().may_manage_permissions(user, novel)
+        finally:
+            close_old_connections()
+
+    @staticmethod
+    def read_events(novel, since, with_permissions):
+        try:
+            return events.get_events(novel, since, with_permissions)
+        finally:
+            close_old_connections()
+
+    # novel_events on the event loop: the database is read on the thread pool, the waiting is done here.
+    async def stream_events(self, environ, receive, send):
+        opened = await self.run_in_thread(self.open_event_stream, environ)
+        if opened is None:
+            return False
+        novel, since, with_permissions = opened
+        await send({'type': 'http.response.start', 'status': 200, 'headers': [
+            (b'content-type', b'text/event-stream'), (b'cache-control', b'no-cache'), (b'x-accel-buffering', b'no')]})
+
+        disconnected = asyncio.ensure_future(receive())  # The only message left is http.disconnect
+        started = last_sent = time.monotonic()
+        chunks = ['retry: %s\n\n' % events.get_event_stream_setting('RETRY')]
+        try:
+            while not disconnected.done() and \
+                    time.monotonic() - started < events.get_event_stream_setting('MAX_DURATION'):
+                new_events, since, has_more = await self.run_in_thread(self.read_events, novel, since, with_permissions)
+                chunks += new_events
+                if time.monotonic() - last_sent >= events.get_event_stream_setting('HEARTBEAT_INTERVAL'):
+                    chunks.append(': heartbeat\n\n')
+                if chunks:
+                    await send({'type': 'http.response.body', 'body': ''.join(chunks).encode('utf-8'), 'more_body': True})
+                    chunks = []
+                    last_sent = time.monotonic()
+                if not has_more:
+                    changed = asyncio.ensure_future(changelog.notifier.async_wait(
+                        novel.pk, since, events.get_event_stream_setting('POLL_INTERVAL')))
+                    await asyncio.wait([disconnected, changed], return_when=asyncio.FIRST_COMPLETED)
+                    changed.cancel()
+            if not disconnected.done():
+                await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+        finally:
+            disconnected.cancel()
+        return True
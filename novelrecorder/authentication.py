@@ -0,0 +1,58 @@
+from django.conf import settings
+from django.core.cache import cache
+from rest_framework import authentication, exceptions
+
+from novelrecorder import metrics
+
+DEFAULT_TOKEN_CACHE_TIMEOUT = 60  # In seconds. Bounds how long a revocation takes to reach other processes.
+
+
+class AuthenticatedToken(object):
+    """What request.auth is set to for a token authenticated request."""
+    def __init__(self, token_id, scopes):
+        self.token_id = token_id
+        self.scopes = scopes
+
+    def has_scope(self, scope):
+        return scope in self.scopes
+
+
+# Authorization: Token <key>
+# The key is looked up by its SHA-256, and the ids of the token and its user and the scopes it resolves to are cached,
+# so a request from a script costs a hash, a cache lookup and the load of the user rather than a PBKDF2 run
+# (BasicAuthentication). The user is loaded each time, so e.g. deactivating them takes effect straight away.
+class NovelUserTokenAuthentication(authentication.BaseAuthentication):
+    keyword = 'Token'
+
+    def authenticate(self, request):
+        auth = authentication.get_authorization_header(request).split()
+        if not auth or auth[0].lower() != self.keyword.lower().encode():
+            return None
+        if len(auth) != 2:
+            raise exceptions.AuthenticationFailed('Invalid token header.')
+        try:
+            key = auth[1].decode()
+        except UnicodeError:
+            raise exceptions.AuthenticationFailed('Invalid token header.')
+        return self.authenticate_key(key)
+
+    def authenticate_key(self, key):
+        # Not imported at the top: DRF imports this class while novelrecorder.models is being loaded.
+        from novelrecorder.models import NovelUser, NovelUserToken
+        key_hash = NovelUserToken.hash_key(key)
+        cache_key = NovelUserToken.get_cache_key(key_hash)
+        cached = cache.get(cache_key)
+        metrics.record_cache_lookup('token', cached is not None)
+        if cached is None:
+            token = NovelUserToken.objects.filter(key_hash=key_hash, time_revoked__isnull=True).first()
+            if token is None:
+                raise exceptions.AuthenticationFailed('Invalid token.')
+            cached = {'user_id': token.user_id, 'token_id': token.id, 'scopes': token.get_scopes()}
+            cache.set(cache_key, cached, getattr(settings, 'TOKEN_CACHE_TIMEOUT', DEFAULT_TOKEN_CACHE_TIMEOUT))
+        user = NovelUser.objects.filter(pk=cached['user_id'], is_active=True).first()
+        if user is None:
+            raise exceptions.AuthenticationFailed('Invalid token.')
+        return user, AuthenticatedToken(cached['token_id'], cached['scopes'])
+
+    def authenticate_header(self, request):
+        return self.keyword
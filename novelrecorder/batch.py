@@ -0,0 +1,481 @@
+from django.db import connection, router, IntegrityError
+from django.db.models import F, Max, Q, ProtectedError
+from django.utils import timezone
+from rest_framework import serializers
+
+from novelrecorder import changelog, metrics, revisions, sharding
+from novelrecorder.constants import BATCH_MAX_OPERATIONS
+from novelrecorder.models import Character, Relationship, Description
+from novelrecorder.permissions import NovelUserPermission
+from novelrecorder.serializers import DescriptionPartialUpdateSerializer
+
+# Batch editing of a novel: an ordered list of operations applied with one bulk query per kind of change in a
+# single transaction, instead of one request (authentication, permission lookups, transaction) per object.
+#
+# An operation is {'op': 'create' | 'update' | 'delete', 'type': 'character' | 'relationship' | 'description',
+# 'id': <for update and delete>, 'ref': <optional name of a created character or relationship>, 'data': {...}}.
+# The character/relationship of a created relationship or description is either an id or '$<ref>' of one created
+# earlier in the batch. Either every operation is applied or none is.
+
+OP_CREATE = 'create'
+OP_UPDATE = 'update'
+OP_DELETE = 'delete'
+
+TYPE_CHARACTER = 'character'
+TYPE_RELATIONSHIP = 'relationship'
+TYPE_DESCRIPTION = 'description'
+
+MODEL_CLASSES = {TYPE_CHARACTER: Character, TYPE_RELATIONSHIP: Relationship, TYPE_DESCRIPTION: Description}
+# Descriptions before what they belong to, so nothing deleted is still referred to
+DELETE_ORDER = [TYPE_DESCRIPTION, TYPE_RELATIONSHIP, TYPE_CHARACTER]
+
+
+# An id, or '$<ref>' of an object created earlier in the batch
+class BatchReferenceField(serializers.Field):
+    def to_internal_value(self, data):
+        if isinstance(data, str) and data.startswith('$') and len(data) > 1:
+            return data
+        if isinstance(data, int) and not isinstance(data, bool):
+            return data
+        raise serializers.ValidationError('Expected an id or a "$ref" of an object created in this batch.')
+
+
+class CharacterBatchSerializer(serializers.Serializer):
+    name = serializers.CharField(max_length=200)
+    des_title = serializers.CharField(max_length=200)
+    des_content = serializers.CharField(allow_blank=True, required=False, default='')
+
+
+class CharacterBatchUpdateSerializer(serializers.Serializer):
+    name = serializers.CharField(max_length=200)
+
+
+class RelationshipBatchSerializer(serializers.Serializer):
+    character1 = BatchReferenceField()
+    character2 = BatchReferenceField()
+    des_title = serializers.CharField(max_length=200)
+    des_content = serializers.CharField(allow_blank=True, required=False, default='')
+
+
+class DescriptionBatchSerializer(serializers.Serializer):
+    character = BatchReferenceField(required=False)
+    relationship = BatchReferenceField(required=False)
+    title = serializers.CharField(max_length=200)
+    content = serializers.CharField(allow_blank=True, required=False, default='')
+
+    def validate(self, attrs):
+        if ('character' in attrs) == ('relationship' in attrs):
+            raise serializers.ValidationError('A description is linked to either a character or a relationship.')
+        return attrs
+
+
+class DescriptionBatchUpdateSerializer(serializers.Serializer):
+    title = serializers.CharField(max_length=200, required=False)
+    content = serializers.CharField(allow_blank=True, required=False)
+
+
+DATA_SERIALIZERS = {
+    (OP_CREATE, TYPE_CHARACTER): CharacterBatchSerializer,
+    (OP_UPDATE, TYPE_CHARACTER): CharacterBatchUpdateSerializer,
+    (OP_CREATE, TYPE_RELATIONSHIP): RelationshipBatchSerializer,
+    (OP_CREATE, TYPE_DESCRIPTION): DescriptionBatchSerializer,
+    (OP_UPDATE, TYPE_DESCRIPTION): DescriptionBatchUpdateSerializer,
+}
+
+
+class BatchOperation(object):
+    def __init__(self, index, op, type, id=None, ref=None, data=None):
+        self.index = index
+        self.op = op
+        self.type = type
+        self.id = id
+        self.ref = ref
+        self.data = data or {}
+        self.instance = None  # The object created, updated or deleted
+
+    def result(self):
+        return {'index': self.index, 'op': self.op, 'type': self.type, 'id': self.instance.pk if self.op != OP_DELETE else self.id,
+                'ref': self.ref, 'status': self.op + 'd'}
+
+
+class NovelBatch(object):
+    def __init__(self, novel, user, operations):
+        self.novel = novel
+        self.user = user
+        self.raw_operations = operations
+        self.operations = []
+        self.errors = {}  # index -> errors
+        self.permission = NovelUserPermission()
+
+    def add_error(self, operation, error):
+        self.errors.setdefault(operation.index, []).append(error)
+
+    # Validates everything and raises a ValidationError with the errors of each failed operation by its index.
+    def validate(self):
+        if not isinstance(self.raw_operations, list) or not self.raw_operations:
+            raise serializers.ValidationError({'operations': 'Expected a non-empty list of operations.'})
+        if len(self.raw_operations) > BATCH_MAX_OPERATIONS:
+            raise serializers.ValidationError({'operations': 'At most %s operations per batch.' % BATCH_MAX_OPERATIONS})
+        self.parse_operations()
+        self.raise_errors()
+        self.load_objects()
+        self.validate_operations()
+        self.raise_errors()
+
+    def raise_errors(self):
+        if self.errors:
+            raise serializers.ValidationError({'errors': self.errors})
+
+    def parse_operations(self):
+        refs = set()
+        targets = set()
+        for index, raw in enumerate(self.raw_operations):
+            operation = BatchOperation(index, raw.get('op'), raw.get('type')) if isinstance(raw, dict) else None
+            if operation is None or operation.op not in (OP_CREATE, OP_UPDATE, OP_DELETE) \
+                    or operation.type not in MODEL_CLASSES:
+                self.errors[index] = ['Expected an object with "op" in create, update, delete and '
+                                      '"type" in character, relationship, description.']
+                continue
+            self.operations.append(operation)
+
+            if operation.op == OP_CREATE:
+                operation.ref = raw.get('ref')
+                if operation.ref is not None:
+                    if operation.type == TYPE_DESCRIPTION or not isinstance(operation.ref, str) or operation.ref in refs:
+                        self.add_error(operation, 'A ref names a created character or relationship, once per batch.')
+                    refs.add(operation.ref)
+            else:
+                operation.id = raw.get('id')
+                if not isinstance(operation.id, int) or isinstance(operation.id, bool):
+                    self.add_error(operation, 'Expected the id of the object to %s.' % operation.op)
+                elif (operation.type, operation.id) in targets:
+                    self.add_error(operation, 'Only one operation per object in a batch.')
+                targets.add((operation.type, operation.id))
+
+            serializer_class = DATA_SERIALIZERS.get((operation.op, operation.type))
+            if serializer_class is not None:
+                serializer = serializer_class(data=raw.get('data') or {})
+                if serializer.is_valid():
+                    operation.data = serializer.validated_data
+                else:
+                    self.add_error(operation, serializer.errors)
+            elif operation.op == OP_UPDATE:
+                self.add_error(operation, 'A relationship has nothing to update.')
+
+    # One query per type for all the existing objects the batch refers to, limited to this novel.
+    def load_objects(self):
+        ids = {type: set() for type in MODEL_CLASSES}
+        for operation in self.operations:
+            if operation.id is not None:
+                ids[operation.type].add(operation.id)
+            for field, type in [('character1', TYPE_CHARACTER), ('character2', TYPE_CHARACTER),
+                                ('character', TYPE_CHARACTER), ('relationship', TYPE_RELATIONSHIP)]:
+                if isinstance(operation.data.get(field), int):
+                    ids[type].add(operation.data[field])
+
+        self.objects = {type: {} for type in MODEL_CLASSES}
+        if ids[TYPE_CHARACTER]:
+            self.objects[TYPE_CHARACTER] = Character.objects.filter(novel=self.novel).in_bulk(ids[TYPE_CHARACTER])
+        if ids[TYPE_RELATIONSHIP]:
+            self.objects[TYPE_RELATIONSHIP] = Relationship.objects.select_related('character1', 'character2').filter(
+                character1__novel=self.novel).in_bulk(ids[TYPE_RELATIONSHIP])
+        if ids[TYPE_DESCRIPTION]:
+            self.objects[TYPE_DESCRIPTION] = Description.objects.select_related(
+                'character', 'relationship__character1').filter(
+                Q(character__novel=self.novel) | Q(relationship__character1__novel=self.novel)).in_bulk(ids[TYPE_DESCRIPTION])
+        # So getNovel() of any of them doesn't query the novel again
+        for character in self.objects[TYPE_CHARACTER].values():
+            character.novel = self.novel
+        for relationship in self.objects[TYPE_RELATIONSHIP].values():
+            relationship.character1.novel = self.novel
+        for description in self.objects[TYPE_DESCRIPTION].values():
+            (description.character or description.relationship.character1).novel = self.novel
+
+    def resolve(self, operation, field, type, created):
+        value = operation.data[field]
+        if isinstance(value, str):
+            obj = created.get(value[1:])
+            if obj is None or not isinstance(obj, MODEL_CLASSES[type]):
+                self.add_error(operation, {field: 'No %s created earlier in this batch with ref %s.' % (type, value[1:])})
+        else:
+            obj = self.objects[type].get(value)
+            if obj is None:
+                self.add_error(operation, {field: 'No %s with id %s in this novel.' % (type, value)})
+            elif (type, value) in self.deleted:
+                self.add_error(operation, {field: 'The %s with id %s is deleted in this batch.' % (type, value)})
+        return obj
+
+    def validate_operations(self):
+        # The permission group is looked up once, then each object is checked against it
+        permission_group = self.permission.get_permission_group(self.user, self.novel)
+        self.deleted = {(operation.type, operation.id) for operation in self.operations if operation.op == OP_DELETE}
+        created = {}  # ref -> the unsaved object
+        for operation in self.operations:
+            model_class = MODEL_CLASSES[operation.type]
+            if operation.op == OP_CREATE:
+                data = operation.data
+                if operation.type == TYPE_CHARACTER:
+                    operation.instance = Character(novel=self.novel, name=data['name'])
+                elif operation.type == TYPE_RELATIONSHIP:
+                    character1 = self.resolve(operation, 'character1', TYPE_CHARACTER, created)
+                    character2 = self.resolve(operation, 'character2', TYPE_CHARACTER, created)
+                    if character1 is None or character2 is None:
+                        continue
+                    operation.instance = Relationship(character1=character1, character2=character2)
+                else:
+                    field, type = ('character', TYPE_CHARACTER) if 'character' in data else ('relationship', TYPE_RELATIONSHIP)
+                    owner = self.resolve(operation, field, type, created)
+                    if owner is None:
+                        continue
+                    # No author yet, so creating one needs the permission to add descriptions to the novel
+                    operation.instance = Description(title=data['title'], content=data['content'], **{field: owner})
+                if operation.ref is not None:
+                    created[operation.ref] = operation.instance
+            else:
+                operation.instance = self.objects[operation.type].get(operation.id)
+                if operation.instance is None:
+                    self.add_error(operation, 'No %s with id %s in this novel.' % (operation.type, operation.id))
+                    continue
+                if operation.op == OP_DELETE and operation.type == TYPE_DESCRIPTION and operation.instance.is_primary:
+                    self.add_error(operation, "You can't delete a primary description.")
+
+            if not self.permission.custom_has_object_permission(self.user, True, operation.instance, permission_group):
+                self.add_error(operation, 'You have no permission to %s this %s.' % (operation.op, operation.type))
+
+        self.validate_character_names()
+        self.validate_character_deletes()
+
+    # Names are unique in a novel. Left to the database for the rare swaps of names within a batch.
+    def validate_character_names(self):
+        renamed = [operation for operation in self.operations if operation.type == TYPE_CHARACTER
+                   and operation.op in (OP_CREATE, OP_UPDATE) and operation.instance is not None]
+        if not renamed:
+            return
+        names = {}
+        for operation in renamed:
+            if operation.data['name'] in names:
+                self.add_error(operation, {'name': 'Another operation in this batch uses this name.'})
+            names[operation.data['name']] = operation
+        freed = {operation.id for operation in self.operations if operation.type == TYPE_CHARACTER and operation.op != OP_CREATE}
+        taken = set(Character.objects.filter(novel=self.novel, name__in=names).exclude(id__in=freed).values_list('name', flat=True))
+        for name in taken:
+            self.add_error(names[name], {'name': 'There is already a character with this name in the novel.'})
+
+    # Characters are protected from deletion by their relationships, unless those are deleted in the batch too.
+    def validate_character_deletes(self):
+        deleted_characters = {operation.id: operation for operation in self.operations
+                              if operation.type == TYPE_CHARACTER and operation.op == OP_DELETE}
+        if not deleted_characters:
+            return
+        deleted_relationships = [operation.id for operation in self.operations
+                                 if operation.type == TYPE_RELATIONSHIP and operation.op == OP_DELETE]
+        remaining = Relationship.objects.filter(
+            Q(character1__in=deleted_characters) | Q(character2__in=deleted_characters)).exclude(
+            id__in=deleted_relationships).values_list('character1_id', 'character2_id')
+        for character_ids in remaining:
+            for character_id in character_ids:
+                if character_id in deleted_characters:
+                    self.add_error(deleted_characters[character_id], 'The character still has relationships.')
+
+    def of(self, op, type):
+        return [operation for operation in self.operations if operation.op == op and operation.type == type]
+
+    # Applies the validated operations and returns the result of each, in order.
+    def apply(self):
+        try:
+            with changelog.recording_changes(self.novel.pk):
+                self.apply_creates()
+                self.apply_updates()
+                self.record_changes()
+                self.record_revisions()
+                self.apply_deletes()  # Recorded by the signals of the change log
+        except (IntegrityError, ProtectedError) as e:
+            raise serializers.ValidationError({'detail': 'The batch conflicts with the novel: %s' % e})
+        for operation in self.operations:
+            metrics.inc('novelrecorder_batch_operations_total', {'op': operation.op, 'type': operation.type})
+        return [operation.result() for operation in self.operations]
+
+    # bulk_create and bulk_update don't send the signals the change log is recorded by
+    def record_changes(self):
+        for operation in self.of(OP_CREATE, TYPE_CHARACTER) + self.of(OP_CREATE, TYPE_RELATIONSHIP):
+            changelog.record(operation.instance, changelog.ACTION_CREATE)
+        for description in self.primary_descriptions:
+            changelog.record(description, changelog.ACTION_CREATE)
+        for operation in self.of(OP_CREATE, TYPE_DESCRIPTION) + [operation for operation in self.operations
+                                                                 if operation.op == OP_UPDATE]:
+            changelog.record(operation.instance, operation.op)
+
+    # Nor the one the revisions are
+    def record_revisions(self):
+        created = self.primary_descriptions + [operation.instance for operation in self.of(OP_CREATE, TYPE_DESCRIPTION)]
+        revisions.record_revisions(created + [operation.instance for operation in self.of(OP_UPDATE, TYPE_DESCRIPTION)],
+                                   router.db_for_write(Description), created)
+
+    def apply_creates(self):
+        characters = [operation.instance for operation in self.of(OP_CREATE, TYPE_CHARACTER)]
+        bulk_create_with_ids(characters, lambda: Character.objects.filter(
+            novel=self.novel, name__in=[character.name for character in characters]), lambda c: c.name)
+
+        relationships = [operation.instance for operation in self.of(OP_CREATE, TYPE_RELATIONSHIP)]
+        for relationship in relationships:  # Now the characters created have ids
+            relationship.character1 = relationship.character1
+            relationship.character2 = relationship.character2
+        bulk_create_with_ids(relationships, lambda: Relationship.objects.filter(
+            character1__in={relationship.character1_id for relationship in relationships}),
+            lambda r: (r.character1_id, r.character2_id))
+
+        # The primary descriptions go first, to have the smallest sort_order of their character or relationship
+        self.primary_descriptions = []
+        for operation in self.of(OP_CREATE, TYPE_CHARACTER) + self.of(OP_CREATE, TYPE_RELATIONSHIP):
+            field = operation.type
+            self.primary_descriptions.append(Description(author=self.user, title=operation.data['des_title'],
+                                                         content=operation.data['des_content'], is_primary=True,
+                                                         **{field: operation.instance}))
+        descriptions = list(self.primary_descriptions)
+        for operation in self.of(OP_CREATE, TYPE_DESCRIPTION):
+            description = operation.instance
+            description.author = self.user
+            description.character = description.character  # Now the owners created have ids
+            description.relationship = description.relationship
+            descriptions.append(description)
+        bulk_create_descriptions(descriptions)
+
+    def apply_updates(self):
+        characters = []
+        for operation in self.of(OP_UPDATE, TYPE_CHARACTER):
+            operation.instance.name = operation.data['name']
+            characters.append(operation.instance)
+        if characters:  # bulk_update goes where the reads would without using()
+            Character.objects.using(router.db_for_write(Character)).bulk_update(characters, ['name'])
+
+        descriptions = []
+        for operation in self.of(OP_UPDATE, TYPE_DESCRIPTION):
+            for field, value in operation.data.items():
+                setattr(operation.instance, field, value)
+            descriptions.append(operation.instance)
+        bulk_update_descriptions(descriptions)
+
+    def apply_deletes(self):
+        for type in DELETE_ORDER:
+            ids = [operation.id for operation in self.of(OP_DELETE, type)]
+            if ids:
+                MODEL_CLASSES[type].objects.filter(id__in=ids).delete()
+
+
+# bulk_create only sets the ids on the backends returning them from the insert (PostgreSQL), otherwise they are
+# looked up by a natural key in one more query. With shards the ids are given beforehand.
+def bulk_create_with_ids(objs, lookup_queryset, natural_key):
+    if not objs:
+        return
+    model_class = objs[0].__class__
+    ids_assigned = sharding.assign_ids(objs)
+    model_class.objects.bulk_create(objs)
+    if ids_assigned or connection.features.can_return_ids_from_bulk_insert:
+        return
+    ids = {natural_key(obj): obj.pk for obj in lookup_queryset()}
+    for obj in objs:
+        obj.pk = ids[natural_key(obj)]
+
+
+# Descriptions have no natural key: without ids from the insert they are the rows after the largest id before
+# it, in order (the rows of one insert get increasing ids, and the transaction holds the SQLite write lock).
+# Also does what Description.save() and descriptionAfterSave do for a save, which bulk_create doesn't send post_save for.
+def bulk_create_descriptions(descriptions):
+    if not descriptions:
+        return
+    Description.save_contents(descriptions, router.db_for_write(Description))
+    if sharding.assign_ids(descriptions):
+        for description in descriptions:
+            description.sort_order = description.pk
+        Description.objects.bulk_create(descriptions)
+        return
+    returns_ids = connection.features.can_return_ids_from_bulk_insert
+    max_id = None if returns_ids else Description.objects.aggregate(max_id=Max('id'))['max_id'] or 0
+    Description.objects.bulk_create(descriptions)
+    if not returns_ids:
+        ids = Description.objects.filter(id__gt=max_id, sort_order=0).order_by('id').values_list('id', flat=True)
+        for description, id in zip(descriptions, ids):
+            description.pk = id
+    Description.objects.filter(id__in=[description.pk for description in descriptions]).update(sort_order=F('id'))
+    for description in descriptions:
+        description.sort_order = description.pk
+
+
+# The title and content set on the descriptions written with one bulk_update, doing what Description.save() does but
+# the signals (see NovelBatch.record_changes and record_revisions).
+def bulk_update_descriptions(descriptions):
+    if not descriptions:
+        return
+    now = timezone.now()
+    for description in descriptions:
+        description.time_modified = now  # bulk_update doesn't go through auto_now
+    using = router.db_for_write(Description)  # bulk_update goes where the reads would without using()
+    Description.save_contents(descriptions, using)
+    Description.objects.using(using).bulk_update(descriptions, ['title', 'blob', 'excerpt', 'excerpt_html',
+                                                                'word_count', 'time_modified'])
+
+
+# The descriptions of a character or a relationship edited at once, from one page or request rather than one per
+# description: a DescriptionPartialUpdateSerializer per description given in data ([{'id': ..., 'title': ...,
+# 'content': ...}], the others are left as they are). Everything is validated before anything is written, then the
+# descriptions changed are written with one bulk_update, their changes recorded with one change_seq allocation.
+class DescriptionFormset(object):
+    def __init__(self, owner, user, data=None):
+        self.owner = owner
+        self.owner_type = TYPE_CHARACTER if isinstance(owner, Character) else TYPE_RELATIONSHIP
+        self.user = user
+        self.data = data
+        self.descriptions = list(Description.objects.filter(**{self.owner_type: owner}).select_related('blob')
+                                 .order_by('sort_order', 'id'))
+        for description in self.descriptions:  # So getNovel() of each doesn't query the owner again
+            setattr(description, self.owner_type, owner)
+        self.forms = {}  # description id -> its bound serializer
+        self.errors = {}  # index in data -> errors
+
+    # The descriptions in order, each with its serializer if it's in data.
+    @property
+    def rows(self):
+        return [(description, self.forms.get(description.pk)) for description in self.descriptions]
+
+    def is_valid(self):
+        if not isinstance(self.data, list) or not self.data:
+            self.errors = {'descriptions': 'Expected a non-empty list of descriptions.'}
+            return False
+        if len(self.data) > BATCH_MAX_OPERATIONS:
+            self.errors = {'descriptions': 'At most %s descriptions at a time.' % BATCH_MAX_OPERATIONS}
+            return False
+        descriptions = {description.pk: description for description in self.descriptions}
+        permission = NovelUserPermission()
+        permission_group = permission.get_permission_group(self.user, self.owner.getNovel())
+        for index, item in enumerate(self.data):
+            description = descriptions.get(item.get('id')) if isinstance(item, dict) else None
+            if description is None:
+                self.errors[index] = ['Expected the id of a description of this %s.' % self.owner_type]
+            elif description.pk in self.forms:
+                self.errors[index] = ['Only one edit per description.']
+            elif not permission.custom_has_object_permission(self.user, True, description, permission_group):
+                self.errors[index] = ['You have no permission to edit this description.']
+            else:
+                form = self.forms[description.pk] = DescriptionPartialUpdateSerializer(description, data=item)
+                if not form.is_valid():
+                    self.errors[index] = form.errors
+        return not self.errors
+
+    # Writes the changes and returns the descriptions changed.
+    def save(self):
+        changed = []
+        for description, form in self.rows:
+            if form is None:
+                continue
+            data = {field: value for field, value in form.validated_data.items() if field in ('title', 'content')}
+            if all(getattr(description, field) == value for field, value in data.items()):
+                continue
+            for field, value in data.items():
+                setattr(description, field, value)
+            changed.append(description)
+        with changelog.recording_changes(self.owner.getNovelId()):
+            bulk_update_descriptions(changed)
+            for description in changed:
+                changelog.record(description, changelog.ACTION_UPDATE)
+            revisions.record_revisions(changed, router.db_for_write(Description))
+        return changed
@@ -0,0 +1,139 @@
+import random
+
+from django.contrib.auth.hashers import make_password
+from django.core.management.color import no_style
+from django.db import connection, router, transaction
+
+from novelrecorder.models import NovelUser, Novel, Character, Relationship, Description
+from novelrecorder.revisions import record_revisions
+
+# Number of rows generated by each preset. 'large' is the size of our largest deployments.
+PRESETS = {
+    'tiny': {'users': 5, 'novels': 5, 'characters': 100, 'relationships': 300, 'descriptions': 1000},
+    'small': {'users': 20, 'novels': 50, 'characters': 2000, 'relationships': 10000, 'descriptions': 20000},
+    'medium': {'users': 100, 'novels': 200, 'characters': 20000, 'relationships': 100000, 'descriptions': 200000},
+    'large': {'users': 300, 'novels': 1000, 'characters': 100000, 'relationships': 500000, 'descriptions': 1000000},
+}
+BENCHMARK_PASSWORD = 'benchmark'
+BATCH_SIZE = 2000
+WORDS = ('the', 'of', 'and', 'a', 'to', 'in', 'is', 'was', 'he', 'she', 'that', 'it', 'with', 'for', 'as', 'his',
+         'her', 'on', 'be', 'at', 'by', 'sword', 'castle', 'letter', 'storm', 'night', 'promise', 'secret', 'brother',
+         'sister', 'king', 'village', 'river', 'memory', 'war', 'friend', 'enemy', 'journey', 'dream', 'fire')
+
+
+def long_tailed_split(rng: random.Random, total, parts, minimum=0):
+    """Splits total into parts with a Pareto distribution, i.e. a few very big parts and many small ones."""
+    weights = [rng.paretovariate(1.2) for _ in range(parts)]
+    weight_sum = sum(weights)
+    remaining = total - minimum * parts
+    sizes = [minimum + int(remaining * weight / weight_sum) for weight in weights]
+    for index in range(total - sum(sizes)):
+        sizes[index % parts] += 1
+    return sizes
+
+
+def make_text(rng: random.Random):
+    # Log-normal length: mostly a sentence or a paragraph, sometimes chapter-length.
+    length = min(int(rng.lognormvariate(4.0, 1.3)), 20000)
+    return ' '.join(rng.choice(WORDS) for _ in range(max(length, 1)))
+
+
+class NovelGenerator(object):
+    """Bulk creates a reproducible (for the same seed) set of novels, with explicit ids so that it doesn't
+    rely on bulk_create returning them, which SQLite doesn't."""
+
+    def __init__(self, preset='tiny', seed=0, stdout=None):
+        self.sizes = PRESETS[preset]
+        self.rng = random.Random(seed)
+        self.stdout = stdout
+
+    def log(self, message):
+        if self.stdout:
+            self.stdout.write(message)
+
+    @staticmethod
+    def next_id(model):
+        last = model.objects.order_by('-id').values_list('id', flat=True).first()
+        return (last or 0) + 1
+
+    def bulk_create(self, model, objects):
+        if not objects:
+            return
+        using = router.db_for_write(model)  # Where bulk_create writes, not a replica the reads may go to
+        for start in range(0, len(objects), BATCH_SIZE):
+            if model is Description:  # Their content goes to the blobs first
+                Description.save_contents(objects[start:start + BATCH_SIZE], using)
+            model.objects.bulk_create(objects[start:start + BATCH_SIZE])
+            if model is Description:  # And their first revisions
+                record_revisions(objects[start:start + BATCH_SIZE], using, objects[start:start + BATCH_SIZE])
+        self.log('  %s %s rows' % (model.__name__, len(objects)))
+
+    @transaction.atomic
+    def generate(self):
+        rng = self.rng
+        password = make_password(BENCHMARK_PASSWORD)
+
+        user_id = self.next_id(NovelUser)
+        users = [NovelUser(id=user_id + index, username='benchmark_user_%s' % (user_id + index), password=password)
+                 for index in range(self.sizes['users'])]
+        self.bulk_create(NovelUser, users)
+
+        novel_id = self.next_id(Novel)
+        novels = [Novel(id=novel_id + index, author_id=rng.choice(users).id, name='Benchmark Novel %s' % (novel_id + index),
+                        is_public=rng.random() < 0.8)
+                  for index in range(self.sizes['novels'])]
+        self.bulk_create(Novel, novels)
+
+        character_id = self.next_id(Character)
+        characters_by_novel = {}
+        characters = []
+        for novel, count in zip(novels, long_tailed_split(rng, self.sizes['characters'], len(novels), minimum=2)):
+            for _ in range(count):
+                character = Character(id=character_id, novel_id=novel.id, name='Character %s' % character_id)
+                characters_by_novel.setdefault(novel.id, []).append(character)
+                characters.append(character)
+                character_id += 1
+        self.bulk_create(Character, characters)
+
+        relationship_id = self.next_id(Relationship)
+        relationships = []
+        novel_characters = list(characters_by_novel.values())
+        for cast, count in zip(novel_characters, long_tailed_split(rng, self.sizes['relationships'], len(novel_characters))):
+            pairs = set()
+            count = min(count, len(cast) * (len(cast) - 1))
+            while len(pairs) < count:
+                character1, character2 = rng.sample(cast, 2)
+                pairs.add((character1.id, character2.id))
+            for character1_id, character2_id in sorted(pairs):
+                relationships.append(Relationship(id=relationship_id, character1_id=character1_id, character2_id=character2_id))
+                relationship_id += 1
+        self.bulk_create(Relationship, relationships)
+
+        # Every character and relationship has its primary description, the rest are spread with a long tail.
+        character_novels = {c.id: c.novel_id for c in characters}
+        owners = [('character_id', c.id, c.novel_id) for c in characters] + \
+                 [('relationship_id', r.id, character_novels[r.character1_id]) for r in relationships]
+        extra = max(self.sizes['descriptions'] - len(owners), 0)
+        extra_counts = long_tailed_split(rng, extra, len(owners)) if owners else []
+        novel_authors = {novel.id: novel.author_id for novel in novels}
+        description_id = self.next_id(Description)
+        descriptions = []
+        for (owner_field, owner_id, novel_id), extra_count in zip(owners, extra_counts):
+            for index in range(1 + extra_count):
+                description = Description(**{
+                    'id': description_id, owner_field: owner_id, 'author_id': novel_authors[novel_id],
+                    'title': 'Description %s' % description_id, 'content': make_text(rng),
+                    'sort_order': description_id, 'is_primary': index == 0,
+                })
+                descriptions.append(description)
+                description_id += 1
+            if len(descriptions) >= BATCH_SIZE * 10:
+                self.bulk_create(Description, descriptions)
+                descriptions = []
+        self.bulk_create(Description, descriptions)
+
+        # Explicit ids leave the sequences behind on e.g. PostgreSQL.
+        with connection.cursor() as cursor:
+            for sql in connection.ops.sequence_reset_sql(no_style(), [NovelUser, Novel, Character, Relationship, Description]):
+                cursor.execute(sql)
+        return novels
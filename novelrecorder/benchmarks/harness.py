@@ -0,0 +1,124 @@
+import statistics
+import time
+
+from django.db import connection
+from django.db.models import Count
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from novelrecorder.benchmarks.query_plans import check_query_plans
+from novelrecorder.models import Novel, Character, Relationship, Description
+
+# The delete routes only take POSTs that would destroy the dataset (novel_clone ones that would grow it), the profiling
+# ones are staff only.
+SKIPPED_ROUTES = ['character_detail_delete', 'relationship_detail_delete', 'description_detail_delete', 'novel_clone',
+                  'profile_list', 'profile_download', 'novel_events']  # novel_events streams until MAX_DURATION
+
+
+def pick_objects():
+    """The objects the routes are benchmarked on: the biggest of each, as that's where regressions hurt."""
+    novel = Novel.objects.annotate(size=Count('character')).order_by('-size', 'id').first()
+    character = Character.objects.filter(novel=novel).annotate(
+        size=Count('relationship_character1')).order_by('-size', 'id').first()
+    relationship = Relationship.objects.filter(character1=character).order_by('id').first()
+    other = Character.objects.filter(novel=novel).exclude(id=character.id).order_by('id').first()
+    description = Description.objects.filter(character=character).order_by('id').first()
+    return {'novel': novel, 'character': character, 'other_character': other,
+            'relationship': relationship, 'description': description}
+
+
+def get_route_requests(objects):
+    """Maps each route name in novelrecorder/urls.py to the (url kwargs, query string) to benchmark it with."""
+    return {
+        'index': ({}, ''),
+        'public_novel_list': ({}, ''),
+        'my_novel_list': ({}, ''),
+        'novel_detail': ({'pk': objects['novel'].pk}, ''),
+        'novel_detail_create': ({}, ''),
+        'character_detail': ({'pk': objects['character'].pk}, ''),
+        'character_detail_create': ({}, 'novel_id=%s' % objects['novel'].pk),
+        'relationship_detail': ({'pk': objects['relationship'].pk}, ''),
+        'relationship_detail_create': ({}, 'character1_id=%s&character2_id=%s' % (
+            objects['character'].pk, objects['other_character'].pk)),
+        'description_list_character': ({'character_id': objects['character'].pk}, ''),
+        'description_list_relationship': ({'relationship_id': objects['relationship'].pk}, ''),
+        'description_detail': ({'pk': objects['description'].pk}, ''),
+        'description_detail_create': ({}, 'character_id=%s' % objects['character'].pk),
+        'description_bulk_edit_character': ({'pk': objects['character'].pk}, ''),
+        'description_bulk_edit_relationship': ({'pk': objects['relationship'].pk}, ''),
+    }
+
+
+def get_unlisted_routes(route_requests):
+    from novelrecorder import urls
+    names = [pattern.name for pattern in urls.urlpatterns]
+    return [name for name in names if name not in route_requests and name not in SKIPPED_ROUTES]
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def measure(client, url, iterations, warmup=1):
+    for _ in range(warmup):
+        client.get(url)
+    durations = []
+    queries = None
+    status = None
+    for _ in range(iterations):
+        with CaptureQueriesContext(connection) as context:
+            start = time.perf_counter()
+            response = client.get(url)
+            durations.append((time.perf_counter() - start) * 1000)
+        queries = len(context)
+        status = response.status_code
+    return {
+        'url': url,
+        'status': status,
+        'queries': queries,
+        'bytes': len(response.content),
+        'median_ms': round(statistics.median(durations), 2),
+        'p95_ms': round(percentile(durations, 0.95), 2),
+        'min_ms': round(min(durations), 2),
+    }
+
+
+def run_benchmarks(iterations=5, stdout=None):
+    objects = pick_objects()
+    client = Client()
+    client.force_login(objects['novel'].author)
+    route_requests = get_route_requests(objects)
+    results = {}
+    for name, (kwargs, query) in route_requests.items():
+        url = reverse('novelrecorder:%s' % name, kwargs=kwargs) + ('?' + query if query else '')
+        results[name] = measure(client, url, iterations)
+        if stdout:
+            stdout.write('  %-32s %4s queries %9.2f ms (p95 %9.2f ms)' % (
+                name, results[name]['queries'], results[name]['median_ms'], results[name]['p95_ms']))
+    return {
+        'vendor': connection.vendor,
+        'novel_size': Character.objects.filter(novel=objects['novel']).count(),
+        'routes': results,
+        'unlisted_routes': get_unlisted_routes(route_requests),
+        'sequential_scans': {name: tables for name, tables in check_query_plans(objects).items() if tables},
+    }
+
+
+def compare(baseline, current, tolerance=0.25, min_delta_ms=5.0):
+    """Returns the regressions of current against baseline: any extra query, or a median slower by
+    more than tolerance (and min_delta_ms, so the noise on fast routes doesn't count)."""
+    regressions = []
+    for name, result in current['routes'].items():
+        before = baseline['routes'].get(name)
+        if not before:
+            continue
+        if result['queries'] > before['queries']:
+            regressions.append('%s: %s queries, was %s' % (name, result['queries'], before['queries']))
+        if result['median_ms'] > before['median_ms'] * (1 + tolerance) and \
+                result['median_ms'] - before['median_ms'] > min_delta_ms:
+            regressions.append('%s: %.2f ms, was %.2f ms' % (name, result['median_ms'], before['median_ms']))
+        if result['status'] != before['status']:
+            regressions.append('%s: status %s, was %s' % (name, result['status'], before['status']))
+    return regressions
@@ -0,0 +1,53 @@
+import re
+
+from django.db import connection, transaction
+
+from novelrecorder.constants import NUP_VIEW_ONLY
+from novelrecorder.models import Novel, Relationship, Description, NovelUserPermissionModel
+
+# SQLite: "SCAN novelrecorder_novel" (or "SCAN TABLE ..." before 3.36) reads the whole table, unless followed by
+# "USING [COVERING] INDEX".
+SQLITE_SCAN = re.compile(r'\bSCAN (?:TABLE )?(\w+)(.*)')
+
+
+def get_hot_queries(objects):
+    """The queries the indexes of the models are for (by name), on the objects picked by harness.pick_objects."""
+    character, relationship, novel = objects['character'], objects['relationship'], objects['novel']
+    return {
+        'descriptions_of_character': Description.objects.filter(character=character).order_by('sort_order'),
+        'descriptions_of_relationship': Description.objects.filter(relationship=relationship).order_by('sort_order'),
+        'primary_descriptions_of_characters': Description.objects.filter(
+            character__in=[character.pk, objects['other_character'].pk], is_primary=True),
+        'primary_descriptions_of_relationships': Description.objects.filter(
+            relationship__in=[relationship.pk], is_primary=True),
+        'public_novels': Novel.objects.filter(is_public=True).order_by('name'),
+        'permission_of_user': NovelUserPermissionModel.objects.filter(novel=novel, user_id=novel.author_id),
+        'novels_granted_to_user': NovelUserPermissionModel.objects.filter(
+            user_id=novel.author_id, permission__gte=NUP_VIEW_ONLY).values('novel_id'),
+        # E.g. the PROTECT check of deleting a character
+        'relationships_to_character': Relationship.objects.filter(character2=character).order_by().values('character1_id'),
+    }
+
+
+def explain(queryset):
+    if connection.vendor != 'postgresql':
+        return queryset.explain()
+    # The planner prefers a sequential scan of a small table even with an index, so only let it fall back to one
+    # when no index would do.
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute('SET LOCAL enable_seqscan = off')
+        return queryset.explain()
+
+
+def get_sequential_scans(plan, vendor):
+    """The tables the plan reads all of."""
+    if vendor == 'postgresql':
+        return re.findall(r'Seq Scan on (\w+)', plan)
+    return [match.group(1) for match in SQLITE_SCAN.finditer(plan) if 'INDEX' not in match.group(2)]
+
+
+def check_query_plans(objects):
+    """Maps the name of each hot query to the tables it scans sequentially, or an empty list if it only uses
+    indexes."""
+    return {name: get_sequential_scans(explain(queryset), connection.vendor)
+            for name, queryset in get_hot_queries(objects).items()}
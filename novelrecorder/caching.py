@@ -0,0 +1,267 @@
+import os
+import pickle
+import sqlite3
+import threading
+import time
+
+from django.core.cache import cache as default_cache
+from django.core.cache.backends.base import BaseCache, DEFAULT_TIMEOUT
+
+# A cache shared by the processes on a host (e.g. the gunicorn workers), so they warm it once and a write invalidating
+# an entry reaches all of them - without a cache server. Use it as
+#     CACHES = {'default': {'BACKEND': 'novelrecorder.caching.SQLiteCache', 'LOCATION': '/path/to/cache.sqlite3',
+#                           'OPTIONS': {'MAX_BYTES': 64 * 1024 * 1024}}}
+# (settings.py does with NOVELRECORDER_CACHE_PATH). The entries are rows of an SQLite file in WAL mode, so the reads
+# don't wait for the writes, and read through a memory map of it. Each thread of each process has its own connection.
+#
+# The entries take at most MAX_BYTES (of key and pickled value): a write past it evicts the expired entries, then the
+# least recently used ones down to CULL_RATIO of it. A read records when it used an entry - at most once per
+# ACCESS_RESOLUTION seconds, so reading a hot entry doesn't write each time. Integers are stored as they are, which is
+# what makes incr() one UPDATE, atomic across the processes.
+#
+# Below it, namespaces: keys whose version is in the cache too, so bumping it invalidates all of them at once (the
+# entries of the old version are left to expire or be evicted) - with any cache backend.
+
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+DEFAULT_CULL_RATIO = 0.9
+DEFAULT_ACCESS_RESOLUTION = 1.0  # In seconds
+DEFAULT_BUSY_TIMEOUT = 5.0  # In seconds, how long a write waits for another one
+DEFAULT_MMAP_BYTES = 256 * 1024 * 1024
+MAX_VARIABLES = 900  # Keys per IN (), below SQLite's limit of query parameters
+
+SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS cache_entry (key TEXT PRIMARY KEY, value BLOB NOT NULL, expires REAL, '
+    'size INTEGER NOT NULL, accessed REAL NOT NULL)',
+    'CREATE INDEX IF NOT EXISTS cache_entry_accessed ON cache_entry (accessed)',
+    # The total size of the entries, kept by the triggers whichever statement changes them
+    'CREATE TABLE IF NOT EXISTS cache_size (id INTEGER PRIMARY KEY CHECK (id = 0), bytes INTEGER NOT NULL)',
+    'INSERT OR IGNORE INTO cache_size (id, bytes) VALUES (0, 0)',
+    'CREATE TRIGGER IF NOT EXISTS cache_entry_insert AFTER INSERT ON cache_entry '
+    'BEGIN UPDATE cache_size SET bytes = bytes + NEW.size; END',
+    'CREATE TRIGGER IF NOT EXISTS cache_entry_update AFTER UPDATE OF size ON cache_entry '
+    'BEGIN UPDATE cache_size SET bytes = bytes + NEW.size - OLD.size; END',
+    'CREATE TRIGGER IF NOT EXISTS cache_entry_delete AFTER DELETE ON cache_entry '
+    'BEGIN UPDATE cache_size SET bytes = bytes - OLD.size; END',
+]
+
+# Writes the entry, over one of the key (unless it's live and only_expired)
+UPSERT = 'INSERT INTO cache_entry (key, value, expires, size, accessed) VALUES (?, ?, ?, ?, ?) ' \
+         'ON CONFLICT (key) DO UPDATE SET value = excluded.value, expires = excluded.expires, size = excluded.size, ' \
+         'accessed = excluded.accessed'
+UPSERT_EXPIRED = UPSERT + ' WHERE cache_entry.expires IS NOT NULL AND cache_entry.expires <= ?'
+# The least recently used entries making up at least ? bytes
+LEAST_RECENTLY_USED = 'SELECT key FROM (SELECT key, size, SUM(size) OVER (ORDER BY accessed, key ROWS UNBOUNDED ' \
+                      'PRECEDING) AS total FROM cache_entry) WHERE total - size < ?'
+
+
+def encode(value):
+    if type(value) is int:  # Not bool
+        return value, 8
+    data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+    return data, len(data)
+
+
+def decode(stored):
+    return stored if isinstance(stored, int) else pickle.loads(stored)
+
+
+def is_live(expires, now):
+    return expires is None or expires > now
+
+
+class SQLiteCache(BaseCache):
+    def __init__(self, location, params):
+        super().__init__(params)
+        options = params.get('OPTIONS', {})
+        self.path = location
+        self.max_bytes = options.get('MAX_BYTES', DEFAULT_MAX_BYTES)
+        self.cull_ratio = options.get('CULL_RATIO', DEFAULT_CULL_RATIO)
+        self.access_resolution = options.get('ACCESS_RESOLUTION', DEFAULT_ACCESS_RESOLUTION)
+        self.busy_timeout = options.get('BUSY_TIMEOUT', DEFAULT_BUSY_TIMEOUT)
+        self.mmap_bytes = options.get('MMAP_BYTES', DEFAULT_MMAP_BYTES)
+        self._local = threading.local()
+
+    # The connection of the thread, a new one in a process forked since (e.g. a gunicorn worker).
+    def get_connection(self):
+        local = self._local
+        if getattr(local, 'pid', None) != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=self.busy_timeout, isolation_level=None)
+            connection.execute('PRAGMA journal_mode = WAL')
+            connection.execute('PRAGMA synchronous = NORMAL')  # A crash can lose the last writes, which a cache can
+            connection.execute('PRAGMA mmap_size = %d' % self.mmap_bytes)
+            with connection:
+                for statement in SCHEMA:
+                    connection.execute(statement)
+            local.connection, local.pid = connection, os.getpid()
+        return local.connection
+
+    # A write transaction: BEGIN IMMEDIATE takes the write lock straight away, so what's read in it stays as read.
+    def write(self, function):
+        connection = self.get_connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            result = function(connection)
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+        return result
+
+    def get_expires(self, timeout):
+        return self.get_backend_timeout(timeout)  # An absolute time.time(), or None for never
+
+    def get(self, key, default=None, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        values = self.read([key])
+        return values.get(key, default)
+
+    def get_many(self, keys, version=None):
+        keys_by_key = {}
+        for key in keys:
+            made = self.make_key(key, version=version)
+            self.validate_key(made)
+            keys_by_key[made] = key
+        return {keys_by_key[key]: value for key, value in self.read(list(keys_by_key)).items()}
+
+    # key -> value of the live entries of the keys (made), recording the use of those not used for a while.
+    def read(self, keys):
+        connection = self.get_connection()
+        now = time.time()
+        values, used = {}, []
+        for start in range(0, len(keys), MAX_VARIABLES):
+            chunk = keys[start:start + MAX_VARIABLES]
+            for key, stored, expires, accessed in connection.execute(
+                    'SELECT key, value, expires, accessed FROM cache_entry WHERE key IN (%s)' % ', '.join('?' * len(chunk)),
+                    chunk):
+                if not is_live(expires, now):
+                    continue
+                values[key] = decode(stored)
+                if now - accessed >= self.access_resolution:
+                    used.append(key)
+        for start in range(0, len(used), MAX_VARIABLES):
+            chunk = used[start:start + MAX_VARIABLES]
+            connection.execute('UPDATE cache_entry SET accessed = ? WHERE key IN (%s)' % ', '.join('?' * len(chunk)),
+                               [now] + chunk)
+        return values
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        self.set_many({key: value}, timeout, version)
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        now, expires = time.time(), self.get_expires(timeout)
+        rows = []
+        for key, value in data.items():
+            key = self.make_key(key, version=version)
+            self.validate_key(key)
+            stored, size = encode(value)
+            rows.append((key, stored, expires, len(key) + size, now))
+
+        def write_rows(connection):
+            if is_live(expires, now):
+                connection.executemany(UPSERT, rows)
+                self.cull(connection, now)
+            else:  # A timeout of 0 or less
+                connection.executemany('DELETE FROM cache_entry WHERE key = ?', [row[:1] for row in rows])
+        self.write(write_rows)
+        return []
+
+    # Whether it's written: not if the key has a live entry.
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        now, expires = time.time(), self.get_expires(timeout)
+        stored, size = encode(value)
+
+        def add_row(connection):
+            added = connection.execute(UPSERT_EXPIRED, (key, stored, expires, len(key) + size, now, now)).rowcount
+            if added:
+                self.cull(connection, now)
+            return bool(added)
+        return self.write(add_row)
+
+    # Evicts the expired entries, then the least recently used ones, if they take more than max_bytes.
+    def cull(self, connection, now):
+        if connection.execute('SELECT bytes FROM cache_size').fetchone()[0] <= self.max_bytes:
+            return
+        connection.execute('DELETE FROM cache_entry WHERE expires <= ?', (now,))
+        excess = connection.execute('SELECT bytes FROM cache_size').fetchone()[0] - int(self.max_bytes * self.cull_ratio)
+        if excess > 0:
+            connection.execute('DELETE FROM cache_entry WHERE key IN (%s)' % LEAST_RECENTLY_USED, (excess,))
+
+    def incr(self, key, delta=1, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+
+        def add_delta(connection):
+            if not connection.execute("UPDATE cache_entry SET value = value + ? WHERE key = ? AND typeof(value) = "
+                                      "'integer' AND (expires IS NULL OR expires > ?)",
+                                      (delta, key, time.time())).rowcount:
+                raise ValueError("Key '%s' not found, or its value isn't an integer." % key)
+            return connection.execute('SELECT value FROM cache_entry WHERE key = ?', (key,)).fetchone()[0]
+        return self.write(add_delta)
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        now = time.time()
+        return bool(self.get_connection().execute(
+            'UPDATE cache_entry SET expires = ?, accessed = ? WHERE key = ? AND (expires IS NULL OR expires > ?)',
+            (self.get_expires(timeout), now, key, now)).rowcount)
+
+    def has_key(self, key, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        return self.get_connection().execute(
+            'SELECT 1 FROM cache_entry WHERE key = ? AND (expires IS NULL OR expires > ?)', (key, time.time())
+        ).fetchone() is not None
+
+    def delete(self, key, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        return bool(self.get_connection().execute('DELETE FROM cache_entry WHERE key = ?', (key,)).rowcount)
+
+    def delete_many(self, keys, version=None):
+        keys = [self.make_key(key, version=version) for key in keys]
+        for key in keys:
+            self.validate_key(key)
+        self.write(lambda connection: connection.executemany('DELETE FROM cache_entry WHERE key = ?',
+                                                             [(key,) for key in keys]))
+
+    def clear(self):
+        self.get_connection().execute('DELETE FROM cache_entry')
+
+    # The connections are kept open between the requests (Django calls this after each).
+    def close(self, **kwargs):
+        pass
+
+
+# Namespaces
+# The versions start from the time they're created at, so a namespace whose version has been evicted never gets one
+# it had before (which would bring the entries of that version back).
+
+def get_namespace_version_key(namespace):
+    return 'novelrecorder_namespace:%s' % namespace
+
+
+def get_namespace_version(namespace, cache=default_cache):
+    key = get_namespace_version_key(namespace)
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, int(time.time() * 1000), None)
+        version = cache.get(key)
+    return version
+
+
+# The key in the namespace, with its version, e.g. get_namespaced_key('novel_permissions:1', 'user:2').
+def get_namespaced_key(namespace, key, cache=default_cache):
+    return '%s:%s:%s' % (namespace, get_namespace_version(namespace, cache), key)
+
+
+# Invalidates all the keys of the namespace.
+def invalidate_namespace(namespace, cache=default_cache):
+    key = get_namespace_version_key(namespace)
+    try:
+        cache.incr(key)
+    except ValueError:  # Evicted, or never used
+        cache.add(key, int(time.time() * 1000), None)
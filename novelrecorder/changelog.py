@@ -0,0 +1,302 @@
+import asyncio
+import json
+import threading
+from contextlib import contextmanager, nullcontext
+
+from django.db import router, transaction
+from django.db.models import F, Q
+from django.db.models.signals import post_save, pre_delete
+from django.dispatch import receiver
+
+from novelrecorder import sharding
+from novelrecorder.constants import CHANGE_LOG_KEEP
+from novelrecorder.models import Novel, Character, Relationship, Description, DescriptionBlob, \
+    NovelUserPermissionModel, NovelChange, NovelSnapshot
+from novelrecorder.yd_exceptions import ShardMovedException
+
+# The change log of each novel: every create/update/delete of its characters, relationships, descriptions and
+# permissions becomes a NovelChange numbered by the novel's change_seq, so a client can ask for the changes since
+# the last seq it has seen rather than refetch the novel. compact() deletes the old changes, recording where in a
+# NovelSnapshot: a client further behind syncs from the snapshot pages instead (get_snapshot_page), the novel's objects
+# as they are read in pages, then from the seq of the first page - the changes made while it reads them have the data
+# of their objects, so applying them after the pages ends up at the same state.
+#
+# The changes are recorded by signals. Within recording_changes() - which the views wrap their writes in - they
+# are kept until the end of the block, where the changes of one object are merged (a description is saved three
+# times when created) and written with one seq allocation per novel, in the transaction of the writes.
+
+ACTION_CREATE = 'create'
+ACTION_UPDATE = 'update'
+ACTION_DELETE = 'delete'
+
+# object_type -> (model class, fields in the data)
+OBJECT_TYPES = {
+    'character': (Character, ['id', 'novel', 'name']),
+    'relationship': (Relationship, ['id', 'character1', 'character2']),
+    'description': (Description, ['id', 'character', 'relationship', 'author', 'title', 'content', 'sort_order',
+                                  'is_primary', 'time_created', 'time_modified']),
+    'permission': (NovelUserPermissionModel, ['id', 'novel', 'user', 'permission']),
+}
+OBJECT_TYPE_OF_MODEL = {model_class: object_type for object_type, (model_class, fields) in OBJECT_TYPES.items()}
+
+_local = threading.local()
+
+
+# Wakes the event streams (novelrecorder.events) of this process when changes of their novel are committed.
+# Streams in other processes find them by polling the change log instead.
+class ChangeNotifier(object):
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.latest_seqs = {}  # novel id -> the latest seq committed in this process
+        self.async_waiters = {}  # novel id -> {(event loop, asyncio.Event)}, for the streams served by ASGI
+
+    def notify(self, novel_id, seq):
+        with self.condition:
+            self.latest_seqs[novel_id] = max(seq, self.latest_seqs.get(novel_id, 0))
+            self.condition.notify_all()
+            for loop, event in self.async_waiters.get(novel_id, ()):
+                loop.call_soon_threadsafe(event.set)
+
+    # Returns whether there is a change after seq, waiting up to timeout seconds for one.
+    def wait(self, novel_id, seq, timeout):
+        with self.condition:
+            return self.condition.wait_for(lambda: self.latest_seqs.get(novel_id, 0) > seq, timeout)
+
+    # The same without blocking the event loop.
+    async def async_wait(self, novel_id, seq, timeout):
+        waiter = (asyncio.get_event_loop(), asyncio.Event())
+        with self.condition:
+            if self.latest_seqs.get(novel_id, 0) > seq:
+                return True
+            self.async_waiters.setdefault(novel_id, set()).add(waiter)
+        try:
+            await asyncio.wait_for(waiter[1].wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            with self.condition:
+                waiters = self.async_waiters.get(novel_id)
+                waiters.discard(waiter)
+                if not waiters:
+                    del self.async_waiters[novel_id]
+
+
+notifier = ChangeNotifier()
+
+
+# The JSON of an object, with the related objects by id like the API. Description.content is a property (of its
+# blob) rather than a field, which snapshots give the hash of instead - see get_snapshot_page.
+def serialize_object(instance, with_content=True):
+    data = {}
+    for name in OBJECT_TYPES[OBJECT_TYPE_OF_MODEL[instance.__class__]][1]:
+        if name == 'content' and not with_content:
+            data['blob'] = instance.blob_id
+            continue
+        elif name == 'content':
+            value = instance.content
+        else:
+            value = getattr(instance, instance._meta.get_field(name).attname)
+        data[name] = value.isoformat() if hasattr(value, 'isoformat') else value
+    return data
+
+
+def get_novel_id(instance):
+    return instance.getNovelId()
+
+
+class PendingChange(object):
+    def __init__(self, novel_id, instance, action):
+        self.novel_id = novel_id
+        self.instance = instance
+        self.object_type = OBJECT_TYPE_OF_MODEL[instance.__class__]
+        self.object_id = instance.pk
+        self.action = action
+
+    # Merges a later change of the same object into this one. Returns False if the two cancel out.
+    def merge(self, action, instance):
+        self.instance = instance
+        if action == ACTION_CREATE:  # The post_save of a create comes after those of the saves it makes
+            self.action = ACTION_CREATE
+        elif action == ACTION_DELETE:
+            if self.action == ACTION_CREATE:
+                return False
+            self.action = ACTION_DELETE
+        return True
+
+    def to_model(self, seq):
+        data = None if self.action == ACTION_DELETE else json.dumps(serialize_object(self.instance))
+        return NovelChange(novel_id=self.novel_id, seq=seq, object_type=self.object_type, object_id=self.object_id,
+                           action=self.action, data=data)
+
+
+# novel_id can be given when every change in the block is of that novel, which saves looking it up.
+# The transaction is also one of the active shard (novelrecorder.sharding), which the writes of the block go to.
+@contextmanager
+def recording_changes(novel_id=None):
+    if getattr(_local, 'pending', None) is not None:  # Nested: the outermost block writes them
+        yield
+        return
+    shard = sharding.get_active_shard()
+    with transaction.atomic(), \
+            transaction.atomic(using=shard) if shard not in (None, sharding.PRIMARY) else nullcontext():
+        _local.pending = {}
+        _local.novel_id = novel_id
+        try:
+            yield
+            pending, _local.pending = _local.pending, None
+            write_changes(pending.values())
+        finally:
+            _local.pending = None
+            _local.novel_id = None
+
+
+def record(instance, action, novel_id=None):
+    if novel_id is None:
+        novel_id = getattr(_local, 'novel_id', None) or get_novel_id(instance)
+    pending = getattr(_local, 'pending', None)
+    if pending is None:
+        write_changes([PendingChange(novel_id, instance, action)])
+        return
+    key = (instance.__class__, instance.pk)
+    if key not in pending:
+        pending[key] = PendingChange(novel_id, instance, action)
+    elif not pending[key].merge(action, instance):
+        del pending[key]
+
+
+# The delete changes of the objects of the model with these ids, deleted without the signals (see
+# novelrecorder.deletion) - written straight away.
+def write_deletes(novel_id, model_class, ids, using):
+    changes = []
+    for id in ids:
+        instance = model_class(pk=id)
+        instance._state.db = using
+        changes.append(PendingChange(novel_id, instance, ACTION_DELETE))
+    write_changes(changes)
+
+
+# One UPDATE of change_seq per novel allocates the seqs of its changes (and serialises the writers of a novel).
+# With shards, it also checks the changes were written to the shard the novel is still on - see sharding.move_novel.
+def write_changes(changes):
+    by_novel = {}
+    for change in changes:
+        by_novel.setdefault(change.novel_id, []).append(change)
+    rows = []
+    novels = Novel.objects.using(router.db_for_write(Novel))  # The seqs just allocated are read back, not a replica's
+    with transaction.atomic():
+        for novel_id, novel_changes in by_novel.items():
+            novel = novels.filter(pk=novel_id)
+            if sharding.is_enabled():
+                novel = novel.filter(shard=novel_changes[0].instance._state.db)
+            if not novel.update(change_seq=F('change_seq') + len(novel_changes)):
+                if sharding.is_enabled() and Novel.objects.filter(pk=novel_id).exists():
+                    sharding.forget_shard(novel_id)
+                    raise ShardMovedException('Novel %s has been moved to another shard, try again.' % novel_id)
+                continue  # The novel is being deleted along with its log
+            last_seq = novels.values_list('change_seq', flat=True).get(pk=novel_id)
+            first_seq = last_seq - len(novel_changes) + 1
+            rows += [change.to_model(first_seq + i) for i, change in enumerate(novel_changes)]
+            transaction.on_commit(lambda novel_id=novel_id, last_seq=last_seq: notifier.notify(novel_id, last_seq))
+        NovelChange.objects.bulk_create(rows)
+
+
+@receiver(post_save, sender=Character, dispatch_uid="record_character_save")
+@receiver(post_save, sender=Relationship, dispatch_uid="record_relationship_save")
+@receiver(post_save, sender=Description, dispatch_uid="record_description_save")
+@receiver(post_save, sender=NovelUserPermissionModel, dispatch_uid="record_permission_save")
+def recordSave(sender, instance, created, raw=False, **kwargs):
+    if not raw:
+        record(instance, ACTION_CREATE if created else ACTION_UPDATE)
+
+
+# Before the delete, as the novel of a cascaded description is only found through rows deleted with it.
+@receiver(pre_delete, sender=Character, dispatch_uid="record_character_delete")
+@receiver(pre_delete, sender=Relationship, dispatch_uid="record_relationship_delete")
+@receiver(pre_delete, sender=Description, dispatch_uid="record_description_delete")
+@receiver(pre_delete, sender=NovelUserPermissionModel, dispatch_uid="record_permission_delete")
+def recordDelete(sender, instance, **kwargs):
+    record(instance, ACTION_DELETE)
+
+
+def serialize_change(change):
+    return {'seq': change.seq, 'type': change.object_type, 'id': change.object_id, 'action': change.action,
+            'data': json.loads(change.data) if change.data is not None else None,
+            'time': change.time_created.isoformat()}
+
+
+# The changes after seq since, at most limit of them, and the since of the next ones - but not the ones of the
+# permissions unless with_permissions (for who manages them, see NovelUserPermission.may_manage_permissions), which
+# still count towards limit so next_since moves past them. If some have been compacted away, there is a snapshot
+# instead, telling the client to sync from the snapshot pages.
+def get_changes_since(novel, since, limit, with_permissions=True):
+    response = {'seq': novel.change_seq, 'snapshot': None, 'has_more': False, 'changes': [], 'next_since': since}
+    snapshot = novel.snapshots.first()
+    if snapshot is not None and since < snapshot.compacted_seq:
+        response['snapshot'] = {'seq': snapshot.seq, 'compacted_seq': snapshot.compacted_seq}
+        return response
+    changes = list(novel.changes.filter(seq__gt=since)[:limit + 1])
+    response['has_more'] = len(changes) > limit
+    changes = changes[:limit]
+    if changes:
+        response['next_since'] = changes[-1].seq
+    response['changes'] = [serialize_change(change) for change in changes
+                           if with_permissions or change.object_type != 'permission']
+    return response
+
+
+# The objects of the type of the novel, by id.
+def get_snapshot_queryset(novel, object_type):
+    shard = sharding.db_for_novel(novel)
+    querysets = {
+        'character': Character.objects.using(shard).filter(novel=novel),
+        'relationship': Relationship.objects.using(shard).filter(character1__novel=novel),
+        'description': Description.objects.using(shard).filter(
+            Q(character__novel=novel) | Q(relationship__character1__novel=novel)),
+        'permission': NovelUserPermissionModel.objects.using(shard).filter(novel=novel),
+    }
+    return querysets[object_type].order_by('id')
+
+
+# A page of at most limit objects of the novel as they are, by type then id, from the cursor ('<type>:<id>', the
+# 'next' of the previous page - None for the first) - the permissions only if with_permissions. Raises ValueError for
+# a cursor it didn't give. The descriptions have the hash of their blob rather than their content, which is in 'blob'
+# by hash - once per page however many descriptions have it.
+def get_snapshot_page(novel, cursor, limit, with_permissions=True):
+    object_types = [object_type for object_type in OBJECT_TYPES if with_permissions or object_type != 'permission']
+    object_type, after = (cursor or '%s:0' % object_types[0]).split(':')
+    after = int(after)
+    if object_type not in object_types or after < 0:
+        raise ValueError('Unknown cursor %r.' % cursor)
+    response = {'seq': novel.change_seq, 'data': {}, 'next': None}
+    count = 0
+    for object_type in object_types[object_types.index(object_type):]:
+        if count == limit:
+            response['next'] = '%s:%s' % (object_type, after)
+            break
+        objects = list(get_snapshot_queryset(novel, object_type).filter(id__gt=after)[:limit - count + 1])
+        if len(objects) > limit - count:
+            objects = objects[:limit - count]
+            response['next'] = '%s:%s' % (object_type, objects[-1].pk)
+        response['data'][object_type] = [serialize_object(instance, with_content=False) for instance in objects]
+        count += len(objects)
+        if response['next']:
+            break
+        after = 0
+    hashes = {description['blob'] for description in response['data'].get('description', [])} - {None}
+    response['data']['blob'] = {blob.hash: blob.content for blob in
+                                DescriptionBlob.objects.using(sharding.db_for_novel(novel)).filter(hash__in=hashes)}
+    return response
+
+
+# Deletes the changes of the novel but the latest keep, if there are more than twice as many, recording the seq up to
+# which they are in a snapshot. Returns the number of changes deleted.
+def compact(novel, keep=CHANGE_LOG_KEEP):
+    with transaction.atomic():
+        novel = Novel.objects.select_for_update().get(pk=novel.pk)  # No change can be written meanwhile
+        compacted_seq = novel.change_seq - keep
+        if novel.changes.filter(seq__lte=compacted_seq).count() <= keep:
+            return 0
+        NovelSnapshot.objects.create(novel=novel, seq=novel.change_seq, compacted_seq=compacted_seq)
+        novel.snapshots.filter(seq__lt=novel.change_seq).delete()
+        return novel.changes.filter(seq__lte=compacted_seq).delete()[0]
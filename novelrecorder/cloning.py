@@ -0,0 +1,203 @@
+from contextlib import contextmanager, nullcontext
+
+from django.db import connections, router, transaction
+from django.db.models import Max, Q
+from django.utils import timezone
+
+from novelrecorder import caching, sharding
+from novelrecorder.constants import NUP_COEDITOR
+from novelrecorder.models import Novel, Character, Relationship, Description, DescriptionBlob, DescriptionRevision, \
+    NovelUserPermissionModel, NovelSnapshot
+from novelrecorder.permissions import NovelUserPermission
+
+# A copy of a novel as a new novel of the user - to try another plot, say - with its characters, relationships,
+# descriptions and permissions (if the user could grant them), all in one transaction. The rows are copied by the
+# database, an INSERT ... SELECT per kind of row rather than read and written back one by one: the ids of the copies
+# are put in a temporary table by the ids of the originals first, so the copies of the characters and relationships
+# referred to are known to the statements copying what refers to them. Nothing is loaded into memory however large
+# the novel, and no signal of saving each object is sent.
+#
+# The copy is on the shard of the original (both sides of the statements on one database). The descriptions refer to
+# the same blobs, so their text isn't copied either. The new novel's change log starts with a snapshot (as if
+# compacted, so clients sync from the snapshot pages), and each description with a first revision.
+
+
+# The name of the copy, with a number if the user has a novel of that name already.
+def get_clone_name(novel, user):
+    base = '%s (copy)' % novel.name
+    taken = set(Novel.objects.filter(author=user, name__startswith=base).values_list('name', flat=True))
+    name, number = base, 1
+    while name in taken:
+        number += 1
+        name = '%s (copy %s)' % (novel.name, number)
+    return name
+
+
+# The SQL (and its parameters) of new ids for count rows of the model, in the order of order_by, which no other write
+# takes (to be called in the transaction of the writes). On PostgreSQL the next value of the table's sequence for each
+# row, as its inserts take - the inserts going on meanwhile take some of them, so the ids aren't in a row, but they
+# are in the order. Else numbered from the first of a block: of the allocator with shards, or after the last id
+# (SQLite, whose transaction holds the write lock since the novel was saved, past the ids of deleted rows too).
+def get_new_ids(model_class, count, using, order_by):
+    connection = connections[using]
+    table = model_class._meta.db_table
+    if sharding.is_enabled():
+        return get_row_number(sharding.id_allocator.allocate(model_class, count)[0] if count else 1, order_by), []
+    if connection.vendor == 'postgresql':
+        return "nextval(pg_get_serial_sequence(%s, 'id'))", [table]
+    last = model_class.objects.using(using).aggregate(max_id=Max('id'))['max_id'] or 0
+    if connection.vendor == 'sqlite':
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT seq FROM sqlite_sequence WHERE name = %s', [table])
+            row = cursor.fetchone()
+            last = max(last, row[0] if row else 0)
+    return get_row_number(last + 1, order_by), []
+
+
+# Inserts the rows selected by source (SQL with the rows as "source") into the model's table. values has the SQL
+# (and its parameters) of the columns not copied as they are from the source rows. Returns how many.
+def insert_select(using, model_class, source, params, values):
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    columns = [field.column for field in model_class._meta.concrete_fields]
+    select, select_params = [], []
+    for column in columns:
+        sql, column_params = values.get(column, ('source.%s' % qn(column), []))
+        select.append(sql)
+        select_params += column_params
+    with connection.cursor() as cursor:
+        cursor.execute('INSERT INTO %s (%s) SELECT %s FROM %s' % (
+            qn(model_class._meta.db_table), ', '.join(qn(column) for column in columns), ', '.join(select), source),
+            select_params + params)
+        return cursor.rowcount
+
+
+# The tables of the ids of the copies by the ids of the originals, for the statements copying them and what refers to
+# them to join.
+CHARACTER_IDS = 'novelrecorder_clone_character_ids'
+RELATIONSHIP_IDS = 'novelrecorder_clone_relationship_ids'
+DESCRIPTION_IDS = 'novelrecorder_clone_description_ids'
+REVISION_IDS = 'novelrecorder_clone_revision_ids'
+
+
+# SQL numbering the rows of source in the order of order_by from first, e.g. to give them the reserved ids.
+def get_row_number(first, order_by):
+    return '%d + ROW_NUMBER() OVER (ORDER BY %s) - 1' % (first, order_by)
+
+
+# A temporary table (of the connection) of new ids of the model (see get_new_ids) by the ids of the count rows
+# selected by source, in the order of order_by. Indexed by the original ids, so a join with it is a lookup per row.
+@contextmanager
+def id_table(using, name, model_class, count, source, params, order_by='source.id'):
+    qn = connections[using].ops.quote_name
+    new_id, new_id_params = get_new_ids(model_class, count, using, order_by)
+    with connections[using].cursor() as cursor:
+        cursor.execute('CREATE TEMPORARY TABLE %s (old_id integer PRIMARY KEY, new_id integer NOT NULL)' % qn(name))
+        try:
+            cursor.execute('INSERT INTO %s (old_id, new_id) SELECT source.id, %s FROM %s ORDER BY %s' % (
+                qn(name), new_id, source, order_by), new_id_params + params)
+            yield qn(name)
+        finally:
+            cursor.execute('DROP TABLE %s' % qn(name))
+
+
+# Returns the new novel.
+def clone_novel(novel, user, name=None, is_public=None):
+    clone = Novel(author=user, name=name or get_clone_name(novel, user),
+                  is_public=novel.is_public if is_public is None else is_public, shard=novel.shard)
+    clone.keep_shard = True
+    using = sharding.db_for_novel(novel) or router.db_for_write(Description)
+    with transaction.atomic():
+        clone.save()
+        with sharding.using_shard(sharding.db_for_novel(clone)), \
+                transaction.atomic(using=using) if using != sharding.PRIMARY else nullcontext():
+            clone_rows(novel, clone, using)
+            clone_permissions(novel, clone, user, using)
+        # The copies are in the snapshot pages, so the changes of a client syncing from 0 start after them
+        Novel.objects.filter(pk=clone.pk).update(change_seq=1)
+        clone.change_seq = 1
+        NovelSnapshot.objects.create(novel=clone, seq=1, compacted_seq=1)
+    return clone
+
+
+def clone_rows(novel, clone, using):
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    characters = Character.objects.using(using).filter(novel=novel)
+    relationships = Relationship.objects.using(using).filter(character1__novel=novel)
+    descriptions = Description.objects.using(using)
+    counts = {
+        'character': characters.count(),
+        'relationship': relationships.count(),
+        'character_description': descriptions.filter(character__novel=novel).count(),
+        'relationship_description': descriptions.filter(relationship__character1__novel=novel).count(),
+    }
+    with id_table(using, CHARACTER_IDS, Character, counts['character'], '%s source WHERE source.novel_id = %%s' % (
+            qn(Character._meta.db_table)), [novel.pk]) as character_ids, \
+            id_table(using, RELATIONSHIP_IDS, Relationship, counts['relationship'], '%s source JOIN %s c ON '
+                     'c.old_id = source.character1_id' % (qn(Relationship._meta.db_table), character_ids),
+                     []) as relationship_ids:
+        insert_select(using, Character, '%s source JOIN %s ids ON ids.old_id = source.id' % (
+            qn(Character._meta.db_table), character_ids), [], {
+            'id': ('ids.new_id', []),
+            'novel_id': ('%s', [clone.pk]),
+        })
+        insert_select(using, Relationship, '%s source JOIN %s ids ON ids.old_id = source.id '
+                                           'JOIN %s c1 ON c1.old_id = source.character1_id '
+                                           'JOIN %s c2 ON c2.old_id = source.character2_id' % (
+            qn(Relationship._meta.db_table), relationship_ids, character_ids, character_ids), [], {
+            'id': ('ids.new_id', []),
+            'character1_id': ('c1.new_id', []),
+            'character2_id': ('c2.new_id', []),
+        })
+        clone_descriptions(using, clone, counts, character_ids, relationship_ids)
+
+
+# In the order of their sort_order, which the copies get from their new ids (keeping the order of the ones of a
+# character or a relationship).
+def clone_descriptions(using, clone, counts, character_ids, relationship_ids):
+    qn = connections[using].ops.quote_name
+    now = connections[using].ops.adapt_datetimefield_value(timezone.now())
+    table = qn(Description._meta.db_table)
+    for owner, owner_ids in [('character', character_ids), ('relationship', relationship_ids)]:
+        count = counts[owner + '_description']
+        if not count:
+            continue
+        source = '%s source JOIN %s owner ON owner.old_id = source.%s_id' % (table, owner_ids, owner)
+        with id_table(using, DESCRIPTION_IDS, Description, count, source, [],
+                      'source.sort_order, source.id') as description_ids:
+            insert_select(using, Description, '%s JOIN %s ids ON ids.old_id = source.id' % (source, description_ids),
+                          [], {
+                'id': ('ids.new_id', []),
+                'character_id': ('owner.new_id' if owner == 'character' else 'NULL', []),
+                'relationship_id': ('owner.new_id' if owner == 'relationship' else 'NULL', []),
+                'sort_order': ('ids.new_id', []),
+                'time_created': ('%s', [now]),
+                'time_modified': ('%s', [now]),
+            })
+            # The first revisions, snapshots of the copies
+            with id_table(using, REVISION_IDS, DescriptionRevision, count, '%s source JOIN %s d ON d.new_id = '
+                          'source.id' % (table, description_ids), []) as revision_ids:
+                insert_select(using, DescriptionRevision, '%s source JOIN %s ids ON ids.old_id = source.id' % (
+                    table, revision_ids), [], {
+                    'id': ('ids.new_id', []),
+                    'description_id': ('source.id', []),
+                    'number': ('1', []),
+                    'is_snapshot': ('%s', [True]),
+                    'delta': ('NULL', []),
+                    'time_created': ('%s', [now]),
+                })
+    DescriptionBlob.objects.retain_for(Description.objects.using(using).filter(
+        Q(character__novel=clone) | Q(relationship__character1__novel=clone)), using)
+
+
+# The grants of the original, if the user could give them (its author or a co-editor).
+def clone_permissions(novel, clone, user, using):
+    if novel.author_id != user.pk and NovelUserPermission().get_permission_group(user, novel) != NUP_COEDITOR:
+        return
+    copies = [NovelUserPermissionModel(novel=clone, user_id=permission.user_id, permission=permission.permission)
+              for permission in NovelUserPermissionModel.objects.using(using).filter(novel=novel).exclude(user=user)]
+    sharding.assign_ids(copies)
+    NovelUserPermissionModel.objects.using(using).bulk_create(copies)
+    for copy in copies:  # No signal is sent
+        caching.invalidate_namespace(NovelUserPermissionModel.get_user_namespace(copy.user_id))
@@ -0,0 +1,137 @@
+import base64
+import codecs
+import zlib
+
+from django.conf import settings
+from django.db import models
+from django.db.models.query_utils import DeferredAttribute
+
+# Compressed storage of long texts (DescriptionBlob.content): a value of at least THRESHOLD bytes is stored zlib
+# compressed, if that makes it shorter, as MARKER + the codec + the base64 of the compressed bytes. Anything else is
+# stored as it is, so the column stays a text column and the rows written before are still read as they are -
+# manage.py compress_descriptions converts them.
+#
+# A compressed value is only decompressed when the attribute is first read, and is saved back without being
+# recompressed if it hasn't been.
+
+MARKER = '\x1b'  # Escape, which no text a user writes starts with (one that does is stored with CODEC_RAW)
+CODEC_RAW = 'r'
+CODEC_ZLIB = 'z'
+
+DEFAULT_COMPRESSION_SETTINGS = {
+    'THRESHOLD': 1024,  # In bytes of UTF-8, below which compressing isn't worth it
+    'LEVEL': 6,
+    'CHUNK_SIZE': 64 * 1024,  # Characters of base64 decompressed at a time by iter_decompressed
+}
+
+
+def get_compression_setting(key):
+    return getattr(settings, 'CONTENT_COMPRESSION', {}).get(key, DEFAULT_COMPRESSION_SETTINGS[key])
+
+
+def is_compressed(stored):
+    return isinstance(stored, str) and stored[:2] == MARKER + CODEC_ZLIB
+
+
+def compress(text):
+    if text is None:
+        return None
+    data = text.encode('utf-8')
+    if len(data) >= get_compression_setting('THRESHOLD'):
+        stored = MARKER + CODEC_ZLIB + base64.b64encode(zlib.compress(data, get_compression_setting('LEVEL'))).decode('ascii')
+        if len(stored) < len(text):
+            return stored
+    return store_uncompressed(text)
+
+
+def store_uncompressed(text):
+    if text is None:
+        return None
+    return MARKER + CODEC_RAW + text if text.startswith(MARKER) else text
+
+
+def decompress(stored):
+    if stored is None or not stored.startswith(MARKER):
+        return stored
+    codec, payload = stored[1:2], stored[2:]
+    if codec == CODEC_RAW:
+        return payload
+    if codec == CODEC_ZLIB:
+        return zlib.decompress(base64.b64decode(payload)).decode('utf-8')
+    raise ValueError('Unknown compression codec %r.' % codec)
+
+
+# The text of a stored value piece by piece, without holding all of it at once - for writing out long texts.
+def iter_decompressed(stored, chunk_size=None):
+    chunk_size = chunk_size or get_compression_setting('CHUNK_SIZE')
+    if not is_compressed(stored):
+        text = decompress(stored) or ''
+        for start in range(0, len(text), chunk_size):
+            yield text[start:start + chunk_size]
+        return
+    chunk_size -= chunk_size % 4  # Whole base64 quanta
+    decompressor = zlib.decompressobj()
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    for start in range(2, len(stored), chunk_size):
+        text = decoder.decode(decompressor.decompress(base64.b64decode(stored[start:start + chunk_size])))
+        if text:
+            yield text
+    text = decoder.decode(decompressor.flush(), final=True)
+    if text:
+        yield text
+
+
+# A value as read from the database, before it's decompressed (also what values() and values_list() give).
+class CompressedText(object):
+    def __init__(self, stored):
+        self.stored = stored
+
+    def __str__(self):
+        return decompress(self.stored)
+
+    def chunks(self, chunk_size=None):
+        return iter_decompressed(self.stored, chunk_size)
+
+
+# Whether the value of the field of the instance is still as it was read from the database, not decompressed.
+def is_unread(instance, attname):
+    return isinstance(instance.__dict__.get(attname), CompressedText)
+
+
+# A data descriptor (unlike DeferredAttribute), or the value in the __dict__ of the instance would be read directly.
+class CompressedTextAttribute(DeferredAttribute):
+    def __get__(self, instance, cls=None):
+        value = super().__get__(instance, cls)
+        if isinstance(value, CompressedText):
+            value = instance.__dict__[self.field_name] = str(value)
+        return value
+
+    def __set__(self, instance, value):
+        instance.__dict__[self.field_name] = value
+
+
+class CompressedTextField(models.TextField):
+    def contribute_to_class(self, cls, name, private_only=False):
+        super().contribute_to_class(cls, name, private_only)
+        setattr(cls, self.attname, CompressedTextAttribute(self.attname))
+
+    def from_db_value(self, value, expression, connection):
+        if value is None or not value.startswith(MARKER):
+            return value
+        return CompressedText(value)
+
+    def to_python(self, value):
+        if isinstance(value, CompressedText):
+            return str(value)
+        return super().to_python(value)
+
+    def get_prep_value(self, value):
+        if isinstance(value, CompressedText):
+            return value.stored
+        return compress(super().get_prep_value(value))
+
+    # The value as it is if it hasn't been read, rather than decompressed and compressed again.
+    def pre_save(self, model_instance, add):
+        if is_unread(model_instance, self.attname):
+            return model_instance.__dict__[self.attname]
+        return super().pre_save(model_instance, add)
@@ -4,3 +4,53 @@ NUP_VIEW_ONLY = 1
 NUP_DESCRIPTION_ONLY = 2
 NUP_CONTRIBUTOR = 3 # Not implementing this for now
 NUP_COEDITOR = 4
+
+# Token scopes
+TOKEN_SCOPE_READ = 'read'  # Safe methods
+TOKEN_SCOPE_WRITE = 'write'  # Everything else
+TOKEN_SCOPES = [TOKEN_SCOPE_READ, TOKEN_SCOPE_WRITE]
+
+# Descriptions
+DESCRIPTION_EXCERPT_LENGTH = 200  # Characters of the content shown by the lists, without the ellipsis
+BLOB_RETAIN_ATTEMPTS = 3  # Tries at referring to a blob, each undone by the blob being collected meanwhile
+
+# Description revisions (novelrecorder.revisions)
+DESCRIPTION_REVISION_SNAPSHOT_INTERVAL = 20  # Revisions per snapshot, so at most 19 deltas rebuild one
+DESCRIPTION_REVISION_KEEP = 100  # Latest revisions per description kept by pruning, whatever their age
+DESCRIPTION_REVISION_KEEP_DAYS = 90  # Older revisions beyond those are pruned
+DESCRIPTION_REVISION_PAGE_SIZE = 50
+DESCRIPTION_REVISION_MAX_PAGE_SIZE = 500
+
+# Metrics (novelrecorder.metrics)
+METRICS_GAUGE_CACHE_SECONDS = 60  # How long /metrics keeps the counts of the objects
+
+# Permissions (novelrecorder.permissions)
+PERMISSION_CACHE_SECONDS = 60  # Bounds how long a change takes to reach the processes with another cache
+
+# Batch editing (novelrecorder.batch)
+BATCH_MAX_OPERATIONS = 500
+
+# Deleting characters and novels (novelrecorder.deletion)
+DELETE_CHANGE_BATCH_SIZE = 1000  # Ids of the deleted objects read and written to the change log at a time
+
+# Change log (novelrecorder.changelog)
+CHANGE_LOG_KEEP = 1000  # Changes kept per novel by compaction, older ones are replaced by a snapshot
+CHANGE_LOG_PAGE_SIZE = 100
+CHANGE_LOG_MAX_PAGE_SIZE = 1000
+
+# Sharding (novelrecorder.sharding)
+SHARD_ID_BLOCK_SIZE = 100  # Ids reserved per process at a time, per model
+SHARD_MAP_CACHE_SECONDS = 30  # How long a process keeps the shard of a novel before looking it up again
+SHARD_MOVE_ATTEMPTS = 5  # Copies of a novel tried by rebalancing, each undone by a write to the novel meanwhile
+
+# Background jobs (novelrecorder.jobs)
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_DONE = 'done'
+JOB_FAILED = 'failed'
+JOB_STATUSES = [JOB_QUEUED, JOB_RUNNING, JOB_DONE, JOB_FAILED]
+JOB_MAX_ATTEMPTS = 3  # Runs of a job before it fails for good, each after the one before raised
+JOB_RETRY_DELAY_SECONDS = 30  # Before the second run, doubled for each one after
+JOB_LEASE_SECONDS = 300  # A running job whose worker hasn't reported for this long is run again by another
+JOB_WORKER_CONCURRENCY = 2  # Jobs run at a time by a worker (threads)
+JOB_POLL_SECONDS = 1.0  # How often an idle worker looks for jobs
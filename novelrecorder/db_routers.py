@@ -0,0 +1,65 @@
+import contextvars
+import random
+import time
+
+from django.conf import settings
+
+# Read replicas: the reads of the safe-method requests to the novelrecorder views go to one of
+# settings.DATABASE_REPLICAS, everything else to the primary ('default').
+#
+# Read-after-write: an unsafe-method request sets a cookie keeping the client's reads on the primary for
+# REPLICA_STICKY_SECONDS, longer than the replicas are expected to lag, so a redirect after a POST shows the change.
+
+PRIMARY = 'default'
+STICKY_COOKIE_NAME = 'novelrecorder_primary_until'
+REPLICA_APP_NAMES = ['novelrecorder', 'novelrecorder_api']
+
+# A context variable rather than a thread local, so query_utils.run_concurrently carries it over to its threads.
+_read_from_replica = contextvars.ContextVar('novelrecorder_read_from_replica', default=False)
+
+
+def get_replicas():
+    return getattr(settings, 'DATABASE_REPLICAS', [])
+
+
+class ReplicaRouter(object):
+    def db_for_read(self, model, **hints):
+        replicas = get_replicas()
+        if replicas and _read_from_replica.get():
+            return random.choice(replicas)
+        return PRIMARY
+
+    def db_for_write(self, model, **hints):
+        return PRIMARY
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True  # The replicas are copies of the primary
+
+
+class ReplicaRoutingMiddleware(object):
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        try:
+            response = self.get_response(request)
+        finally:
+            if hasattr(request, '_novelrecorder_replica_token'):
+                _read_from_replica.reset(request._novelrecorder_replica_token)
+        if request.method not in ('GET', 'HEAD', 'OPTIONS') and get_replicas():
+            sticky_seconds = getattr(settings, 'REPLICA_STICKY_SECONDS', 10)
+            response.set_cookie(STICKY_COOKIE_NAME, str(int(time.time() + sticky_seconds)), max_age=sticky_seconds,
+                                httponly=True)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if request.method in ('GET', 'HEAD', 'OPTIONS') and request.resolver_match.app_name in REPLICA_APP_NAMES \
+                and not self.is_sticky(request):
+            request._novelrecorder_replica_token = _read_from_replica.set(True)
+
+    @staticmethod
+    def is_sticky(request):
+        try:
+            return int(request.COOKIES.get(STICKY_COOKIE_NAME, 0)) > time.time()
+        except ValueError:
+            return False
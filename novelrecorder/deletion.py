@@ -0,0 +1,68 @@
+from contextlib import nullcontext
+
+from django.db import router, transaction
+from django.db.models import Q
+
+from novelrecorder import changelog, sharding
+from novelrecorder.constants import DELETE_CHANGE_BATCH_SIZE
+from novelrecorder.models import Character, Relationship, Description, DescriptionBlob, DescriptionRevision
+
+# Deleting a character with its relationships (which protect it otherwise) and the descriptions of both, or a novel
+# with everything in it. Rather than through Django's collector, which loads every object deleted (to send its
+# signals) and gives up at the first protected one, each kind of row goes with one DELETE, all in one transaction:
+# the revisions first, then the descriptions - the references to their blobs removed with one UPDATE - then the
+# relationships and the characters.
+#
+# The signals aren't sent, so what they do is done here: the delete changes of a character's objects are written to
+# the novel's change log from their ids, DELETE_CHANGE_BATCH_SIZE at a time (a novel's log goes with it). Both
+# return what's deleted like QuerySet.delete(): (total, {model label: count}).
+
+
+# The ids of the rows, DELETE_CHANGE_BATCH_SIZE at a time (keyset).
+def iter_ids(queryset):
+    ids = list(queryset.order_by('pk').values_list('pk', flat=True)[:DELETE_CHANGE_BATCH_SIZE])
+    while ids:
+        yield ids
+        ids = list(queryset.filter(pk__gt=ids[-1]).order_by('pk').values_list('pk', flat=True)[:DELETE_CHANGE_BATCH_SIZE])
+
+
+# Deletes the rows by model in order, with the delete changes of those whose model is logged (if novel_id is given).
+def delete_rows(rows, using, novel_id=None):
+    counts = {}
+    for model_class, queryset in rows:
+        if novel_id is not None and model_class in changelog.OBJECT_TYPE_OF_MODEL:
+            for ids in iter_ids(queryset):
+                changelog.write_deletes(novel_id, model_class, ids, using)
+        if model_class is Description:
+            DescriptionBlob.objects.release_for(queryset, using)
+        counts[model_class._meta.label] = queryset.order_by()._raw_delete(using)
+    return sum(counts.values()), counts
+
+
+def in_transaction(using):
+    return transaction.atomic(using=using) if using != sharding.PRIMARY else nullcontext()
+
+
+def delete_character(character):
+    using = character._state.db or router.db_for_write(Character, instance=character)
+    characters = Character.objects.using(using).filter(pk=character.pk)
+    relationships = Relationship.objects.using(using).filter(Q(character1=character) | Q(character2=character))
+    descriptions = Description.objects.using(using).filter(
+        Q(character=character) | Q(relationship__in=relationships.values('pk')))
+    revisions = DescriptionRevision.objects.using(using).filter(description__in=descriptions.values('pk'))
+    with transaction.atomic(), in_transaction(using):
+        return delete_rows([(DescriptionRevision, revisions), (Description, descriptions),
+                            (Relationship, relationships), (Character, characters)], using, character.novel_id)
+
+
+# The content of the novel on its shard, then the novel (whose change log and snapshots go with it).
+def delete_novel(novel):
+    using = sharding.db_for_novel(novel) or router.db_for_write(Character)
+    rows = [(model_class, model_class.objects.using(using).filter(row_filter(novel.pk)))
+            for model_class, row_filter in reversed(sharding.NOVEL_ROW_FILTERS)]
+    with transaction.atomic(), in_transaction(using):
+        total, counts = delete_rows(rows, using)
+        deleted, novel_counts = novel.delete()
+    for label, count in novel_counts.items():
+        counts[label] = counts.get(label, 0) + count
+    return total + deleted, counts
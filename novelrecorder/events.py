@@ -0,0 +1,58 @@
+import json
+
+from django.conf import settings
+
+from novelrecorder import changelog
+
+# Server-Sent Events streams of the changes of a novel, for the browsers of the co-editors (those who can write to
+# it) to update without reloading. Fed by the change log: the ChangeNotifier wakes the streams of the process where
+# a change is committed, the others poll the log every POLL_INTERVAL. No broker is needed either way.
+#
+# The streams are kept open when served by the ASGI handler (novelrecorder.asgi, if mysite.asgi is served rather than
+# the Procfile's WSGI), where an idle one is only a coroutine, and closed after MAX_DURATION. Through WSGI, where it would hold a thread of the worker, a response
+# only has the events so far, and the browser's EventSource reconnects RETRY later. Either way it reconnects with
+# the Last-Event-ID it got up to, so no change is missed.
+
+DEFAULT_EVENT_STREAM_SETTINGS = {
+    'POLL_INTERVAL': 2,  # In seconds
+    'HEARTBEAT_INTERVAL': 15,  # A comment line keeps proxies from closing an idle stream
+    'MAX_DURATION': 300,
+    'RETRY': 3000,  # The reconnection delay for the browser, in milliseconds
+    'BATCH_SIZE': 100,  # Changes read from the log at a time
+}
+
+
+def get_event_stream_setting(key):
+    return getattr(settings, 'EVENT_STREAM', {}).get(key, DEFAULT_EVENT_STREAM_SETTINGS[key])
+
+
+def format_event(change):
+    return 'id: %s\nevent: %s.%s\ndata: %s\n\n' % (change['seq'], change['type'], change['action'], json.dumps(change))
+
+
+# The events after seq since (not the ones of the permissions unless with_permissions, see
+# changelog.get_changes_since): a 'reset' event alone if the changes since then have been compacted away, telling the
+# client to reload the novel, the events after it following.
+def get_events(novel, since, with_permissions=True):
+    response = changelog.get_changes_since(novel, since, get_event_stream_setting('BATCH_SIZE'), with_permissions)
+    if response['snapshot'] is not None:
+        return ['id: %s\nevent: reset\ndata: {}\n\n' % response['snapshot']['seq']], response['snapshot']['seq'], True
+    return [format_event(change) for change in response['changes']], response['next_since'], response['has_more']
+
+
+# The events so far, without waiting for more (the WSGI responses).
+def stream_events(novel, since, with_permissions=True):
+    yield 'retry: %s\n\n' % get_event_stream_setting('RETRY')
+    has_more = True
+    while has_more:
+        events, since, has_more = get_events(novel, since, with_permissions)
+        for event in events:
+            yield event
+
+
+def get_last_event_id(request):
+    value = request.META.get('HTTP_LAST_EVENT_ID') or request.GET.get('since')
+    try:
+        return max(int(value), 0)
+    except (TypeError, ValueError):
+        return None
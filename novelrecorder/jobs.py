@@ -0,0 +1,221 @@
+import json
+import os
+import socket
+import threading
+import traceback
+import uuid
+from datetime import timedelta
+
+from django.db import close_old_connections, connection, connections, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from novelrecorder import changelog, cloning, deletion, revisions, sharding
+from novelrecorder.constants import JOB_QUEUED, JOB_RUNNING, JOB_DONE, JOB_FAILED, JOB_MAX_ATTEMPTS, \
+    JOB_RETRY_DELAY_SECONDS, JOB_LEASE_SECONDS, JOB_WORKER_CONCURRENCY, JOB_POLL_SECONDS, CHANGE_LOG_KEEP, \
+    DESCRIPTION_REVISION_KEEP, DESCRIPTION_REVISION_KEEP_DAYS
+from novelrecorder.models import Job, Novel, NovelUser, DescriptionBlob
+
+# Background jobs: expensive work (cloning or deleting a large novel, the periodic maintenance) queued as a Job row
+# by enqueue() and run by manage.py runworker, rather than in a request - no broker needed, the queue is a table of
+# the primary database.
+#
+# A worker claims a job by taking a lease on it (locked_by and locked_until): with SELECT ... FOR UPDATE SKIP LOCKED
+# where the database has it (PostgreSQL), so the workers polling at once each get other jobs without waiting; else
+# (SQLite) with an UPDATE per job conditional on it still being claimable, which only one of them can win. A task
+# reports its progress through the function it's given, which renews the lease - a job whose worker stops reporting
+# (or died) is claimed again once the lease runs out. A task that raises is run again JOB_RETRY_DELAY_SECONDS later,
+# twice as long after each run, until it has been run max_attempts times.
+
+TASKS = {}
+
+
+# Registers the function as the task of the name (its own by default). It's called with report(progress, message='')
+# - progress from 0 to 1 - and the keyword arguments of the job, and returns something JSON serializable.
+def task(name=None):
+    def register(function):
+        TASKS[name or function.__name__] = function
+        return function
+    return register
+
+
+# Queues a run of the task with the arguments (a dict), for the user if any.
+def enqueue(name, args=None, user=None, max_attempts=JOB_MAX_ATTEMPTS, run_after=None):
+    if name not in TASKS:
+        raise ValueError('Unknown task %r.' % name)
+    return Job.objects.using(sharding.PRIMARY).create(name=name, user=user, args=json.dumps(args or {}),
+                                                      max_attempts=max_attempts, run_after=run_after or timezone.now())
+
+
+# Queued ones due, and running ones whose worker's lease has run out.
+def get_claimable(now):
+    return Job.objects.using(sharding.PRIMARY).filter(Q(status=JOB_QUEUED, run_after__lte=now) |
+                                                      Q(status=JOB_RUNNING, locked_until__lt=now))
+
+
+# Takes up to limit jobs for the worker, the longest due first. Returns them.
+def claim(worker_id, limit=1):
+    now = timezone.now()
+    lease = {'status': JOB_RUNNING, 'locked_by': worker_id, 'locked_until': now + timedelta(seconds=JOB_LEASE_SECONDS),
+             'attempts': F('attempts') + 1, 'time_started': now}
+    candidates = get_claimable(now).order_by('run_after', 'pk')
+    if connections[sharding.PRIMARY].features.has_select_for_update_skip_locked:
+        with transaction.atomic(using=sharding.PRIMARY):
+            ids = list(candidates.select_for_update(skip_locked=True).values_list('pk', flat=True)[:limit])
+            Job.objects.using(sharding.PRIMARY).filter(pk__in=ids).update(**lease)
+    else:
+        # The UPDATE finding the job claimable still is the one that got it, another worker's finds it leased
+        ids = [pk for pk in candidates.values_list('pk', flat=True)[:limit]
+               if get_claimable(now).filter(pk=pk).update(**lease)]
+    return list(Job.objects.using(sharding.PRIMARY).filter(pk__in=ids, locked_by=worker_id).order_by('run_after', 'pk'))
+
+
+# Raised by the report function of a job that another worker has claimed meanwhile, ending the run.
+class JobLost(Exception):
+    pass
+
+
+# The updates of a job by the worker running it, which don't apply if another has claimed it since.
+def get_leased(job, worker_id):
+    return Job.objects.using(sharding.PRIMARY).filter(pk=job.pk, status=JOB_RUNNING, locked_by=worker_id)
+
+
+def get_reporter(job, worker_id):
+    def report(progress, message=''):
+        if not get_leased(job, worker_id).update(progress=min(max(progress, 0), 1), progress_message=message[:200],
+                                                 locked_until=timezone.now() + timedelta(seconds=JOB_LEASE_SECONDS)):
+            raise JobLost('Job %s has been claimed by another worker.' % job.pk)
+    return report
+
+
+# Runs a claimed job, then marks it done, queues it again or marks it failed. Returns its status.
+def run(job, worker_id):
+    function = TASKS.get(job.name)
+    try:
+        if function is None:
+            raise LookupError('Unknown task %r.' % job.name)
+        result = function(get_reporter(job, worker_id), **json.loads(job.args))
+    except JobLost:
+        return JOB_RUNNING
+    except Exception:
+        now = timezone.now()
+        if job.attempts < job.max_attempts:
+            status, fields = JOB_QUEUED, {
+                'run_after': now + timedelta(seconds=JOB_RETRY_DELAY_SECONDS * 2 ** (job.attempts - 1))}
+        else:
+            status, fields = JOB_FAILED, {'time_finished': now}
+        get_leased(job, worker_id).update(status=status, error=traceback.format_exc(), locked_by='',
+                                          locked_until=None, **fields)
+        return status
+    get_leased(job, worker_id).update(status=JOB_DONE, result=json.dumps(result), progress=1, locked_by='',
+                                      locked_until=None, time_finished=timezone.now())
+    return JOB_DONE
+
+
+# Claims and runs jobs in concurrency threads (in this one if 1), each with its own connection, until stop is set -
+# or there is no job left to claim if once, or max_jobs have been run. Returns how many were run.
+def run_worker(concurrency=JOB_WORKER_CONCURRENCY, poll=JOB_POLL_SECONDS, once=False, max_jobs=None, stop=None,
+               on_finish=None):
+    stop = stop or threading.Event()
+    worker_id = '%s:%s:%s' % (socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+    lock = threading.Lock()
+    counts = {'claimed': 0}
+
+    def take_turn():
+        with lock:
+            if max_jobs is not None and counts['claimed'] >= max_jobs:
+                return False
+            counts['claimed'] += 1
+        return True
+
+    def work(thread_id):
+        try:
+            while not stop.is_set() and take_turn():
+                if not connection.in_atomic_block:  # What a request would do, between the jobs
+                    close_old_connections()
+                claimed = claim(thread_id)
+                if not claimed:
+                    with lock:
+                        counts['claimed'] -= 1
+                    if once:
+                        return
+                    stop.wait(poll)
+                    continue
+                status = run(claimed[0], thread_id)
+                if on_finish:
+                    on_finish(claimed[0], status)
+        finally:
+            if threading.current_thread() is not threading.main_thread():
+                connections.close_all()
+
+    if concurrency <= 1:
+        work(worker_id)
+    else:
+        threads = [threading.Thread(target=work, args=('%s/%s' % (worker_id, index),), daemon=True,
+                                    name='novelrecorder-worker-%s' % index) for index in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    return counts['claimed']
+
+
+def serialize_job(job):
+    return {'id': job.pk, 'name': job.name, 'status': job.status, 'progress': job.progress,
+            'progress_message': job.progress_message, 'attempts': job.attempts, 'max_attempts': job.max_attempts,
+            'result': json.loads(job.result) if job.result is not None else None, 'error': job.error,
+            'time_created': job.time_created.isoformat(),
+            'time_started': job.time_started.isoformat() if job.time_started else None,
+            'time_finished': job.time_finished.isoformat() if job.time_finished else None}
+
+
+# Tasks
+# The heavy operations of the views and the maintenance commands.
+
+@task()
+def clone_novel(report, novel_id, user_id, name=None):
+    report(0, 'Cloning')
+    clone = cloning.clone_novel(Novel.objects.get(pk=novel_id), NovelUser.objects.get(pk=user_id), name=name)
+    return {'novel': clone.pk, 'name': clone.name}
+
+
+@task()
+def delete_novel(report, novel_id):
+    report(0, 'Deleting')
+    novel = Novel.objects.filter(pk=novel_id).first()
+    if novel is None:  # Deleted by a run whose lease ran out
+        return {'deleted': 0, 'objects': {}}
+    total, counts = deletion.delete_novel(novel)
+    return {'deleted': total, 'objects': counts}
+
+
+@task()
+def compact_changes(report, keep=CHANGE_LOG_KEEP):
+    novels = list(Novel.objects.filter(change_seq__gt=keep * 2).values_list('pk', flat=True))
+    deleted = 0
+    for index, novel_id in enumerate(novels):
+        report(index / len(novels), 'Compacting novel %s' % novel_id)
+        deleted += changelog.compact(Novel(pk=novel_id), keep)
+    return {'deleted': deleted}
+
+
+@task()
+def prune_revisions(report, keep=DESCRIPTION_REVISION_KEEP, days=DESCRIPTION_REVISION_KEEP_DAYS):
+    databases = sharding.get_shards() or [sharding.PRIMARY]
+    deleted = {}
+    for index, database in enumerate(databases):
+        report(index / len(databases), 'Pruning %s' % database)
+        deleted[database] = revisions.prune_all(database, keep, days)
+    return {'deleted': deleted}
+
+
+@task()
+def collect_blobs(report, recount=False):
+    databases = sharding.get_shards() or [sharding.PRIMARY]
+    deleted = {}
+    for index, database in enumerate(databases):
+        report(index / len(databases), 'Collecting %s' % database)
+        if recount:
+            DescriptionBlob.objects.recount(database)
+        deleted[database] = DescriptionBlob.objects.collect_garbage(database)
+    return {'deleted': deleted}
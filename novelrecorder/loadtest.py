@@ -0,0 +1,274 @@
+import asyncio
+import html
+import random
+import re
+import ssl
+import time
+from http.cookies import SimpleCookie
+from urllib.parse import urlsplit, urlencode
+
+from django.urls import resolve, Resolver404
+
+NOVEL_LINK = re.compile(r'/novelrecorder/novel_detail/(\d+)/')
+CHARACTER_LINK = re.compile(r'/novelrecorder/character_detail/(\d+)/')
+CSRF_INPUT = re.compile(r'name="csrfmiddlewaretoken" value="([^"]+)"')
+CHARACTER_SELECT = re.compile(r'<select class="form-control" name="character">\s*<option value="([^"]*)"')
+ACCESS_LOG_REQUEST = re.compile(r'"([A-Z]+) (\S+) HTTP/[\d.]+"')
+
+
+class HTTPClient(object):
+    """A minimal keep-alive HTTP/1.1 client on asyncio streams, with cookies. One per virtual user."""
+
+    def __init__(self, base_url, timeout=30):
+        parts = urlsplit(base_url)
+        self.scheme = parts.scheme or 'http'
+        self.host = parts.hostname
+        self.port = parts.port or (443 if parts.scheme == 'https' else 80)
+        # What the Host header and the Referer of the target are, with the port unless it's the default one
+        self.netloc = self.host if self.port == (443 if self.scheme == 'https' else 80) else '%s:%s' % (self.host, self.port)
+        self.ssl = ssl.create_default_context() if parts.scheme == 'https' else None
+        self.timeout = timeout
+        self.cookies = {}
+        self.reader = None
+        self.writer = None
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port, ssl=self.ssl)
+
+    def get_url(self, path):
+        return '%s://%s%s' % (self.scheme, self.netloc, path)
+
+    def close(self):
+        if self.writer:
+            self.writer.close()
+            self.writer = None
+
+    async def request(self, method, path, data=None, headers=None):
+        try:
+            return await asyncio.wait_for(self._request(method, path, data, headers), self.timeout)
+        except Exception:
+            self.close()  # The connection is in an unknown state
+            raise
+
+    async def _request(self, method, path, data, headers):
+        if self.writer is None:
+            await self.connect()
+        body = urlencode(data).encode() if data is not None else b''
+        lines = ['%s %s HTTP/1.1' % (method, path), 'Host: %s' % self.netloc, 'Content-Length: %s' % len(body)]
+        if data is not None:
+            lines.append('Content-Type: application/x-www-form-urlencoded')
+        if self.cookies:
+            lines.append('Cookie: %s' % '; '.join('%s=%s' % item for item in self.cookies.items()))
+        for name, value in (headers or {}).items():
+            lines.append('%s: %s' % (name, value))
+        self.writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body)
+        await self.writer.drain()
+
+        status_line = await self.reader.readline()
+        if not status_line:
+            raise ConnectionError('Connection closed by the server.')
+        status = int(status_line.split()[1])
+        response_headers = {}
+        while True:
+            line = (await self.reader.readline()).decode('latin-1').rstrip('\r\n')
+            if not line:
+                break
+            name, value = line.split(':', 1)
+            name = name.strip().lower()
+            if name == 'set-cookie':
+                cookie = SimpleCookie(value.strip())
+                for key, morsel in cookie.items():
+                    self.cookies[key] = morsel.value
+            response_headers[name] = value.strip()
+
+        if method == 'HEAD' or status in (204, 304) or 100 <= status < 200:
+            content = b''  # No body, whatever the headers say
+        elif response_headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int((await self.reader.readline()).split(b';')[0], 16)
+                chunk = await self.reader.readexactly(size + 2)
+                if size == 0:
+                    break
+                chunks.append(chunk[:-2])
+            content = b''.join(chunks)
+        elif 'content-length' in response_headers:
+            content = await self.reader.readexactly(int(response_headers['content-length']))
+        else:  # Delimited by the server closing the connection, which it can't be kept for
+            content = await self.reader.read()
+            self.close()
+        if response_headers.get('connection', '').lower() == 'close':
+            self.close()
+        return status, response_headers, content.decode('utf-8', 'replace')
+
+
+class LoadTestStats(object):
+    def __init__(self):
+        self.routes = {}
+        self.start = time.perf_counter()
+        self.end = None
+
+    @staticmethod
+    def route_name(path):
+        try:
+            return resolve(urlsplit(path).path).view_name or path
+        except Resolver404:
+            return 'unresolved'
+
+    def record(self, path, duration, status=None, error=None):
+        route = self.routes.setdefault(self.route_name(path), {'durations': [], 'errors': 0, 'statuses': {}})
+        route['durations'].append(duration)
+        if error is not None or status >= 400:
+            route['errors'] += 1
+        key = str(status) if error is None else type(error).__name__
+        route['statuses'][key] = route['statuses'].get(key, 0) + 1
+
+    @staticmethod
+    def percentile(durations, fraction):
+        return durations[min(int(len(durations) * fraction), len(durations) - 1)]
+
+    def summary(self):
+        elapsed = (self.end or time.perf_counter()) - self.start
+        routes = {}
+        for name, route in sorted(self.routes.items()):
+            durations = sorted(route['durations'])
+            routes[name] = {
+                'requests': len(durations),
+                'errors': route['errors'],
+                'error_rate': round(route['errors'] / len(durations), 4),
+                'throughput': round(len(durations) / elapsed, 2),
+                'p50_ms': round(self.percentile(durations, 0.50) * 1000, 2),
+                'p95_ms': round(self.percentile(durations, 0.95) * 1000, 2),
+                'p99_ms': round(self.percentile(durations, 0.99) * 1000, 2),
+                'statuses': route['statuses'],
+            }
+        total = sum(route['requests'] for route in routes.values())
+        return {
+            'elapsed_s': round(elapsed, 2),
+            'requests': total,
+            'errors': sum(route['errors'] for route in routes.values()),
+            'throughput': round(total / elapsed, 2) if elapsed else 0,
+            'routes': routes,
+        }
+
+
+class VirtualUser(object):
+    """Logs in, browses the public novels, their novels and characters, and sometimes adds a description
+    to a character of its own novels."""
+
+    def __init__(self, base_url, stats, username=None, password=None, write_ratio=0.1, rng=None):
+        self.client = HTTPClient(base_url)
+        self.stats = stats
+        self.username = username
+        self.password = password
+        self.write_ratio = write_ratio
+        self.rng = rng or random.Random()
+
+    async def get(self, path, **kwargs):
+        return await self.timed('GET', path, **kwargs)
+
+    async def timed(self, method, path, data=None, headers=None):
+        start = time.perf_counter()
+        try:
+            status, response_headers, content = await self.client.request(method, path, data, headers)
+        except Exception as e:
+            self.stats.record(path, time.perf_counter() - start, error=e)
+            return None, ''
+        self.stats.record(path, time.perf_counter() - start, status=status)
+        return status, content
+
+    async def post_form(self, path, form_page, data):
+        match = CSRF_INPUT.search(form_page)
+        data = dict(data, csrfmiddlewaretoken=match.group(1) if match else self.client.cookies.get('csrftoken', ''))
+        return await self.timed('POST', path, data, {'Referer': self.client.get_url(path)})
+
+    async def login(self):
+        status, content = await self.get('/accounts/login/')
+        if status == 200:
+            await self.post_form('/accounts/login/', content, {'username': self.username, 'password': self.password})
+
+    async def run_iteration(self):
+        status, content = await self.get('/novelrecorder/public_novel_list/')
+        novel_ids = NOVEL_LINK.findall(content)
+        if self.username:
+            status, content = await self.get('/novelrecorder/my_novel_list/')
+            own_novel_ids = NOVEL_LINK.findall(content)
+            if own_novel_ids and self.rng.random() < self.write_ratio:
+                await self.write_description(self.rng.choice(own_novel_ids))
+        if novel_ids:
+            status, content = await self.get('/novelrecorder/novel_detail/%s/' % self.rng.choice(novel_ids))
+            character_ids = CHARACTER_LINK.findall(content)
+            if character_ids:
+                await self.get('/novelrecorder/character_detail/%s/' % self.rng.choice(character_ids))
+
+    async def write_description(self, novel_id):
+        status, content = await self.get('/novelrecorder/novel_detail/%s/' % novel_id)
+        character_ids = CHARACTER_LINK.findall(content)
+        if not character_ids:
+            return
+        character_id = self.rng.choice(character_ids)
+        path = '/novelrecorder/description_detail_create/?character_id=%s' % character_id
+        status, form_page = await self.get(path)
+        # The form posts the character as its display value, as rendered in the (single option) select.
+        match = CHARACTER_SELECT.search(form_page)
+        if not match:
+            return
+        await self.post_form(path, form_page, {
+            'character': html.unescape(match.group(1)), 'title': 'Load test %s' % self.rng.randrange(10 ** 9),
+            'content': 'Written by manage.py loadtest.',
+        })
+
+    async def run(self, deadline, iterations):
+        try:
+            if self.username:
+                await self.login()
+            done = 0
+            while time.perf_counter() < deadline and (iterations is None or done < iterations):
+                await self.run_iteration()
+                done += 1
+        finally:
+            self.client.close()
+
+
+def parse_access_log(lines):
+    """Yields (method, path) from access log lines in the common/combined log format, e.g. gunicorn's."""
+    for line in lines:
+        match = ACCESS_LOG_REQUEST.search(line)
+        if match:
+            yield match.group(1), match.group(2)
+
+
+async def replay(base_url, stats, requests, concurrency, username=None, password=None):
+    """Replays the GET requests in order, spread over the clients. Other methods can't be replayed
+    as the access log doesn't have their bodies, so they are counted and skipped."""
+    queue = asyncio.Queue()
+    skipped = 0
+    for method, path in requests:
+        if method == 'GET':
+            queue.put_nowait(path)
+        else:
+            skipped += 1
+
+    async def worker():
+        user = VirtualUser(base_url, stats, username, password)
+        try:
+            if username:
+                await user.login()
+            while not queue.empty():
+                await user.get(queue.get_nowait())
+        finally:
+            user.client.close()
+
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    stats.end = time.perf_counter()
+    return skipped
+
+
+async def run_scenario(base_url, stats, concurrency, duration=None, iterations=None, username=None, password=None,
+                       write_ratio=0.1, seed=None):
+    deadline = time.perf_counter() + duration if duration else float('inf')
+    rng = random.Random(seed)
+    users = [VirtualUser(base_url, stats, username, password, write_ratio, random.Random(rng.random()))
+             for _ in range(concurrency)]
+    await asyncio.gather(*[user.run(deadline, iterations) for user in users])
+    stats.end = time.perf_counter()
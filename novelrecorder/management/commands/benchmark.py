@@ -0,0 +1,60 @@
+import json
+import logging
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import setup_databases, teardown_databases
+
+from novelrecorder.benchmarks.generator import NovelGenerator, PRESETS
+from novelrecorder.benchmarks.harness import run_benchmarks, compare
+
+
+class Command(BaseCommand):
+    help = 'Generates a synthetic dataset in a test database, then times and counts the queries of every route. ' \
+           'Compares the results against a baseline and fails on regressions, or on hot queries scanning whole tables.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--preset', choices=sorted(PRESETS), default='tiny')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--iterations', type=int, default=5)
+        parser.add_argument('--output', default='benchmark_results.json', help='Where to write the results.')
+        parser.add_argument('--baseline', help='Results of an earlier run to compare against.')
+        parser.add_argument('--tolerance', type=float, default=0.25, help='Allowed slowdown of the median, 0.25 = 25%%.')
+        parser.add_argument('--keepdb', action='store_true', help='Keep (and reuse) the test database and its dataset.')
+
+    def handle(self, *args, **options):
+        # One line per request from the instrumentation middleware would drown the report.
+        logging.getLogger('novelrecorder.instrumentation').setLevel(logging.WARNING)
+        old_config = setup_databases(verbosity=options['verbosity'], interactive=False, keepdb=options['keepdb'])
+        try:
+            from novelrecorder.models import Novel
+            if not Novel.objects.filter(name__startswith='Benchmark Novel').exists():
+                self.stdout.write('Generating the %s dataset (seed %s)...' % (options['preset'], options['seed']))
+                NovelGenerator(options['preset'], options['seed'], self.stdout).generate()
+            self.stdout.write('Running the benchmarks...')
+            results = run_benchmarks(options['iterations'], self.stdout)
+        finally:
+            teardown_databases(old_config, verbosity=options['verbosity'], keepdb=options['keepdb'])
+        results.update({'preset': options['preset'], 'seed': options['seed']})
+
+        with open(options['output'], 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        self.stdout.write('Results written to %s' % options['output'])
+        if results['unlisted_routes']:
+            self.stderr.write('Routes without a benchmark: %s' % ', '.join(results['unlisted_routes']))
+        if results['sequential_scans']:
+            raise CommandError('Hot queries scanning whole tables (see benchmarks.query_plans):\n  %s' % '\n  '.join(
+                '%s: %s' % (name, ', '.join(tables)) for name, tables in sorted(results['sequential_scans'].items())))
+
+        if options['baseline']:
+            if not os.path.isfile(options['baseline']):
+                raise CommandError('Baseline %s not found.' % options['baseline'])
+            with open(options['baseline']) as f:
+                baseline = json.load(f)
+            if (baseline.get('vendor'), baseline.get('preset')) != (results['vendor'], results['preset']):
+                raise CommandError('The baseline is for %s/%s, not %s/%s.' % (
+                    baseline.get('vendor'), baseline.get('preset'), results['vendor'], results['preset']))
+            regressions = compare(baseline, results, options['tolerance'])
+            if regressions:
+                raise CommandError('Regressions against %s:\n  %s' % (options['baseline'], '\n  '.join(regressions)))
+            self.stdout.write('No regressions against %s.' % options['baseline'])
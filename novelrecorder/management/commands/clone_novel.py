@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from novelrecorder import cloning
+from novelrecorder.models import Novel, NovelUser
+
+
+class Command(BaseCommand):
+    help = 'Copies a novel with its characters, relationships, descriptions and permissions as a new novel of the ' \
+           'user (see novelrecorder.cloning).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('novel_id', type=int)
+        parser.add_argument('username', help='The author of the copy.')
+        parser.add_argument('--name', help='The name of the copy (default: the name of the novel + " (copy)").')
+
+    def handle(self, *args, **options):
+        try:
+            novel = Novel.objects.get(pk=options['novel_id'])
+            user = NovelUser.objects.get(username=options['username'])
+        except (Novel.DoesNotExist, NovelUser.DoesNotExist) as e:
+            raise CommandError(e)
+        if options['name'] and Novel.objects.filter(author=user, name=options['name']).exists():
+            raise CommandError('%s has a novel named %s already.' % (user, options['name']))
+        clone = cloning.clone_novel(novel, user, name=options['name'])
+        self.stdout.write('Novel %s cloned as %s (%s).' % (novel.pk, clone.pk, clone.name))
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from novelrecorder import sharding
+from novelrecorder.models import DescriptionBlob
+
+
+class Command(BaseCommand):
+    help = 'Deletes the blobs of description text no description or revision refers to any more, on each shard. ' \
+           'Meant to be run periodically, e.g. by a scheduler.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--recount', action='store_true',
+                            help='First set the reference counts of the blobs from the descriptions.')
+
+    def handle(self, *args, **options):
+        for database in sharding.get_shards() or [sharding.PRIMARY]:
+            if options['recount']:
+                DescriptionBlob.objects.recount(database)
+            self.stdout.write('%s: %s blobs deleted' % (database, DescriptionBlob.objects.collect_garbage(database)))
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from novelrecorder import changelog
+from novelrecorder.constants import CHANGE_LOG_KEEP
+from novelrecorder.models import Novel
+
+
+class Command(BaseCommand):
+    help = 'Replaces the old entries of the novels\' change logs with snapshots, to keep the logs bounded. ' \
+           'Meant to be run periodically, e.g. by a scheduler.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--novel', type=int, help='Only compact the change log of the novel with this id.')
+        parser.add_argument('--keep', type=int, default=CHANGE_LOG_KEEP,
+                            help='The number of latest changes kept per novel (default %(default)s).')
+
+    def handle(self, *args, **options):
+        novels = Novel.objects.filter(change_seq__gt=options['keep'] * 2)
+        if options['novel']:
+            novels = novels.filter(pk=options['novel'])
+        for novel in novels:
+            deleted = changelog.compact(novel, options['keep'])
+            if deleted:
+                self.stdout.write('Compacted %s changes of %s' % (deleted, novel))
@@ -0,0 +1,53 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Case, Value, When
+
+from novelrecorder import compression, sharding
+from novelrecorder.models import DescriptionBlob
+
+
+class Command(BaseCommand):
+    help = 'Stores the content of the existing descriptions (their blobs) compressed (see novelrecorder.compression), ' \
+           'or uncompressed with --decompress, a batch at a time. The blobs created since are already stored so.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help='Blobs per transaction (default %(default)s).')
+        parser.add_argument('--sleep', type=float, default=0,
+                            help='Seconds to wait between the batches, to leave the database to the site.')
+        parser.add_argument('--decompress', action='store_true', help='Store the content uncompressed again.')
+
+    def handle(self, *args, **options):
+        store = compression.store_uncompressed if options['decompress'] else compression.compress
+        field = DescriptionBlob._meta.get_field('content')
+        for database in sharding.get_shards() or [sharding.PRIMARY]:
+            blobs = DescriptionBlob.objects.using(database)
+            converted = stored_before = stored_after = 0
+            last_hash = ''
+            while True:
+                with transaction.atomic(using=database):
+                    # Nothing to lock: the text of a blob never changes, only how it's stored
+                    batch = list(blobs.filter(hash__gt=last_hash).order_by('hash')
+                                 .values_list('hash', 'content')[:options['batch_size']])
+                    if not batch:
+                        break
+                    last_hash = batch[-1][0]
+                    changed = []
+                    for hash, before in batch:
+                        before = before.stored if isinstance(before, compression.CompressedText) else before
+                        after = store(compression.decompress(before))
+                        if before != after:
+                            changed.append((hash, after))
+                            stored_before += len(before)
+                            stored_after += len(after)
+                    if changed:
+                        # The values as they are, rather than through the field, which would compress them
+                        blobs.filter(hash__in=[hash for hash, after in changed]).update(content=Case(
+                            *[When(hash=hash, then=Value(compression.CompressedText(after), output_field=field))
+                              for hash, after in changed], output_field=field))
+                    converted += len(changed)
+                if options['sleep']:
+                    time.sleep(options['sleep'])
+            self.stdout.write('%s: %s blobs converted, %s characters stored instead of %s.' % (
+                database, converted, stored_after, stored_before))
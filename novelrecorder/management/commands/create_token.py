@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from novelrecorder.constants import TOKEN_SCOPES, TOKEN_SCOPE_READ
+from novelrecorder.models import NovelUser, NovelUserToken
+
+
+class Command(BaseCommand):
+    help = 'Creates an API token for a user and prints its key, which is not stored and can\'t be shown again.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('username')
+        parser.add_argument('--name', default='API token')
+        parser.add_argument('--scopes', nargs='+', choices=TOKEN_SCOPES, default=[TOKEN_SCOPE_READ])
+
+    def handle(self, *args, **options):
+        try:
+            user = NovelUser.objects.get(username=options['username'])
+        except NovelUser.DoesNotExist:
+            raise CommandError('User %s does not exist.' % options['username'])
+        token, key = NovelUserToken.create_token(user, options['name'], options['scopes'])
+        self.stderr.write('Created token %s with scopes: %s' % (token, token.scopes))
+        self.stdout.write(key)
@@ -0,0 +1,56 @@
+import asyncio
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from novelrecorder.loadtest import LoadTestStats, run_scenario, replay, parse_access_log
+
+
+class Command(BaseCommand):
+    help = 'Drives the real routes of a running server (e.g. gunicorn mysite.wsgi) with a pool of asyncio clients, ' \
+           'then reports the throughput, latency percentiles and error rate per route.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--base-url', default='http://127.0.0.1:8000')
+        parser.add_argument('--concurrency', type=int, default=10, help='Number of concurrent clients.')
+        parser.add_argument('--duration', type=float, default=30, help='In seconds.')
+        parser.add_argument('--iterations', type=int, help='Scenario iterations per client, instead of --duration.')
+        parser.add_argument('--username', help='Log the clients in as this user; they browse anonymously otherwise.')
+        parser.add_argument('--password')
+        parser.add_argument('--write-ratio', type=float, default=0.1,
+                            help='Fraction of the iterations that add a description to one of the user\'s novels.')
+        parser.add_argument('--seed', type=int)
+        parser.add_argument('--replay', metavar='ACCESS_LOG', help='Replay the GET requests of this access log instead.')
+        parser.add_argument('--json', metavar='PATH', help='Also write the report as JSON.')
+
+    def handle(self, *args, **options):
+        if options['username'] and options['password'] is None:
+            raise CommandError('--password is required with --username.')
+        stats = LoadTestStats()
+        if options['replay']:
+            with open(options['replay']) as f:
+                requests = list(parse_access_log(f))
+            skipped = asyncio.run(replay(options['base_url'], stats, requests, options['concurrency'],
+                                         options['username'], options['password']))
+            if skipped:
+                self.stderr.write('Skipped %s requests that are not GETs.' % skipped)
+        else:
+            asyncio.run(run_scenario(options['base_url'], stats, options['concurrency'],
+                                     duration=None if options['iterations'] else options['duration'],
+                                     iterations=options['iterations'], username=options['username'],
+                                     password=options['password'], write_ratio=options['write_ratio'],
+                                     seed=options['seed']))
+        summary = stats.summary()
+        self.write_report(summary)
+        if options['json']:
+            with open(options['json'], 'w') as f:
+                json.dump(summary, f, indent=2, sort_keys=True)
+
+    def write_report(self, summary):
+        self.stdout.write('%-45s %8s %8s %9s %9s %9s %9s' % ('Route', 'Requests', 'Errors', 'Req/s', 'p50 ms', 'p95 ms', 'p99 ms'))
+        for name, route in summary['routes'].items():
+            self.stdout.write('%-45s %8s %7.1f%% %9.2f %9.2f %9.2f %9.2f' % (
+                name, route['requests'], route['error_rate'] * 100, route['throughput'],
+                route['p50_ms'], route['p95_ms'], route['p99_ms']))
+        self.stdout.write('%s requests in %ss, %s req/s, %s errors.' % (
+            summary['requests'], summary['elapsed_s'], summary['throughput'], summary['errors']))
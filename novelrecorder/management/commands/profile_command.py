@@ -0,0 +1,34 @@
+import cProfile
+import time
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+
+from novelrecorder.profiling import write_profile
+
+
+class Command(BaseCommand):
+    help = 'Runs another management command under cProfile, writing the profile next to the request profiles.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('command_name')
+        parser.add_argument('command_args', nargs='*')
+
+    def handle(self, *args, **options):
+        profiler = cProfile.Profile()
+        start = time.perf_counter()
+        profiler.enable()
+        try:
+            call_command(options['command_name'], *options['command_args'])
+        finally:
+            profiler.disable()
+        profile_id = write_profile(profiler, {
+            'method': 'COMMAND',
+            'path': ' '.join([options['command_name']] + options['command_args']),
+            'url_name': None,
+            'view': options['command_name'],
+            'status': None,
+            'duration_ms': round((time.perf_counter() - start) * 1000, 2),
+            'time': time.time(),
+        })
+        self.stdout.write('Profile written: %s' % profile_id)
@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from novelrecorder.profiling import make_profile_token, PROFILE_HEADER, get_profiler_setting
+
+
+class Command(BaseCommand):
+    help = 'Prints a signed token for the X-Novelrecorder-Profile header, which profiles the request sending it.'
+
+    def handle(self, *args, **options):
+        self.stdout.write(make_profile_token())
+        self.stderr.write('Send it as the %s header; valid for %s seconds.' % (
+            PROFILE_HEADER[len('HTTP_'):].replace('_', '-').title(), get_profiler_setting('TOKEN_MAX_AGE')))
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from novelrecorder import revisions, sharding
+from novelrecorder.constants import DESCRIPTION_REVISION_KEEP, DESCRIPTION_REVISION_KEEP_DAYS
+
+
+class Command(BaseCommand):
+    help = 'Deletes the old revisions of the descriptions, on each shard: those older than --days beyond the ' \
+           'latest --keep of each description. Meant to be run periodically, e.g. by a scheduler.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--keep', type=int, default=DESCRIPTION_REVISION_KEEP,
+                            help='Latest revisions kept per description, however old (default %(default)s).')
+        parser.add_argument('--days', type=int, default=DESCRIPTION_REVISION_KEEP_DAYS,
+                            help='Age in days of the revisions pruned (default %(default)s).')
+
+    def handle(self, *args, **options):
+        for database in sharding.get_shards() or [sharding.PRIMARY]:
+            self.stdout.write('%s: %s revisions deleted' % (
+                database, revisions.prune_all(database, options['keep'], options['days'])))
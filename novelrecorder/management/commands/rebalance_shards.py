@@ -0,0 +1,40 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from novelrecorder import sharding
+from novelrecorder.constants import SHARD_MAP_CACHE_SECONDS
+from novelrecorder.models import Novel
+
+
+class Command(BaseCommand):
+    help = 'Moves novels between the shards (settings.DATABASE_SHARDS): the one given by --novel and --to, ' \
+           'or else those evening out the number of objects per shard. Only prints the moves without --apply.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--novel', type=int, help='Move the novel with this id (to the shard given by --to).')
+        parser.add_argument('--to', help='The shard to move the novel to.')
+        parser.add_argument('--apply', action='store_true', help='Make the moves rather than only print them.')
+        parser.add_argument('--wait', type=float, default=SHARD_MAP_CACHE_SECONDS,
+                            help='Seconds to wait after a move before deleting the novel from its old shard, for '
+                                 'the processes to see the move (default %(default)s).')
+
+    def handle(self, *args, **options):
+        if not sharding.is_enabled():
+            raise CommandError('There are no shards, see DATABASE_SHARDS in the settings.')
+        if options['novel']:
+            if options['to'] not in sharding.get_shards():
+                raise CommandError('--to is one of %s.' % ', '.join(sharding.get_shards()))
+            novel = Novel.objects.using(sharding.PRIMARY).filter(pk=options['novel']).first()
+            if novel is None:
+                raise CommandError('There is no novel %s.' % options['novel'])
+            moves = [(novel.pk, novel.shard, options['to'], None)]
+        else:
+            moves = sharding.plan_rebalance()
+        for novel_id, source, target, size in moves:
+            self.stdout.write('Novel %s: %s -> %s%s' % (novel_id, source, target,
+                                                         '' if size is None else ' (%s objects)' % size))
+            if options['apply']:
+                sharding.move_novel(Novel(pk=novel_id), target, options['wait'])
+        if not moves:
+            self.stdout.write('The shards are balanced.')
+        elif not options['apply']:
+            self.stdout.write('Run with --apply to make the moves.')
@@ -0,0 +1,58 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+
+from novelrecorder import rendering, sharding
+from novelrecorder.models import Description, DescriptionBlob, get_excerpt_html
+
+
+class Command(BaseCommand):
+    help = 'Renders the Markdown of the descriptions (their blobs) not rendered yet, or rendered by an older version ' \
+           'of novelrecorder.rendering, a batch at a time - so no page view has to. With --excerpts, renders the ' \
+           'excerpts of all the descriptions again too, e.g. after a change of the renderer.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help='Rows per batch (default %(default)s).')
+        parser.add_argument('--sleep', type=float, default=0,
+                            help='Seconds to wait between the batches, to leave the database to the site.')
+        parser.add_argument('--excerpts', action='store_true', help='Render the excerpts of the descriptions again.')
+
+    def handle(self, *args, **options):
+        for database in sharding.get_shards() or [sharding.PRIMARY]:
+            self.stdout.write('%s: %s blobs rendered' % (database, self.render_blobs(database, options)))
+            if options['excerpts']:
+                self.stdout.write('%s: %s excerpts rendered' % (database, self.render_excerpts(database, options)))
+
+    def render_blobs(self, database, options):
+        blobs = DescriptionBlob.objects.using(database).filter(
+            Q(html__isnull=True) | ~Q(html_version=rendering.RENDERER_VERSION)).only('hash', 'content')
+        rendered = 0
+        last_hash = ''
+        while True:
+            batch = list(blobs.filter(hash__gt=last_hash).order_by('hash')[:options['batch_size']])
+            if not batch:
+                return rendered
+            for blob in batch:
+                blob.html, blob.html_version = rendering.render_markdown(blob.content), rendering.RENDERER_VERSION
+            DescriptionBlob.objects.using(database).bulk_update(batch, ['html', 'html_version'])
+            rendered += len(batch)
+            last_hash = batch[-1].hash
+            if options['sleep']:
+                time.sleep(options['sleep'])
+
+    def render_excerpts(self, database, options):
+        descriptions = Description.objects.using(database).select_related('blob').only('id', 'blob__content')
+        rendered = 0
+        last_id = 0
+        while True:
+            batch = list(descriptions.filter(id__gt=last_id).order_by('id')[:options['batch_size']])
+            if not batch:
+                return rendered
+            for description in batch:
+                description.excerpt_html = get_excerpt_html(description.content)
+            Description.objects.using(database).bulk_update(batch, ['excerpt_html'])
+            rendered += len(batch)
+            last_id = batch[-1].id
+            if options['sleep']:
+                time.sleep(options['sleep'])
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from novelrecorder.models import NovelUserToken
+
+
+class Command(BaseCommand):
+    help = 'Revokes the API tokens of a user, or only those whose key starts with --prefix.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('username')
+        parser.add_argument('--prefix', help='The first characters of the key, as shown in the admin.')
+
+    def handle(self, *args, **options):
+        tokens = NovelUserToken.objects.filter(user__username=options['username'], time_revoked__isnull=True)
+        if options['prefix']:
+            tokens = tokens.filter(key_prefix__startswith=options['prefix'][:8])
+        if not tokens:
+            raise CommandError('No active token found.')
+        for token in tokens:
+            token.revoke()  # One by one so the cache invalidation signals fire
+            self.stdout.write('Revoked %s' % token)
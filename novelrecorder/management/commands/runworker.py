@@ -0,0 +1,35 @@
+import signal
+import threading
+
+from django.core.management.base import BaseCommand
+
+from novelrecorder import jobs
+from novelrecorder.constants import JOB_WORKER_CONCURRENCY, JOB_POLL_SECONDS
+
+
+class Command(BaseCommand):
+    help = 'Runs the background jobs queued by the site (see novelrecorder.jobs) as they come, until stopped - ' \
+           'SIGTERM or SIGINT lets the jobs running finish first. Run as many as needed, on any host.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, default=JOB_WORKER_CONCURRENCY,
+                            help='Jobs run at a time (default %(default)s).')
+        parser.add_argument('--poll', type=float, default=JOB_POLL_SECONDS,
+                            help='Seconds between the looks for jobs when there is none (default %(default)s).')
+        parser.add_argument('--once', action='store_true', help='Stop when there is no job left to run.')
+        parser.add_argument('--max-jobs', type=int, help='Stop after running this many jobs.')
+
+    def handle(self, *args, **options):
+        stop = threading.Event()
+        handlers = {signal_number: signal.signal(signal_number, lambda number, frame: stop.set())
+                    for signal_number in (signal.SIGTERM, signal.SIGINT)}
+        try:
+            run = jobs.run_worker(options['concurrency'], options['poll'], once=options['once'],
+                                  max_jobs=options['max_jobs'], stop=stop, on_finish=self.write_finished)
+        finally:
+            for signal_number, handler in handlers.items():
+                signal.signal(signal_number, handler)
+        self.stdout.write('%s jobs run' % run)
+
+    def write_finished(self, job, status):
+        self.stdout.write('%s #%s: %s' % (job.name, job.pk, status))
@@ -0,0 +1,231 @@
+import fcntl
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+
+logger = logging.getLogger('novelrecorder.metrics')
+
+# Each process keeps its metrics in memory and regularly writes them to its own file in the metrics directory.
+# /metrics sums up the files of all the processes (e.g. gunicorn workers) on the host. The files of the processes
+# that have ended are added to ARCHIVE_FILENAME and removed, so their counts stay in the sums.
+DEFAULT_METRICS_DIRECTORY = os.path.join(tempfile.gettempdir(), 'novelrecorder_metrics')
+FLUSH_INTERVAL = 1.0  # In seconds
+ARCHIVE_FILENAME = 'archived.json'
+GAUGE_CACHE_KEY = 'novelrecorder_metrics_gauges'
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+
+METRIC_HELP = {
+    'novelrecorder_requests_total': ('counter', 'Requests handled, by url name, method and status.'),
+    'novelrecorder_request_duration_seconds': ('histogram', 'Request latency, by url name.'),
+    'novelrecorder_request_queries_total': ('counter', 'Database queries run by requests, by url name.'),
+    'novelrecorder_request_db_seconds_total': ('counter', 'Time spent in the database by requests, by url name.'),
+    'novelrecorder_cache_requests_total': ('counter', 'Cache lookups, by cache and result (hit or miss).'),
+    'novelrecorder_permission_checks_total': ('counter', 'Novel permission checks, by result.'),
+    'novelrecorder_objects': ('gauge', 'Number of objects stored, by model.'),
+}
+
+
+def get_metrics_directory():
+    return getattr(settings, 'METRICS_DIRECTORY', DEFAULT_METRICS_DIRECTORY)
+
+
+class MetricsStore(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.last_flush = 0.0
+        self.flush_lock = threading.Lock()  # One write of the file at a time, the latest counts last
+
+    @staticmethod
+    def key(name, labels):
+        return json.dumps([name, sorted((labels or {}).items())])
+
+    def inc(self, name, labels=None, value=1):
+        key = self.key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+        self.maybe_flush()
+
+    def observe(self, name, labels, value):
+        key = self.key(name, labels)
+        with self.lock:
+            histogram = self.histograms.setdefault(key, {'buckets': [0] * len(LATENCY_BUCKETS), 'sum': 0.0, 'count': 0})
+            for index, bound in enumerate(LATENCY_BUCKETS):
+                if value <= bound:
+                    histogram['buckets'][index] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+        self.maybe_flush()
+
+    def get_path(self):
+        return os.path.join(get_metrics_directory(), 'metrics_%s.json' % os.getpid())
+
+    # The first thread finding a flush due does it, the others go on.
+    def maybe_flush(self):
+        with self.lock:
+            if time.time() - self.last_flush < FLUSH_INTERVAL:
+                return
+            self.last_flush = time.time()
+        self.flush()
+
+    # Never raises: it's called on the path of the requests (by inc() and observe()), which the metrics mustn't fail.
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                data = json.dumps({'counters': self.counters, 'histograms': self.histograms})
+                self.last_flush = time.time()
+            path = self.get_path()
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                write_atomically(path, data)
+            except OSError:
+                logger.warning('Could not write the metrics to %s.', path, exc_info=True)
+
+
+# Writes a file of its own then renames it, so a scrape never reads a half written file.
+def write_atomically(path, data):
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.%s.' % os.path.basename(path))
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(data)
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+
+
+store = MetricsStore()
+
+
+def inc(name, labels=None, value=1):
+    store.inc(name, labels, value)
+
+
+def observe(name, labels, value):
+    store.observe(name, labels, value)
+
+
+def record_cache_lookup(cache_name, hit):
+    inc('novelrecorder_cache_requests_total', {'cache': cache_name, 'result': 'hit' if hit else 'miss'})
+
+
+def record_request(url_name, method, status, duration, queries, db_duration):
+    labels = {'url_name': url_name or 'unknown'}
+    inc('novelrecorder_requests_total', dict(labels, method=method, status=str(status)))
+    observe('novelrecorder_request_duration_seconds', labels, duration)
+    inc('novelrecorder_request_queries_total', labels, queries)
+    inc('novelrecorder_request_db_seconds_total', labels, db_duration)
+
+
+def read_metrics_file(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def add_metrics(counters, histograms, data):
+    for key, value in data['counters'].items():
+        counters[key] = counters.get(key, 0) + value
+    for key, value in data['histograms'].items():
+        histogram = histograms.setdefault(key, {'buckets': [0] * len(LATENCY_BUCKETS), 'sum': 0.0, 'count': 0})
+        histogram['buckets'] = [a + b for a, b in zip(histogram['buckets'], value['buckets'])]
+        histogram['sum'] += value['sum']
+        histogram['count'] += value['count']
+
+
+def is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:  # Running as another user
+        pass
+    return True
+
+
+# Adds the files of the ended processes to the archive and removes them, under a lock so two scrapes don't both.
+def archive_ended(directory, filenames):
+    ended = [filename for filename in filenames if not is_running(int(filename[len('metrics_'):-len('.json')]))]
+    if not ended:
+        return
+    with open(os.path.join(directory, ARCHIVE_FILENAME + '.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        archive_path = os.path.join(directory, ARCHIVE_FILENAME)
+        archived = read_metrics_file(archive_path) or {'counters': {}, 'histograms': {}}
+        counters, histograms = archived['counters'], archived['histograms']
+        ended_paths = [os.path.join(directory, filename) for filename in ended]
+        for path in ended_paths:
+            data = read_metrics_file(path)  # None if archived by another scrape meanwhile
+            if data is not None:
+                add_metrics(counters, histograms, data)
+        write_atomically(archive_path, json.dumps({'counters': counters, 'histograms': histograms}))
+        for path in ended_paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+def collect():
+    store.flush()
+    counters = {}
+    histograms = {}
+    directory = get_metrics_directory()
+    archive_ended(directory, [filename for filename in os.listdir(directory)
+                              if filename.startswith('metrics_') and filename.endswith('.json')])
+    for filename in os.listdir(directory):
+        if not (filename.startswith('metrics_') and filename.endswith('.json') or filename == ARCHIVE_FILENAME):
+            continue
+        data = read_metrics_file(os.path.join(directory, filename))
+        if data is not None:
+            add_metrics(counters, histograms, data)
+    return counters, histograms
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                             for name, value in labels)
+
+
+def format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+# Text exposition format, see https://prometheus.io/docs/instrumenting/exposition_formats/
+def render_metrics(gauges):
+    counters, histograms = collect()
+    series = {}
+    for key, value in sorted(counters.items()):
+        name, labels = json.loads(key)
+        series.setdefault(name, []).append('%s%s %s' % (name, format_labels(labels), format_value(value)))
+    for key, histogram in sorted(histograms.items()):
+        name, labels = json.loads(key)
+        lines = series.setdefault(name, [])
+        for bound, count in zip(LATENCY_BUCKETS, histogram['buckets']):
+            lines.append('%s_bucket%s %s' % (name, format_labels(labels + [['le', repr(bound)]]), count))
+        lines.append('%s_bucket%s %s' % (name, format_labels(labels + [['le', '+Inf']]), histogram['count']))
+        lines.append('%s_sum%s %s' % (name, format_labels(labels), format_value(histogram['sum'])))
+        lines.append('%s_count%s %s' % (name, format_labels(labels), histogram['count']))
+    for name, labels, value in gauges:
+        series.setdefault(name, []).append('%s%s %s' % (name, format_labels(sorted(labels.items())), format_value(value)))
+
+    output = []
+    for name in sorted(series):
+        metric_type, help_text = METRIC_HELP.get(name, ('untyped', ''))
+        output.append('# HELP %s %s' % (name, help_text))
+        output.append('# TYPE %s %s' % (name, metric_type))
+        output.extend(series[name])
+    return '\n'.join(output) + '\n'
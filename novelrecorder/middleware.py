@@ -0,0 +1,172 @@
+import contextvars
+import hashlib
+import json
+import logging
+import threading
+import time
+from contextlib import ExitStack, contextmanager
+
+from django.conf import settings
+from django.db import connections
+
+from novelrecorder import metrics
+from novelrecorder.yd_exceptions import QueryBudgetExceededException
+
+logger = logging.getLogger('novelrecorder.instrumentation')
+
+DEFAULT_SLOW_REQUEST_MS = 500  # Requests taking longer are logged at INFO, the others at DEBUG
+
+# The timing of the request being handled, and whether a serializer is being timed already (in this thread)
+_current_timing = contextvars.ContextVar('novelrecorder_request_timing', default=None)
+_serializing = contextvars.ContextVar('novelrecorder_serializing', default=False)
+
+
+class QueryRecorder(object):
+    """Records every query run through a connection, to be installed with connection.execute_wrapper().
+
+    The queries of a request may run on several threads at once (see query_utils.run_concurrently), hence the lock.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+        self.fingerprints = {}
+        self.lock = threading.Lock()
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            duration = time.perf_counter() - start
+            # The sql still has its placeholders here, so the same query with different params shares a fingerprint.
+            fingerprint = hashlib.sha1(sql.encode('utf-8')).hexdigest()[:12]
+            with self.lock:
+                self.duration += duration
+                self.count += 1
+                entry = self.fingerprints.setdefault(fingerprint, {'sql': sql[:200], 'count': 0})
+                entry['count'] += 1
+
+    def get_duplicates(self):
+        with self.lock:
+            return {fingerprint: entry for fingerprint, entry in self.fingerprints.items() if entry['count'] > 1}
+
+
+class RequestTiming(object):
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.view_start = None
+        self.render_start = None
+        self.render_end = None
+        self.view_class = None
+        self.serialize_duration = 0.0
+        self.lock = threading.Lock()
+        self.recorder = QueryRecorder()
+
+    @staticmethod
+    def milliseconds(start, end):
+        if start is None or end is None:
+            return None
+        return round((end - start) * 1000, 2)
+
+    def on_render_end(self, response):
+        self.render_end = time.perf_counter()
+        return response
+
+
+# Times the block as serialization of the request being handled, if any - once however deeply the serializers nest.
+# The serializers (YDModelSerializer) run in the view or in the template rendering, so it's part of either's time.
+@contextmanager
+def timing_serialization():
+    timing = _current_timing.get()
+    if timing is None or _serializing.get():
+        yield
+        return
+    token = _serializing.set(True)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        with timing.lock:
+            timing.serialize_duration += time.perf_counter() - start
+        _serializing.reset(token)
+
+
+# Records the query count, db time, duplicated queries, view, serializer and template render time of each request,
+# then reports them in the Server-Timing header, the 'novelrecorder.instrumentation' log (at DEBUG, or INFO if slower
+# than settings.SLOW_REQUEST_MS) and the /metrics endpoint.
+# Views can declare query_budgets = {'GET': n, ...}; going over it raises if settings.QUERY_BUDGET_STRICT,
+# otherwise logs a warning.
+class QueryInstrumentationMiddleware(object):
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        timing = RequestTiming()
+        request.novelrecorder_timing = timing
+        token = _current_timing.set(timing)
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(timing.recorder))
+                response = self.get_response(request)
+        finally:
+            _current_timing.reset(token)
+        end = time.perf_counter()
+
+        record = self.build_record(request, response, timing, end)
+        response['Server-Timing'] = self.build_server_timing(record)
+        slow = record['total_ms'] > getattr(settings, 'SLOW_REQUEST_MS', DEFAULT_SLOW_REQUEST_MS)
+        if logger.isEnabledFor(logging.INFO if slow else logging.DEBUG):
+            logger.log(logging.INFO if slow else logging.DEBUG, json.dumps(record))
+        resolver_match = getattr(request, 'resolver_match', None)
+        metrics.record_request(resolver_match.view_name if resolver_match else None, request.method,
+                               response.status_code, end - timing.start, timing.recorder.count, timing.recorder.duration)
+        self.check_query_budget(request, timing, record)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        timing = request.novelrecorder_timing
+        timing.view_start = time.perf_counter()
+        timing.view_class = getattr(view_func, 'view_class', None)
+        return None
+
+    def process_template_response(self, request, response):
+        timing = request.novelrecorder_timing
+        timing.render_start = time.perf_counter()
+        response.add_post_render_callback(timing.on_render_end)
+        return response
+
+    def build_record(self, request, response, timing, end):
+        recorder = timing.recorder
+        return {
+            'method': request.method,
+            'path': request.path,
+            'view': timing.view_class.__name__ if timing.view_class else None,
+            'status': response.status_code,
+            'queries': recorder.count,
+            'db_ms': round(recorder.duration * 1000, 2),
+            'view_ms': timing.milliseconds(timing.view_start, timing.render_start or end),
+            'serialize_ms': round(timing.serialize_duration * 1000, 2),
+            'render_ms': timing.milliseconds(timing.render_start, timing.render_end),
+            'total_ms': timing.milliseconds(timing.start, end),
+            'duplicates': recorder.get_duplicates(),
+        }
+
+    def build_server_timing(self, record):
+        metrics = ['db;dur=%s;desc="%s queries, %s duplicated"' % (record['db_ms'], record['queries'], len(record['duplicates']))]
+        for name in ['view', 'serialize', 'render', 'total']:
+            if record[name + '_ms'] is not None:
+                metrics.append('%s;dur=%s' % (name, record[name + '_ms']))
+        return ', '.join(metrics)
+
+    def check_query_budget(self, request, timing, record):
+        budgets = getattr(timing.view_class, 'query_budgets', None) or {}
+        budget = budgets.get(request.method)
+        if budget is None or record['queries'] <= budget:
+            return
+        message = '%s %s (%s) ran %s queries, over its budget of %s.' % (
+            request.method, request.path, record['view'], record['queries'], budget)
+        if getattr(settings, 'QUERY_BUDGET_STRICT', False):
+            raise QueryBudgetExceededException(message)
+        logger.warning(message)
@@ -3,8 +3,6 @@
 
 from django.db import migrations
 
-from novelrecorder.models import Description
-
 
 class Migration(migrations.Migration):
 
@@ -12,9 +10,15 @@ class Migration(migrations.Migration):
         ('novelrecorder', '0003_description_is_primary'),
     ]
 
+    # With the model of this migration, which later columns aren't in yet (it has none of the methods of the model,
+    # so this is Description.default_is_primary()).
     def updateDescriptionIsPrimary(apps, schema_editor):
-        for description in Description.objects.all():
-            if description.default_is_primary():
+        Description = apps.get_model('novelrecorder', 'Description')
+        descriptions = Description.objects.using(schema_editor.connection.alias)
+        for description in descriptions.order_by('sort_order'):
+            owner = {'character': description.character_id} if description.character_id is not None else \
+                {'relationship': description.relationship_id}
+            if descriptions.filter(**owner).order_by('sort_order').first().id == description.id:
                 description.is_primary = True
                 description.save()
 
@@ -0,0 +1,31 @@
+# Generated by Django 2.2.6 on 2026-10-19 05:24
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('novelrecorder', '0004_auto_20191014_0322'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='NovelUserToken',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=200)),
+                ('key_prefix', models.CharField(max_length=8)),
+                ('key_hash', models.CharField(max_length=64, unique=True)),
+                ('scopes', models.CharField(default='read', max_length=200)),
+                ('time_created', models.DateTimeField(auto_now_add=True)),
+                ('time_revoked', models.DateTimeField(blank=True, null=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='tokens', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+    ]
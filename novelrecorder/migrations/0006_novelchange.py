@@ -0,0 +1,50 @@
+# Generated by Django 2.2.6 on 2026-10-19 09:12
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('novelrecorder', '0005_novelusertoken'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='novel',
+            name='change_seq',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.CreateModel(
+            name='NovelSnapshot',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('seq', models.PositiveIntegerField()),
+                ('compacted_seq', models.PositiveIntegerField()),
+                ('data', models.TextField()),
+                ('time_created', models.DateTimeField(auto_now_add=True)),
+                ('novel', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='snapshots', to='novelrecorder.Novel')),
+            ],
+            options={
+                'ordering': ['-seq'],
+            },
+        ),
+        migrations.CreateModel(
+            name='NovelChange',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('seq', models.PositiveIntegerField()),
+                ('object_type', models.CharField(max_length=20)),
+                ('object_id', models.PositiveIntegerField()),
+                ('action', models.CharField(max_length=10)),
+                ('data', models.TextField(blank=True, null=True)),
+                ('time_created', models.DateTimeField(auto_now_add=True)),
+                ('novel', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='changes', to='novelrecorder.Novel')),
+            ],
+            options={
+                'ordering': ['seq'],
+                'unique_together': {('novel', 'seq')},
+            },
+        ),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 2.2.6 on 2026-10-19 13:40
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('novelrecorder', '0006_novelchange'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ShardIdBlock',
+            fields=[
+                ('model_label', models.CharField(max_length=100, primary_key=True, serialize=False)),
+                ('next_id', models.BigIntegerField()),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+        migrations.AddField(
+            model_name='novel',
+            name='shard',
+            field=models.CharField(default='default', max_length=50),
+        ),
+        migrations.AlterField(
+            model_name='novel',
+            name='author',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.PROTECT, related_name='novel_author', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterField(
+            model_name='description',
+            name='author',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.PROTECT, related_name='description_author', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterField(
+            model_name='noveluserpermissionmodel',
+            name='user',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL),
+        ),
+    ]
@@ -0,0 +1,72 @@
+# Generated by Django 2.2.6 on 2026-10-19 14:10
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('novelrecorder', '0007_sharding'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='description',
+            name='character',
+            field=models.ForeignKey(blank=True, db_index=False, null=True, on_delete=django.db.models.deletion.CASCADE, to='novelrecorder.Character'),
+        ),
+        migrations.AlterField(
+            model_name='description',
+            name='relationship',
+            field=models.ForeignKey(blank=True, db_index=False, null=True, on_delete=django.db.models.deletion.CASCADE, to='novelrecorder.Relationship'),
+        ),
+        migrations.AlterField(
+            model_name='noveluserpermissionmodel',
+            name='novel',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='novelrecorder.Novel'),
+        ),
+        migrations.AlterField(
+            model_name='noveluserpermissionmodel',
+            name='user',
+            field=models.ForeignKey(db_constraint=False, db_index=False, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterField(
+            model_name='relationship',
+            name='character2',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.PROTECT, related_name='relationship_character2', to='novelrecorder.Character'),
+        ),
+        migrations.AddIndex(
+            model_name='description',
+            index=models.Index(fields=['character', 'sort_order'], name='nr_desc_character_order_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='description',
+            index=models.Index(fields=['relationship', 'sort_order'], name='nr_desc_relationship_order_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='description',
+            index=models.Index(condition=models.Q(is_primary=True), fields=['character'], name='nr_desc_character_primary_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='description',
+            index=models.Index(condition=models.Q(is_primary=True), fields=['relationship'], name='nr_desc_rel_primary_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='novel',
+            index=models.Index(fields=['is_public', 'name'], name='nr_novel_public_name_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='noveluserpermissionmodel',
+            index=models.Index(fields=['novel', 'user'], name='nr_nup_novel_user_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='noveluserpermissionmodel',
+            index=models.Index(fields=['user', 'permission', 'novel'], name='nr_nup_user_permission_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='relationship',
+            index=models.Index(fields=['character2', 'character1'], name='nr_rel_character2_idx'),
+        ),
+    ]
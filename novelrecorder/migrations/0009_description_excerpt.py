@@ -0,0 +1,44 @@
+# Generated by Django 2.2.6 on 2026-10-19 15:02
+# The excerpts of the existing descriptions are filled in
+
+from django.db import migrations, models
+
+from novelrecorder.models import get_excerpt, get_word_count
+
+BATCH_SIZE = 500
+
+
+def fillDescriptionExcerpts(apps, schema_editor):
+    Description = apps.get_model('novelrecorder', 'Description')
+    descriptions = Description.objects.using(schema_editor.connection.alias).only('id', 'content').order_by('id')
+    last_id = 0
+    while True:
+        batch = list(descriptions.filter(id__gt=last_id)[:BATCH_SIZE])
+        if not batch:
+            break
+        for description in batch:
+            description.excerpt = get_excerpt(description.content)
+            description.word_count = get_word_count(description.content)
+        Description.objects.using(schema_editor.connection.alias).bulk_update(batch, ['excerpt', 'word_count'])
+        last_id = batch[-1].id
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('novelrecorder', '0008_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='description',
+            name='excerpt',
+            field=models.CharField(blank=True, default='', max_length=201),
+        ),
+        migrations.AddField(
+            model_name='description',
+            name='word_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(fillDescriptionExcerpts, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 2.2.6 on 2026-10-19 06:01
+
+from django.db import migrations
+import novelrecorder.compression
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('novelrecorder', '0009_description_excerpt'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='description',
+            name='content',
+            field=novelrecorder.compression.CompressedTextField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,88 @@
+# Generated by Django 2.2.6 on 2026-10-19 16:20
+# The content of the existing descriptions is moved to the blobs
+
+import hashlib
+from collections import Counter
+
+from django.db import migrations, models
+from django.db.models import F
+import django.db.models.deletion
+import novelrecorder.compression
+
+BATCH_SIZE = 500
+
+
+def moveDescriptionContent(apps, schema_editor):
+    Description = apps.get_model('novelrecorder', 'Description')
+    DescriptionBlob = apps.get_model('novelrecorder', 'DescriptionBlob')
+    descriptions = Description.objects.using(schema_editor.connection.alias).only('id', 'content').order_by('id')
+    blobs = DescriptionBlob.objects.using(schema_editor.connection.alias)
+    ref_counts = Counter()
+    last_id = 0
+    while True:
+        batch = list(descriptions.filter(id__gt=last_id)[:BATCH_SIZE])
+        if not batch:
+            break
+        texts = {}
+        for description in batch:
+            if description.content is not None:
+                # As models.get_blob_hash() hashes them, which a migration mustn't import
+                description.blob_id = hashlib.sha256(description.content.encode('utf-8')).hexdigest()
+                texts[description.blob_id] = description.content
+                ref_counts[description.blob_id] += 1
+        existing = set(blobs.filter(hash__in=list(texts)).values_list('hash', flat=True))
+        blobs.bulk_create([DescriptionBlob(hash=hash, content=text) for hash, text in texts.items() if hash not in existing])
+        Description.objects.using(schema_editor.connection.alias).bulk_update(batch, ['blob'])
+        last_id = batch[-1].id
+    by_count = {}
+    for hash, count in ref_counts.items():
+        by_count.setdefault(count, []).append(hash)
+    for count, hashes in by_count.items():
+        for start in range(0, len(hashes), BATCH_SIZE):
+            blobs.filter(hash__in=hashes[start:start + BATCH_SIZE]).update(ref_count=F('ref_count') + count)
+
+
+def moveDescriptionContentBack(apps, schema_editor):
+    Description = apps.get_model('novelrecorder', 'Description')
+    descriptions = Description.objects.using(schema_editor.connection.alias).select_related('blob').order_by('id')
+    last_id = 0
+    while True:
+        batch = list(descriptions.filter(id__gt=last_id)[:BATCH_SIZE])
+        if not batch:
+            break
+        for description in batch:
+            description.content = description.blob.content if description.blob_id is not None else None
+        Description.objects.using(schema_editor.connection.alias).bulk_update(batch, ['content'])
+        last_id = batch[-1].id
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('novelrecorder', '0010_description_content_compressed'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DescriptionBlob',
+            fields=[
+                ('hash', models.CharField(max_length=64, primary_key=True, serialize=False)),
+                ('content', novelrecorder.compression.CompressedTextField()),
+                ('ref_count', models.IntegerField(default=0)),
+                ('time_created', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+        migrations.AddField(
+            model_name='description',
+            name='blob',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, to='novelrecorder.DescriptionBlob'),
+        ),
+        migrations.RunPython(moveDescriptionContent, moveDescriptionContentBack),
+        migrations.RemoveField(
+            model_name='description',
+            name='content',
+        ),
+    ]
@@ -0,0 +1,52 @@
+# Generated by Django 2.2.6 on 2026-10-19 17:05
+# The existing descriptions get their first revision, a snapshot of what they are now
+
+from django.db import migrations, models
+import django.db.models.deletion
+import novelrecorder.compression
+
+BATCH_SIZE = 500
+
+
+# The id of the description for the revision's: unique across the shards like the ids they allocate after it.
+def createFirstRevisions(apps, schema_editor):
+    Description = apps.get_model('novelrecorder', 'Description')
+    DescriptionRevision = apps.get_model('novelrecorder', 'DescriptionRevision')
+    descriptions = Description.objects.using(schema_editor.connection.alias).only('id', 'title', 'blob').order_by('id')
+    last_id = 0
+    while True:
+        batch = list(descriptions.filter(id__gt=last_id)[:BATCH_SIZE])
+        if not batch:
+            break
+        DescriptionRevision.objects.using(schema_editor.connection.alias).bulk_create([
+            DescriptionRevision(id=description.id, description_id=description.id, number=1, title=description.title,
+                                is_snapshot=True, blob_id=description.blob_id) for description in batch])
+        last_id = batch[-1].id
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('novelrecorder', '0011_descriptionblob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DescriptionRevision',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('number', models.PositiveIntegerField()),
+                ('title', models.CharField(max_length=200)),
+                ('is_snapshot', models.BooleanField(default=False)),
+                ('delta', novelrecorder.compression.CompressedTextField(blank=True, null=True)),
+                ('time_created', models.DateTimeField(auto_now_add=True)),
+                ('blob', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, to='novelrecorder.DescriptionBlob')),
+                ('description', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='revisions', to='novelrecorder.Description')),
+            ],
+            options={
+                'ordering': ['-number'],
+                'unique_together': {('description', 'number')},
+            },
+        ),
+        migrations.RunPython(createFirstRevisions, migrations.RunPython.noop),
+    ]
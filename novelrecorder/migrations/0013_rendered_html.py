@@ -0,0 +1,51 @@
+# Generated by Django 2.2.6 on 2026-10-19 17:48
+# The excerpts of the existing descriptions are rendered, the blobs are by manage.py render_descriptions (or as
+# they are first read)
+
+from django.db import migrations, models
+import novelrecorder.compression
+
+from novelrecorder.models import get_excerpt_html
+
+BATCH_SIZE = 500
+
+
+def renderDescriptionExcerpts(apps, schema_editor):
+    Description = apps.get_model('novelrecorder', 'Description')
+    descriptions = Description.objects.using(schema_editor.connection.alias).select_related('blob') \
+        .only('id', 'blob__content').order_by('id')
+    last_id = 0
+    while True:
+        batch = list(descriptions.filter(id__gt=last_id)[:BATCH_SIZE])
+        if not batch:
+            break
+        for description in batch:
+            description.excerpt_html = get_excerpt_html(description.blob.content if description.blob_id else None)
+        Description.objects.using(schema_editor.connection.alias).bulk_update(batch, ['excerpt_html'])
+        last_id = batch[-1].id
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('novelrecorder', '0012_descriptionrevision'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='description',
+            name='excerpt_html',
+            field=models.TextField(blank=True, default=''),
+        ),
+        migrations.AddField(
+            model_name='descriptionblob',
+            name='html',
+            field=novelrecorder.compression.CompressedTextField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='descriptionblob',
+            name='html_version',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.RunPython(renderDescriptionExcerpts, migrations.RunPython.noop),
+    ]
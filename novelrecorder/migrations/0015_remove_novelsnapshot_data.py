@@ -0,0 +1,17 @@
+# Generated by Django 2.2.6 on 2026-10-19 09:12
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('novelrecorder', '0014_job'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='novelsnapshot',
+            name='data',
+        ),
+    ]
@@ -1,10 +1,19 @@
-from django.db import models
-from django.db.models.signals import post_save
+import hashlib
+import secrets
+from collections import Counter
+
+from django.db import models, router
+from django.db.models import Case, Count, F, OuterRef, Q, Subquery, Value, When
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+from django.utils.safestring import mark_safe
+from django.core.cache import cache
+from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
 from django.contrib.auth.models import AbstractUser
 from django.conf import settings
 
-from novelrecorder import constants
+from novelrecorder import caching, compression, constants, rendering
 
 from novelrecorder.yd_exceptions import DataErrorException
 
@@ -25,6 +34,10 @@ class CustomNovelModel(CustomModel):
     def getNovel(self):  # Maybe an interface instead at some stage.
         raise NotImplementedError("getNovel is not implemented for class " + self.__class__.__name__)
 
+    # The same without loading the novel - the shard key, see novelrecorder.sharding.
+    def getNovelId(self):
+        raise NotImplementedError("getNovelId is not implemented for class " + self.__class__.__name__)
+
     def isDescription(self):
         return False
 
@@ -33,13 +46,18 @@ class CustomNovelModel(CustomModel):
 
 
 class Novel(CustomNovelModel):
-    author = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.PROTECT, related_name='novel_author')
+    # The users only live in 'default', the foreign keys to them can't be constraints on the shards.
+    author = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.PROTECT, related_name='novel_author',
+                               db_constraint=False)
     name = models.CharField(max_length=200)
     is_public = models.BooleanField(default=True)
+    change_seq = models.PositiveIntegerField(default=0)  # The seq of the latest NovelChange - see novelrecorder.changelog
+    shard = models.CharField(max_length=50, default='default')  # The database of its content - see novelrecorder.sharding
 
     class Meta:
         ordering = ['name']
         unique_together = ['author', 'name']
+        indexes = [models.Index(fields=['is_public', 'name'], name='nr_novel_public_name_idx')]  # The public list
 
     def __str__(self):
         return self.name
@@ -47,6 +65,9 @@ class Novel(CustomNovelModel):
     def getNovel(self):
         return self
 
+    def getNovelId(self):
+        return self.pk
+
 
 class Character(CustomNovelModel):
     name = models.CharField(max_length=200)
@@ -62,17 +83,24 @@ class Character(CustomNovelModel):
     def getNovel(self):
         return self.novel
 
+    def getNovelId(self):
+        return self.novel_id
+
     def getPrimaryDescription(self):
-        return Description.objects.filter(character=self).order_by('sort_order')[0]
+        # Uses the prefetched descriptions if there are (ordered by sort_order by default).
+        return self.description_set.all()[0]
 
 
 class Relationship(CustomNovelModel):
     character1 = models.ForeignKey(Character, on_delete=models.PROTECT, related_name='relationship_character1')
-    character2 = models.ForeignKey(Character, on_delete=models.PROTECT, related_name='relationship_character2')
+    character2 = models.ForeignKey(Character, on_delete=models.PROTECT, related_name='relationship_character2',
+                                   db_index=False)  # Indexed by nr_rel_character2_idx
 
     class Meta:
         ordering = ['character1', 'character2']
         unique_together = ['character1', 'character2']
+        # The relationships to a character, covering the other end (the index of unique_together is the other way)
+        indexes = [models.Index(fields=['character2', 'character1'], name='nr_rel_character2_idx')]
 
     def __str__(self):
         return self.character1.__str__() + " -> " + self.character2.__str__()
@@ -80,18 +108,206 @@ class Relationship(CustomNovelModel):
     def getNovel(self):
         return self.character1.getNovel()
 
+    def getNovelId(self):
+        return self.character1.novel_id
+
     def getPrimaryDescription(self):
-        return Description.objects.filter(relationship=self).order_by('sort_order')[0]
+        return self.description_set.all()[0]
+
+
+# The start of the content of a description, cut at a word where it can be, with an ellipsis if it's cut.
+def get_excerpt(content, length=constants.DESCRIPTION_EXCERPT_LENGTH):
+    content = ' '.join((content or '').split())
+    if len(content) <= length:
+        return content
+    head = content[:length + 1]  # A space right after the cut keeps the last word whole
+    return (head.rsplit(' ', 1)[0] if ' ' in head else head[:length]) + '\u2026'
+
+
+def get_word_count(content):
+    return len((content or '').split())
+
+
+# The excerpt of the text without the Markdown marks of its lines, rendered.
+def get_excerpt_html(content):
+    return rendering.render_inline(get_excerpt(rendering.strip_block_marks(content)))
+
+
+# Blobs
+def get_blob_hash(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class DescriptionBlobManager(models.Manager):
+    # Adds count references to the blob of each hash (removes them if negative, only makes sure the blob is there if
+    # 0) with one UPDATE, first creating the missing blobs from get_missing(hashes), which returns them unsaved.
+    def add_references(self, counts, using, get_missing=None):
+        blobs = self.db_manager(using)
+        remaining = dict(counts)
+        for attempt in range(constants.BLOB_RETAIN_ATTEMPTS):
+            if not remaining:
+                return
+            added = [hash for hash, count in remaining.items() if count >= 0]
+            missing = set(added) - set(blobs.filter(hash__in=added).values_list('hash', flat=True)) if added else set()
+            if missing:
+                if get_missing is None:
+                    raise DataErrorException('The blobs %s are missing.' % ', '.join(sorted(missing)))
+                new_blobs = get_missing(missing)
+                for blob in new_blobs:
+                    blob.ref_count = 0
+                blobs.bulk_create(new_blobs, ignore_conflicts=True)  # Or created meanwhile
+            changed = {hash: count for hash, count in remaining.items() if count}
+            if not changed:
+                return
+            updated = blobs.filter(hash__in=list(changed)).update(ref_count=F('ref_count') + Case(
+                *[When(hash=hash, then=Value(count)) for hash, count in changed.items()],
+                output_field=models.IntegerField()))
+            if updated == len(changed):
+                return
+            # Some were collected in between: created again (those still referred to) by the next attempt
+            present = set(blobs.filter(hash__in=list(remaining)).values_list('hash', flat=True))
+            remaining = {hash: count for hash, count in changed.items() if hash not in present and count > 0}
+        raise DataErrorException('The blobs %s keep being collected.' % ', '.join(sorted(remaining)))
+
+    def retain(self, hashes, using, get_missing=None):
+        self.add_references(Counter(hashes), using, get_missing)
+
+    # Makes sure the blobs are there without referring to them, for the revisions (which don't count).
+    def ensure(self, hashes, using, get_missing=None):
+        self.add_references(dict.fromkeys(hashes, 0), using, get_missing)
+
+    # A reference less per hash (as many as it occurs, or its count if it's a mapping).
+    def release(self, hashes, using):
+        self.add_references({hash: -count for hash, count in Counter(hashes).items()}, using)
+
+    # Deletes the blobs no description or revision refers to. Returns how many.
+    def collect_garbage(self, using):
+        referenced = Description.objects.using(using).filter(blob__isnull=False).values('blob')
+        revisions = DescriptionRevision.objects.using(using).filter(blob__isnull=False).values('blob')
+        return self.db_manager(using).filter(ref_count__lte=0).exclude(hash__in=referenced) \
+            .exclude(hash__in=revisions)._raw_delete(using)
+
+    # Adds the references of the descriptions of the queryset (to blobs that are there), or removes them if sign is
+    # -1, with one UPDATE - however many descriptions.
+    def add_references_of(self, descriptions, using, sign=1):
+        references = descriptions.filter(blob=OuterRef('pk')).order_by().values('blob') \
+            .annotate(count=Count('pk')).values('count')
+        return self.db_manager(using).filter(hash__in=descriptions.filter(blob__isnull=False).values('blob')) \
+            .update(ref_count=F('ref_count') + sign * Subquery(references))
+
+    def retain_for(self, descriptions, using):
+        return self.add_references_of(descriptions, using)
+
+    def release_for(self, descriptions, using):
+        return self.add_references_of(descriptions, using, -1)
+
+    # Sets the reference counts from the descriptions, e.g. after a write failed in between.
+    def recount(self, using):
+        references = Description.objects.using(using).filter(blob=OuterRef('pk')).order_by().values('blob') \
+            .annotate(count=Count('pk')).values('count')
+        return self.db_manager(using).update(ref_count=Coalesce(Subquery(references), 0))
+
+
+# The text of descriptions, stored once however many descriptions have it (across characters and novels):
+# Description.content is read from and written to the blob of its hash. The blobs live with the descriptions
+# (on their shard) and count the descriptions referring to them - the ones down to none are deleted by
+# collect_garbage() (manage.py collect_blobs), not straight away, so a concurrent write can still take them up.
+# The snapshot revisions refer to them too, without counting: a blob is kept while any does.
+# The HTML of the text (as Markdown) is kept with it, rendered once per text - see novelrecorder.rendering.
+class DescriptionBlob(CustomModel):
+    hash = models.CharField(max_length=64, primary_key=True)  # SHA-256 of the text
+    content = compression.CompressedTextField()  # Compressed if long, see novelrecorder.compression
+    html = compression.CompressedTextField(null=True, blank=True)
+    html_version = models.PositiveSmallIntegerField(default=0)  # The rendering.RENDERER_VERSION of html
+    ref_count = models.IntegerField(default=0)
+    time_created = models.DateTimeField(auto_now_add=True)
+
+    objects = DescriptionBlobManager()
+
+    @staticmethod
+    def create_rendered(hash, content):
+        return DescriptionBlob(hash=hash, content=content, html=rendering.render_markdown(content),
+                               html_version=rendering.RENDERER_VERSION)
+
+    # Rendered (and stored) if it wasn't, or by an older version of the renderer.
+    def get_html(self):
+        if self.html is None or self.html_version != rendering.RENDERER_VERSION:
+            self.html, self.html_version = rendering.render_markdown(self.content), rendering.RENDERER_VERSION
+            DescriptionBlob.objects.using(router.db_for_write(DescriptionBlob, instance=self)).filter(hash=self.hash).update(
+                html=self.html, html_version=self.html_version)
+        return mark_safe(self.html)
 
 
 class Description(CustomNovelModel):
     class Meta:
         ordering = ['sort_order']
+        # The descriptions of a character or a relationship in order, and their primary descriptions alone.
+        # See benchmarks.query_plans for the queries these are for.
+        indexes = [
+            models.Index(fields=['character', 'sort_order'], name='nr_desc_character_order_idx'),
+            models.Index(fields=['relationship', 'sort_order'], name='nr_desc_relationship_order_idx'),
+            models.Index(fields=['character'], name='nr_desc_character_primary_idx', condition=Q(is_primary=True)),
+            models.Index(fields=['relationship'], name='nr_desc_rel_primary_idx', condition=Q(is_primary=True)),
+        ]
 
     def create(self, **obj_data):
         obj_data['sort_order'] = obj_data['id']
         return super().create(**obj_data)
 
+    # The text is in the blob (shared by the descriptions with the same text), until a new one is saved.
+    @property
+    def content(self):
+        if '_content' in self.__dict__:
+            return self._content
+        return self.blob.content if self.blob_id is not None else None
+
+    @content.setter
+    def content(self, value):
+        self._content = value
+
+    @property
+    def content_html(self):
+        if '_content' in self.__dict__:  # Not saved yet
+            return mark_safe(rendering.render_markdown(self._content))
+        return self.blob.get_html() if self.blob_id is not None else ''
+
+    def save(self, *args, **kwargs):
+        if '_content' in self.__dict__:
+            Description.save_contents([self], kwargs.get('using') or router.db_for_write(Description, instance=self))
+            update_fields = kwargs.get('update_fields')
+            if update_fields is not None and 'content' in update_fields:
+                kwargs['update_fields'] = (set(update_fields) - {'content'}) | {'blob', 'excerpt', 'excerpt_html',
+                                                                                  'word_count'}
+        super().save(*args, **kwargs)
+
+    # Points the descriptions with a new content at its blob (and the excerpt and word count, kept so the lists can
+    # show them without loading it), before they are saved - for the bulk writes, which don't go through save().
+    # A new blob is rendered as it's created.
+    @staticmethod
+    def save_contents(descriptions, using):
+        texts = {}
+        references = Counter()
+        for description in descriptions:
+            if '_content' not in description.__dict__:
+                continue
+            text = description.__dict__.pop('_content')
+            if description.blob_id is not None:
+                references[description.blob_id] -= 1
+            if text is None:
+                description.blob = None
+            else:
+                blob = DescriptionBlob(hash=get_blob_hash(text), content=text)
+                blob._state.adding, blob._state.db = False, using
+                description.blob = blob  # What the content is read from
+                texts[blob.hash] = text
+                references[blob.hash] += 1
+            description.excerpt = get_excerpt(text)
+            description.excerpt_html = get_excerpt_html(text)
+            description.word_count = get_word_count(text)
+        references = {hash: count for hash, count in references.items() if count}
+        DescriptionBlob.objects.add_references(references, using, lambda missing: [
+            DescriptionBlob.create_rendered(hash, texts[hash]) for hash in missing])
+
     def default_is_primary(self):
         return ((self.character is not None) and Description.objects.filter(
                 character=self.character).first().id == self.id) or (
@@ -99,11 +315,16 @@ class Description(CustomNovelModel):
                 relationship=self.relationship).first().id == self.id)
 
 
-    character = models.ForeignKey(Character, null=True, blank=True, on_delete=models.CASCADE)
-    relationship = models.ForeignKey(Relationship, null=True, blank=True, on_delete=models.CASCADE)
-    author = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.PROTECT, related_name='description_author')
+    # Indexed by the Meta.indexes starting with them
+    character = models.ForeignKey(Character, null=True, blank=True, on_delete=models.CASCADE, db_index=False)
+    relationship = models.ForeignKey(Relationship, null=True, blank=True, on_delete=models.CASCADE, db_index=False)
+    author = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.PROTECT, related_name='description_author',
+                               db_constraint=False)
     title = models.CharField(max_length=200)
-    content = models.TextField(null=True, blank=True)
+    blob = models.ForeignKey(DescriptionBlob, null=True, blank=True, on_delete=models.PROTECT)  # The content
+    excerpt = models.CharField(max_length=constants.DESCRIPTION_EXCERPT_LENGTH + 1, blank=True, default='')
+    excerpt_html = models.TextField(blank=True, default='')  # Rendered from the excerpt of the Markdown
+    word_count = models.PositiveIntegerField(default=0)
     sort_order = models.IntegerField(default=0)  # initialise as id on creation - see create function
     time_created = models.DateTimeField(auto_now_add=True)
     time_modified = models.DateTimeField(auto_now=True)
@@ -123,6 +344,9 @@ class Description(CustomNovelModel):
     def getNovel(self):
         return self.getOwner().getNovel()
 
+    def getNovelId(self):
+        return self.getOwner().getNovelId()
+
     def isDescription(self):
         return True
 
@@ -142,20 +366,201 @@ def descriptionAfterSave(sender, instance, created, **kwargs):
             instance.save()
 
 
+@receiver(post_delete, sender=Description, dispatch_uid="release_description_blob")
+def releaseDescriptionBlob(sender, instance, using, **kwargs):
+    if instance.blob_id is not None:
+        DescriptionBlob.objects.release([instance.blob_id], using)
+
+
+# A version of a description (its title and content), numbered from 1 - see novelrecorder.revisions. Every
+# DESCRIPTION_REVISION_SNAPSHOT_INTERVAL-th one from the first is a snapshot, which refers to the blob of its
+# content (the description's at the time, so it costs nothing more), the others keep the delta from the one before.
+class DescriptionRevision(CustomNovelModel):
+    class Meta:
+        ordering = ['-number']
+        unique_together = [('description', 'number')]
+
+    description = models.ForeignKey(Description, on_delete=models.CASCADE, related_name='revisions')
+    number = models.PositiveIntegerField()
+    title = models.CharField(max_length=200)
+    is_snapshot = models.BooleanField(default=False)
+    blob = models.ForeignKey(DescriptionBlob, null=True, blank=True, on_delete=models.PROTECT)  # Of a snapshot
+    delta = compression.CompressedTextField(null=True, blank=True)  # Of the others, see revisions.get_delta
+    time_created = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return '%s (%s)' % (self.title, self.number)
+
+    def getNovel(self):
+        return self.description.getNovel()
+
+    def getNovelId(self):
+        return self.description.getNovelId()
+
+
 
 # INTEGRITY INFO
 # One and only one of the foreign keys be not null.
 
 class NovelUserPermissionModel(CustomNovelModel):
-    novel = models.ForeignKey(Novel, on_delete=models.CASCADE)
-    user = models.ForeignKey(NovelUser, on_delete=models.CASCADE)
+    novel = models.ForeignKey(Novel, on_delete=models.CASCADE, db_index=False)  # Indexed by the Meta.indexes
+    user = models.ForeignKey(NovelUser, on_delete=models.CASCADE, db_constraint=False, db_index=False)
     permission = models.IntegerField(default=constants.NUP_MINIMAL)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['novel', 'user'], name='nr_nup_novel_user_idx'),  # The permission of a user
+            # The novels a user is granted, covered (permissions.readable_filter)
+            models.Index(fields=['user', 'permission', 'novel'], name='nr_nup_user_permission_idx'),
+        ]
+
+    # The novel and the user as loaded, whose cached permissions a save moving the permission invalidates too
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance.loaded_ids = (instance.__dict__.get('novel_id'), instance.__dict__.get('user_id'))
+        return instance
+
     def getNovel(self):
         return self.novel
+
+    def getNovelId(self):
+        return self.novel_id
+
+    # The namespaces of the cached permissions (see novelrecorder.caching) of a novel and of a user
+    @staticmethod
+    def get_novel_namespace(novel_id):
+        return 'novelrecorder_novel_permissions:%s' % novel_id
+
+    @staticmethod
+    def get_user_namespace(user_id):
+        return 'novelrecorder_user_permissions:%s' % user_id
     # TODO: Don't think the co-editor should be able to edit this (and potentially deleting the novel), but just let them to be able to ANYTHING for now.
 
 
+@receiver(post_save, sender=NovelUserPermissionModel, dispatch_uid="invalidate_permission_cache_on_save")
+@receiver(post_delete, sender=NovelUserPermissionModel, dispatch_uid="invalidate_permission_cache_on_delete")
+def invalidatePermissionCache(sender, instance, **kwargs):
+    loaded_novel_id, loaded_user_id = getattr(instance, 'loaded_ids', (None, None))
+    for novel_id in {instance.novel_id, loaded_novel_id} - {None}:
+        caching.invalidate_namespace(NovelUserPermissionModel.get_novel_namespace(novel_id))
+    for user_id in {instance.user_id, loaded_user_id} - {None}:
+        caching.invalidate_namespace(NovelUserPermissionModel.get_user_namespace(user_id))
+    instance.loaded_ids = (instance.novel_id, instance.user_id)
+
+
+# Change log
+# Every create/update/delete of a novel's characters, relationships, descriptions and permissions, numbered per
+# novel, for clients to sync incrementally. Written by novelrecorder.changelog in the transaction of the change.
+class NovelChange(CustomModel):
+    novel = models.ForeignKey(Novel, on_delete=models.CASCADE, related_name='changes')
+    seq = models.PositiveIntegerField()
+    object_type = models.CharField(max_length=20)
+    object_id = models.PositiveIntegerField()
+    action = models.CharField(max_length=10)
+    data = models.TextField(null=True, blank=True)  # JSON of the object after the change, null for a delete
+    time_created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['seq']
+        unique_together = ['novel', 'seq']
+
+
+# Where the change log was compacted: the changes up to compacted_seq have been deleted (when the novel was at seq),
+# so a client behind it syncs from the snapshot pages (novelrecorder.changelog.get_snapshot_page) instead.
+class NovelSnapshot(CustomModel):
+    novel = models.ForeignKey(Novel, on_delete=models.CASCADE, related_name='snapshots')
+    seq = models.PositiveIntegerField()
+    compacted_seq = models.PositiveIntegerField()
+    time_created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['-seq']
+
+
+# Sharding
+# The next id of a sharded model (novelrecorder.sharding.SHARDED_MODELS) not reserved yet, so the ids stay unique
+# across the shards and a novel can be moved between them as it is. Only used in 'default'.
+class ShardIdBlock(CustomModel):
+    model_label = models.CharField(max_length=100, primary_key=True)
+    next_id = models.BigIntegerField()
+
+
+# Background jobs
+# The queue of novelrecorder.jobs: expensive work requested by a user or a command and run by manage.py runworker
+# rather than in the request. Only used in 'default'.
+class Job(CustomModel):
+    name = models.CharField(max_length=100)  # Of the task, see jobs.task
+    args = models.TextField(default='{}')  # JSON of the keyword arguments of the task
+    user = models.ForeignKey(NovelUser, on_delete=models.SET_NULL, null=True, blank=True, related_name='jobs')
+    status = models.CharField(max_length=10, default=constants.JOB_QUEUED)
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField(default=constants.JOB_MAX_ATTEMPTS)
+    run_after = models.DateTimeField(default=timezone.now)
+    locked_by = models.CharField(max_length=100, blank=True, default='')  # The worker running it
+    locked_until = models.DateTimeField(null=True, blank=True)  # Another worker can take it from then, see jobs.claim
+    progress = models.FloatField(default=0)  # From 0 to 1
+    progress_message = models.CharField(max_length=200, blank=True, default='')
+    result = models.TextField(null=True, blank=True)  # JSON of what the task returned
+    error = models.TextField(null=True, blank=True)  # The traceback of the last run that raised
+    time_created = models.DateTimeField(auto_now_add=True)
+    time_started = models.DateTimeField(null=True, blank=True)
+    time_finished = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'run_after'], name='nr_job_status_run_after_idx'),  # The jobs to claim
+        ]
+
+    def __str__(self):
+        return '%s #%s (%s)' % (self.name, self.pk, self.status)
+
+
+# API tokens
+# Only the SHA-256 of the key is stored: the keys are random so a slow hash (like the passwords' PBKDF2) isn't
+# needed, which is what makes the token authentication cheap - see novelrecorder.authentication.
+class NovelUserToken(CustomModel):
+    user = models.ForeignKey(NovelUser, on_delete=models.CASCADE, related_name='tokens')
+    name = models.CharField(max_length=200)
+    key_prefix = models.CharField(max_length=8)  # To tell the tokens apart, as the key isn't stored
+    key_hash = models.CharField(max_length=64, unique=True)
+    scopes = models.CharField(max_length=200, default=constants.TOKEN_SCOPE_READ)  # Space separated
+    time_created = models.DateTimeField(auto_now_add=True)
+    time_revoked = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return '%s (%s...)' % (self.name, self.key_prefix)
+
+    @staticmethod
+    def hash_key(key):
+        return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def get_cache_key(key_hash):
+        return 'novelrecorder_token:' + key_hash
+
+    @classmethod
+    def create_token(cls, user, name, scopes):
+        # Returns the key as well, as it can't be recovered afterwards.
+        key = secrets.token_urlsafe(32)
+        token = cls.objects.create(user=user, name=name, key_prefix=key[:8], key_hash=cls.hash_key(key),
+                                   scopes=' '.join(scopes))
+        return token, key
+
+    def get_scopes(self):
+        return self.scopes.split()
+
+    def revoke(self):
+        self.time_revoked = timezone.now()
+        self.save()
+
+
+@receiver(post_save, sender=NovelUserToken, dispatch_uid="invalidate_token_cache_on_save")
+@receiver(post_delete, sender=NovelUserToken, dispatch_uid="invalidate_token_cache_on_delete")
+def invalidateTokenCache(sender, instance, **kwargs):
+    cache.delete(NovelUserToken.get_cache_key(instance.key_hash))
+
+
 # class Alias
 
 # Singletons
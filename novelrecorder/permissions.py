@@ -1,10 +1,15 @@
 from annoying.functions import get_object_or_None
 from django.contrib.auth.models import AbstractUser
+from django.core.cache import cache
+from django.db.models import Q
 from rest_framework import permissions
 from rest_framework.request import Request
 
-from novelrecorder.constants import NUP_MINIMAL, NUP_VIEW_ONLY, NUP_DESCRIPTION_ONLY, NUP_COEDITOR
-from novelrecorder.models import CustomNovelModel, NovelUserPermissionModel
+from novelrecorder import caching, metrics, sharding
+from novelrecorder.constants import NUP_MINIMAL, NUP_VIEW_ONLY, NUP_DESCRIPTION_ONLY, NUP_COEDITOR, \
+    TOKEN_SCOPE_READ, TOKEN_SCOPE_WRITE, PERMISSION_CACHE_SECONDS
+
+from novelrecorder.models import CustomNovelModel, NovelUserPermissionModel, Novel
 
 
 class NovelUserPermission(permissions.BasePermission):
@@ -14,7 +19,35 @@ class NovelUserPermission(permissions.BasePermission):
     # That's enough for now, only when the permission settings get more involved
     # another PermissionGroup -> Permission model would be needed.
     # Also note currently assuming permissionGroups are in order, so inequalities are used for deciding permissions.
-    def custom_has_object_permission(self, user: AbstractUser, requiresWritePermission: bool, novelObj: CustomNovelModel) -> bool:
+    # permissionGroup can be passed in (see get_permission_group) when checking many objects of one novel.
+    def custom_has_object_permission(self, user: AbstractUser, requiresWritePermission: bool, novelObj: CustomNovelModel,
+                                     permissionGroup=None) -> bool:
+        allowed = self.resolve_object_permission(user, requiresWritePermission, novelObj, permissionGroup)
+        metrics.inc('novelrecorder_permission_checks_total', {'result': 'allowed' if allowed else 'denied'})
+        return allowed
+
+    # Cached in the namespace of the novel's permissions, which a change of any of them invalidates.
+    def get_permission_group(self, user: AbstractUser, novel) -> int:
+        if user.is_anonymous:
+            return NUP_MINIMAL  # Quite annoying, have to do this or exception.
+            # Could have better way to handle? If it's only here doesn't matter, otherwise need something.
+        cache_key = caching.get_namespaced_key(NovelUserPermissionModel.get_novel_namespace(novel.pk), user.pk)
+        permissionGroup = cache.get(cache_key)
+        metrics.record_cache_lookup('permission', permissionGroup is not None)
+        if permissionGroup is None:
+            # On the shard of the novel, whichever shard the request is on
+            permissionObj = get_object_or_None(NovelUserPermissionModel.objects.using(sharding.db_for_novel(novel)),
+                                               novel=novel, user=user)
+            permissionGroup = permissionObj.permission if permissionObj else NUP_MINIMAL
+            cache.set(cache_key, permissionGroup, PERMISSION_CACHE_SECONDS)
+        return permissionGroup
+
+    # Whether the user sees and may change who is granted what on the novel: staff, its author and its co-editors.
+    def may_manage_permissions(self, user: AbstractUser, novel) -> bool:
+        return user.is_staff or novel.author_id == user.pk or self.get_permission_group(user, novel) == NUP_COEDITOR
+
+    def resolve_object_permission(self, user: AbstractUser, requiresWritePermission: bool, novelObj: CustomNovelModel,
+                                  permissionGroup=None) -> bool:
         assert isinstance(novelObj, CustomNovelModel), 'NovelUserPermission.custom_has_object_permission ' \
                                                        'called with novelObj parameter being a %s rather than ' \
                                                        'a novel object' % novelObj.__class__.__name__
@@ -23,22 +56,15 @@ class NovelUserPermission(permissions.BasePermission):
                                               'are you trying to call has_object_permission instead?'
 
         novel = novelObj.getNovel()
-        if user.is_anonymous:
-            permissionGroup = NUP_MINIMAL  # Quite annoying, have to do this or exception.
-            # Could have better way to handle? If it's only here doesn't matter, otherwise need something.
-        else:
-            permissionObj = get_object_or_None(NovelUserPermissionModel, novel=novel, user=user)
-            if not permissionObj:
-                permissionGroup = NUP_MINIMAL
-            else:
-                permissionGroup = permissionObj.permission
+        if permissionGroup is None:
+            permissionGroup = self.get_permission_group(user, novel)
 
         # For superuser
         if user.is_staff:
             return True
 
         # All allowed if author
-        if novel.author == user:
+        if novel.author_id == user.pk:
             return True
 
         # Allow read-only permission either the novel is public or the user has been granted enough permission
@@ -47,7 +73,7 @@ class NovelUserPermission(permissions.BasePermission):
 
         # For modify permissions of descriptions, allow if author or enough permission
         # TODO: This should allow only creating a new description and any modification if author
-        if novelObj.isDescription() and ((novelObj.author == user) or (permissionGroup >= NUP_DESCRIPTION_ONLY)):
+        if novelObj.isDescription() and ((novelObj.author_id == user.pk) or (permissionGroup >= NUP_DESCRIPTION_ONLY)):
             return True
 
         # All allowed for co-editor for now
@@ -56,8 +82,66 @@ class NovelUserPermission(permissions.BasePermission):
 
         return False
 
+    # Token authenticated requests are further limited to the scopes of the token.
+    def has_permission(self, request, view):
+        if not hasattr(request.auth, 'has_scope'):
+            return True
+        return request.auth.has_scope(TOKEN_SCOPE_READ if request.method in permissions.SAFE_METHODS else TOKEN_SCOPE_WRITE)
+
     def has_object_permission(self, request, view, obj):
         assert not isinstance(request, AbstractUser), 'NovelUserPermission.has_object_permission ' \
                                               'called with request parameter being a User -- ' \
                                               'are you trying to call custom_has_object_permission instead?'
-        return self.custom_has_object_permission(request.user, not request.method in permissions.SAFE_METHODS, obj)
\ No newline at end of file
+        return self.custom_has_object_permission(request.user, not request.method in permissions.SAFE_METHODS, obj)
+
+
+# The ids of the novels the user can read, as a subquery, to filter lists by what
+# custom_has_object_permission would allow for reading. Without shards only, see readable_filter.
+def readable_novel_ids(user: AbstractUser):
+    novels = Novel.objects.all()
+    if user.is_anonymous:
+        novels = novels.filter(is_public=True)
+    elif not user.is_staff:
+        granted = NovelUserPermissionModel.objects.filter(user=user, permission__gte=NUP_VIEW_ONLY)
+        novels = novels.filter(Q(is_public=True) | Q(author=user) | Q(id__in=granted.values('novel_id')))
+    return novels.values('id')
+
+
+# The filter of a list of the model whose novel is at novel_lookup ('id' for the novels) to what the user can read.
+# With shards, the content of the novels is filtered on its shard through the copies of the novels and the permissions
+# there, and the novels (in 'default', away from the permissions) by the ids granted to the user, from every shard -
+# cached in the namespace of the user's permissions.
+def readable_filter(user: AbstractUser, novel_lookup):
+    if not sharding.is_enabled():
+        return Q(**{'%s__in' % novel_lookup: readable_novel_ids(user)})
+    if user.is_staff:
+        return Q()
+    prefix = '' if novel_lookup == 'id' else novel_lookup + '__'
+    readable = Q(**{prefix + 'is_public': True})
+    if user.is_anonymous:
+        return readable
+    granted = NovelUserPermissionModel.objects.filter(user=user, permission__gte=NUP_VIEW_ONLY)
+    granted_ids = get_granted_novel_ids(user, granted) if novel_lookup == 'id' else granted.values('novel_id')
+    return readable | Q(**{prefix + 'author': user}) | Q(**{'%s__in' % novel_lookup: granted_ids})
+
+
+# The filter of the permissions to the ones the user sees: the ones of the novels they manage (see
+# may_manage_permissions), and their own.
+def visible_permissions_filter(user: AbstractUser):
+    if user.is_staff:
+        return Q()
+    if user.is_anonymous:
+        return Q(pk__in=[])
+    managed = NovelUserPermissionModel.objects.filter(user=user, permission=NUP_COEDITOR).values('novel_id')
+    return Q(user=user) | Q(novel__author=user) | Q(novel__in=managed)
+
+
+def get_granted_novel_ids(user: AbstractUser, granted):
+    cache_key = caching.get_namespaced_key(NovelUserPermissionModel.get_user_namespace(user.pk), 'granted')
+    granted_ids = cache.get(cache_key)
+    metrics.record_cache_lookup('granted_novels', granted_ids is not None)
+    if granted_ids is None:
+        granted_ids = [novel_id for alias in sharding.get_shards()
+                       for novel_id in granted.using(alias).values_list('novel_id', flat=True)]
+        cache.set(cache_key, granted_ids, PERMISSION_CACHE_SECONDS)
+    return granted_ids
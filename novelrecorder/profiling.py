@@ -0,0 +1,154 @@
+import cProfile
+import json
+import os
+import pstats
+import random
+import time
+import uuid
+
+from django.conf import settings
+from django.core import signing
+
+PROFILE_HEADER = 'HTTP_X_NOVELRECORDER_PROFILE'
+PROFILE_TOKEN_SALT = 'novelrecorder.profiling'
+
+DEFAULT_PROFILER_SETTINGS = {
+    'ENABLED': False,  # Profile a sampled fraction of the requests without the header
+    'SAMPLE_RATE': 0.01,
+    'DIRECTORY': os.path.join(settings.BASE_DIR, 'profiles'),
+    'MAX_PROFILES': 200,  # Oldest profiles are removed beyond this
+    'TOKEN_MAX_AGE': 60 * 60 * 24,  # In seconds
+}
+
+
+def get_profiler_setting(key):
+    return getattr(settings, 'PROFILER', {}).get(key, DEFAULT_PROFILER_SETTINGS[key])
+
+
+# The header value is a signed token, so that anyone can't make the server profile their requests.
+def make_profile_token():
+    return signing.dumps('profile', salt=PROFILE_TOKEN_SALT)
+
+
+def is_valid_profile_token(token):
+    try:
+        return signing.loads(token, salt=PROFILE_TOKEN_SALT, max_age=get_profiler_setting('TOKEN_MAX_AGE')) == 'profile'
+    except signing.BadSignature:
+        return False
+
+
+def should_profile(request):
+    token = request.META.get(PROFILE_HEADER)
+    if token:
+        return is_valid_profile_token(token)
+    return get_profiler_setting('ENABLED') and random.random() < get_profiler_setting('SAMPLE_RATE')
+
+
+# Collapsed stacks ("a;b;c <microseconds>" per line) for flamegraph.pl / speedscope.
+# cProfile only keeps caller -> callee edges, not full stacks, so the time of a callee is split
+# among its callers in proportion to the time spent through each edge.
+# Paths taking less than min_fraction of the total time are dropped to keep the output (and the walk) bounded.
+def to_collapsed_stacks(stats: pstats.Stats, max_depth=64, min_fraction=0.001):
+    callees = {}
+    for func, (cc, nc, tt, ct, callers) in stats.stats.items():
+        for caller, edge in callers.items():
+            callees.setdefault(caller, {})[func] = edge
+    roots = [func for func, entry in stats.stats.items() if not entry[4]]
+    min_time = max(sum(stats.stats[root][3] for root in roots) * min_fraction, 0.000001)
+    lines = {}
+
+    def label(func):
+        filename, line, name = func
+        return '%s (%s:%s)' % (name, os.path.basename(filename), line)
+
+    def walk(func, stack, stack_funcs, scale):
+        stack = stack + [label(func)]
+        key = ';'.join(stack)
+        lines[key] = lines.get(key, 0) + stats.stats[func][2] * scale
+        if len(stack) >= max_depth:
+            return
+        for callee, edge in callees.get(func, {}).items():
+            callee_ct = stats.stats[callee][3]
+            if callee in stack_funcs or not callee_ct or edge[3] * scale < min_time:
+                continue
+            walk(callee, stack, stack_funcs | {callee}, scale * edge[3] / callee_ct)
+
+    for root in roots:
+        walk(root, [], {root}, 1.0)
+    return '\n'.join('%s %d' % (key, value * 1000000) for key, value in lines.items() if value * 1000000 >= 1)
+
+
+def write_profile(profiler: cProfile.Profile, meta: dict):
+    directory = get_profiler_setting('DIRECTORY')
+    os.makedirs(directory, exist_ok=True)
+    profile_id = '%d-%s' % (time.time() * 1000, uuid.uuid4().hex[:8])
+    profiler.dump_stats(os.path.join(directory, profile_id + '.prof'))
+    with open(os.path.join(directory, profile_id + '.collapsed'), 'w') as f:
+        f.write(to_collapsed_stacks(pstats.Stats(profiler)))
+    meta = dict(meta, id=profile_id)
+    with open(os.path.join(directory, profile_id + '.json'), 'w') as f:
+        json.dump(meta, f)
+    prune_profiles()
+    return profile_id
+
+
+def list_profiles():
+    directory = get_profiler_setting('DIRECTORY')
+    if not os.path.isdir(directory):
+        return []
+    profiles = []
+    for filename in os.listdir(directory):
+        if filename.endswith('.json'):
+            try:
+                with open(os.path.join(directory, filename)) as f:
+                    profiles.append(json.load(f))
+            except (OSError, ValueError):
+                pass  # Being written or pruned by another worker
+    return profiles
+
+
+def prune_profiles():
+    profiles = sorted(list_profiles(), key=lambda p: p['id'])
+    directory = get_profiler_setting('DIRECTORY')
+    for profile in profiles[:max(0, len(profiles) - get_profiler_setting('MAX_PROFILES'))]:
+        for extension in ['.json', '.prof', '.collapsed']:
+            try:
+                os.remove(os.path.join(directory, profile['id'] + extension))
+            except OSError:
+                pass
+
+
+# Profiles the novelrecorder views (including the template rendering) of the requests chosen by should_profile().
+# Everything is decided per request, so it can be switched on with the header without restarting the workers.
+class ProfilingMiddleware(object):
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        request.novelrecorder_profiler = None
+        try:
+            response = self.get_response(request)
+        finally:
+            if request.novelrecorder_profiler:
+                request.novelrecorder_profiler.disable()
+        profiler = request.novelrecorder_profiler
+        if profiler:
+            duration = time.perf_counter() - request.novelrecorder_profile_start
+            view_func = request.resolver_match.func
+            write_profile(profiler, {
+                'method': request.method,
+                'path': request.path,
+                'url_name': request.resolver_match.view_name,
+                'view': getattr(getattr(view_func, 'view_class', view_func), '__name__', None),
+                'status': response.status_code,
+                'duration_ms': round(duration * 1000, 2),
+                'time': time.time(),
+            })
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if request.resolver_match.namespace == 'novelrecorder' and should_profile(request):
+            request.novelrecorder_profile_start = time.perf_counter()
+            request.novelrecorder_profiler = cProfile.Profile()
+            request.novelrecorder_profiler.enable()
+        return None
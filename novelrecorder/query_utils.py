@@ -0,0 +1,55 @@
+# Shared helpers for applying the eager loading plans declared on views and serializers.
+import contextvars
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.db import connection, connections, close_old_connections
+
+
+def apply_query_plan(queryset, select_related=(), prefetch_related=(), only=()):
+    if select_related:
+        queryset = queryset.select_related(*select_related)
+    if prefetch_related:
+        queryset = queryset.prefetch_related(*prefetch_related)
+    if only:
+        queryset = queryset.only(*only)
+    return queryset
+
+
+# Runs independent query functions on a thread pool, each with its own connection, so their time adds up to the
+# slowest of them rather than the sum. Each function has to evaluate its querysets itself. Runs them one after
+# another unless settings.CONCURRENT_QUERIES, or inside a transaction whose data the other connections can't see.
+def run_concurrently(*functions):
+    if len(functions) < 2 or not getattr(settings, 'CONCURRENT_QUERIES', False) or connection.in_atomic_block:
+        return [function() for function in functions]
+    # The execute wrappers of this thread (e.g. QueryInstrumentationMiddleware's) see the queries of the pool too, on
+    # every database, and the context variables (e.g. the database routing of db_routers) carry over
+    wrappers = {alias_connection.alias: list(alias_connection.execute_wrappers)
+                for alias_connection in connections.all()}
+    futures = [get_query_executor().submit(contextvars.copy_context().run, _run_with_wrappers, function, wrappers)
+               for function in functions]
+    return [future.result() for future in futures]
+
+
+_query_executor = None
+_query_executor_lock = threading.Lock()
+
+
+def get_query_executor():
+    global _query_executor
+    with _query_executor_lock:
+        if _query_executor is None:
+            _query_executor = ThreadPoolExecutor(max_workers=getattr(settings, 'CONCURRENT_QUERY_THREADS', 8),
+                                                 thread_name_prefix='novelrecorder-query')
+        return _query_executor
+
+
+def _run_with_wrappers(function, wrappers):
+    close_old_connections()  # What a request would do for the pool thread's connection
+    with ExitStack() as stack:
+        for alias, alias_wrappers in wrappers.items():
+            for wrapper in alias_wrappers:
+                stack.enter_context(connections[alias].execute_wrapper(wrapper))
+        return function()
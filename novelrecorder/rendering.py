@@ -0,0 +1,154 @@
+import html
+import re
+
+# The Markdown of the descriptions: headings, paragraphs (a line break in one is kept), block quotes, lists, code
+# blocks, rules, and inline code, strong and emphasised text and links. Whatever the author writes is escaped, so
+# none of their HTML gets through, and links only take http(s) and mailto URLs.
+#
+# What's rendered is stored (DescriptionBlob.html, Description.excerpt_html) rather than rendered per request, with
+# RENDERER_VERSION: changing how something renders means bumping it, and the HTML of an older version is rendered
+# again on its next read (or by manage.py render_descriptions).
+
+RENDERER_VERSION = 1
+
+FENCE = re.compile(r'^ {0,3}(```|~~~)')
+HEADING = re.compile(r'^ {0,3}(#{1,6})\s+(.*?)(?:\s+#+)?\s*$')
+RULE = re.compile(r'^ {0,3}([-*_])(?: *\1){2,} *$')
+QUOTE = re.compile(r'^ {0,3}> ?(.*)$')
+QUOTE_MAX_DEPTH = 20  # Block quotes nested deeper are left as the text of the deepest one
+LIST_ITEMS = {
+    'ul': re.compile(r'^ {0,3}[-*+]\s+(.*)$'),
+    'ol': re.compile(r'^ {0,3}\d{1,9}[.)]\s+(.*)$'),
+}
+# Code spans and links, whose text isn't marked up further (but a link's own)
+INLINE_TOKEN = re.compile(r'`([^`\n]+)`|\[([^\]\n]+)\]\(((?:https?://|mailto:)[^\s)]+)\)')
+# The opening and closing marks of strong and emphasised text: the text between starts and ends with no space.
+STRONG = (re.compile(r'(?:\*\*|(?<!\w)__)(?=\S)'), re.compile(r'(?<=\S)(?:\*\*|__(?!\w))'))
+EMPHASIS = (re.compile(r'(?:\*|(?<!\w)_)(?=\S)'), re.compile(r'(?<=\S)(?:\*|_(?!\w))'))
+
+
+# Wraps the text from each opening mark to the first closing one after it in the tag, in one pass: the closing marks
+# that could end the text of an opening mark could end that of any earlier one, so once an opening mark has none,
+# none after it has either - the rest is left as it is rather than searched again from each mark in it.
+def render_marks(escaped, marks, tag):
+    opening, closing = marks
+    parts = []
+    position = 0
+    while True:
+        start = opening.search(escaped, position)
+        end = closing.search(escaped, start.end() + 1) if start else None
+        if end is None:
+            break
+        parts.append('%s<%s>%s</%s>' % (escaped[position:start.start()], tag, escaped[start.end():end.start()], tag))
+        position = end.end()
+    parts.append(escaped[position:])
+    return ''.join(parts)
+
+
+def render_emphasis(escaped):
+    return render_marks(render_marks(escaped, STRONG, 'strong'), EMPHASIS, 'em')
+
+
+def render_inline(text):
+    parts = []
+    position = 0
+    for match in INLINE_TOKEN.finditer(text):
+        parts.append(render_emphasis(html.escape(text[position:match.start()])))
+        if match.group(1) is not None:
+            parts.append('<code>%s</code>' % html.escape(match.group(1)))
+        else:
+            parts.append('<a href="%s" rel="nofollow">%s</a>' % (html.escape(match.group(3)),
+                                                                render_emphasis(html.escape(match.group(2)))))
+        position = match.end()
+    parts.append(render_emphasis(html.escape(text[position:])))
+    return ''.join(parts)
+
+
+def get_list_item(line):
+    for tag, pattern in LIST_ITEMS.items():
+        match = pattern.match(line)
+        if match:
+            return tag, match.group(1)
+    return None, None
+
+
+def render_markdown(text, depth=0):
+    lines = (text or '').replace('\r\n', '\n').replace('\r', '\n').split('\n')
+    blocks = []
+    paragraph = []
+    index = 0
+
+    def end_paragraph():
+        if paragraph:
+            blocks.append('<p>%s</p>' % '<br>\n'.join(render_inline(line.strip()) for line in paragraph))
+            paragraph.clear()
+
+    while index < len(lines):
+        line = lines[index]
+        fence = FENCE.match(line)
+        heading = HEADING.match(line)
+        tag, item = get_list_item(line)
+        if not line.strip():
+            end_paragraph()
+            index += 1
+        elif fence:
+            end_paragraph()
+            code = []
+            index += 1
+            while index < len(lines) and not lines[index].lstrip().startswith(fence.group(1)):
+                code.append(lines[index])
+                index += 1
+            blocks.append('<pre><code>%s</code></pre>' % html.escape('\n'.join(code)))
+            index += 1  # The closing fence, if any
+        elif heading:
+            end_paragraph()
+            level = len(heading.group(1))
+            blocks.append('<h%s>%s</h%s>' % (level, render_inline(heading.group(2)), level))
+            index += 1
+        elif RULE.match(line):
+            end_paragraph()
+            blocks.append('<hr>')
+            index += 1
+        elif QUOTE.match(line) and depth < QUOTE_MAX_DEPTH:
+            end_paragraph()
+            quoted = []
+            while index < len(lines) and QUOTE.match(lines[index]):
+                quoted.append(QUOTE.match(lines[index]).group(1))
+                index += 1
+            blocks.append('<blockquote>\n%s\n</blockquote>' % render_markdown('\n'.join(quoted), depth + 1))
+        elif tag:
+            end_paragraph()
+            items = [item]
+            index += 1
+            # Up to a blank line: the items of the same kind, and the lines continuing the last one
+            while index < len(lines) and lines[index].strip():
+                next_tag, next_item = get_list_item(lines[index])
+                if next_tag == tag:
+                    items.append(next_item)
+                elif next_tag or FENCE.match(lines[index]) or HEADING.match(lines[index]) or QUOTE.match(lines[index]):
+                    break
+                else:
+                    items[-1] += ' ' + lines[index].strip()
+                index += 1
+            blocks.append('<%s>\n%s\n</%s>' % (tag, '\n'.join('<li>%s</li>' % render_inline(item) for item in items), tag))
+        else:
+            paragraph.append(line)
+            index += 1
+    end_paragraph()
+    return '\n'.join(blocks)
+
+
+# The text of Markdown without the marks that start its lines, e.g. for an excerpt.
+def strip_block_marks(text):
+    lines = []
+    for line in (text or '').splitlines():
+        if FENCE.match(line) or RULE.match(line):
+            continue
+        heading = HEADING.match(line)
+        if heading:
+            line = heading.group(2)
+        while QUOTE.match(line):
+            line = QUOTE.match(line).group(1)
+        tag, item = get_list_item(line)
+        lines.append(item if tag else line)
+    return '\n'.join(lines)
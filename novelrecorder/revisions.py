@@ -0,0 +1,175 @@
+import difflib
+import json
+from datetime import timedelta
+
+from django.db import transaction
+from django.db.models import Max, OuterRef, Subquery
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from novelrecorder import sharding
+from novelrecorder.constants import DESCRIPTION_REVISION_SNAPSHOT_INTERVAL, DESCRIPTION_REVISION_KEEP, \
+    DESCRIPTION_REVISION_KEEP_DAYS, DESCRIPTION_REVISION_PAGE_SIZE
+from novelrecorder.models import Description, DescriptionBlob, DescriptionRevision, get_blob_hash
+
+# The revision history of each description: a save that changes its title or content adds a DescriptionRevision.
+# Every DESCRIPTION_REVISION_SNAPSHOT_INTERVAL-th revision is a snapshot, which refers to the blob of the content
+# (already stored for the description), the ones between keep a line delta from the revision before. A revision is
+# rebuilt from the snapshot at or before it and at most the interval - 1 deltas, however long the history.
+#
+# prune() deletes the old revisions beyond the latest DESCRIPTION_REVISION_KEEP, first making the oldest one kept
+# a snapshot if it isn't.
+
+
+def split_lines(text):
+    return text.splitlines(keepends=True)
+
+
+# The delta from one text to the next as JSON: [start, end, lines] per change, the lines of the text before from
+# start to end being replaced by lines.
+def get_delta(before, after):
+    before_lines, after_lines = split_lines(before), split_lines(after)
+    matcher = difflib.SequenceMatcher(None, before_lines, after_lines)
+    return json.dumps([[i1, i2, after_lines[j1:j2]] for tag, i1, i2, j1, j2 in matcher.get_opcodes()
+                       if tag != 'equal'], ensure_ascii=False, separators=(',', ':'))
+
+
+def apply_delta(text, delta):
+    lines = split_lines(text)
+    result = []
+    position = 0
+    for start, end, inserted in json.loads(delta):
+        result += lines[position:start]
+        result += inserted
+        position = end
+    return ''.join(result + lines[position:])
+
+
+def is_snapshot_number(number):
+    return (number - 1) % DESCRIPTION_REVISION_SNAPSHOT_INTERVAL == 0
+
+
+# The content of the last of the revisions of a description, in order from a snapshot.
+def rebuild(revisions):
+    text = None
+    for revision in revisions:
+        if revision.is_snapshot:
+            text = revision.blob.content if revision.blob_id is not None else None
+        else:
+            text = apply_delta(text, revision.delta)
+    return text
+
+
+# The revisions from the snapshot at or before number to number, in order.
+def get_chain(revisions, number):
+    snapshots = revisions.filter(is_snapshot=True, number__lte=number).order_by('-number').values('number')[:1]
+    return list(revisions.filter(number__lte=number, number__gte=Subquery(snapshots)).select_related('blob')
+                .order_by('number'))
+
+
+# The revision with its content (rebuilt), raises DescriptionRevision.DoesNotExist if there is none of the number.
+def get_revision(description, number):
+    chain = get_chain(description.revisions.all(), number)
+    if not chain or chain[-1].number != number:
+        raise DescriptionRevision.DoesNotExist('Description %s has no revision %s.' % (description.pk, number))
+    revision = chain[-1]
+    revision.content = rebuild(chain)
+    return revision
+
+
+# description id -> (number, title, content) of its latest revision, for the descriptions that have any.
+def get_latest_revisions(description_ids, using):
+    snapshots = DescriptionRevision.objects.filter(description=OuterRef('description'), is_snapshot=True) \
+        .order_by('-number').values('number')[:1]
+    chains = {}
+    for revision in DescriptionRevision.objects.using(using).filter(
+            description__in=description_ids, number__gte=Subquery(snapshots)).select_related('blob') \
+            .order_by('description', 'number'):
+        chains.setdefault(revision.description_id, []).append(revision)
+    return {description_id: (chain[-1].number, chain[-1].title, rebuild(chain)) for description_id, chain in chains.items()}
+
+
+# Adds a revision to each of the descriptions (saved) whose title or content differs from its latest one, with one
+# query for the latest ones - but those of the created descriptions (which have none) and of the instances
+# recorded before.
+def record_revisions(descriptions, using, created=()):
+    descriptions = [description for description in descriptions if description.pk is not None]
+    for description in created:
+        description._latest_revision = (0, None, None)
+    unknown = [description.pk for description in descriptions if '_latest_revision' not in description.__dict__]
+    latest = get_latest_revisions(unknown, using) if unknown else {}
+    revisions = []
+    for description in descriptions:
+        number, title, text = description.__dict__.get('_latest_revision') or latest.get(description.pk, (0, None, None))
+        content = description.content
+        if number and title == description.title and text == content:
+            continue
+        number += 1
+        revision = DescriptionRevision(description=description, number=number, title=description.title)
+        if is_snapshot_number(number) or text is None or content is None:
+            revision.is_snapshot, revision.blob_id = True, description.blob_id
+        else:
+            revision.delta = get_delta(text, content)
+        revisions.append(revision)
+        description._latest_revision = (number, description.title, content)
+    sharding.assign_ids(revisions)
+    DescriptionRevision.objects.using(using).bulk_create(revisions)
+    return revisions
+
+
+# A save that doesn't write the title or the content can't change them
+@receiver(post_save, sender=Description, dispatch_uid="record_description_revision")
+def recordRevision(sender, instance, created, raw=False, using=None, update_fields=None, **kwargs):
+    if raw or (update_fields is not None and not {'title', 'blob'} & set(update_fields)):
+        return
+    record_revisions([instance], using)
+
+
+def serialize_revision(revision, with_content=False):
+    data = {'number': revision.number, 'title': revision.title, 'is_snapshot': revision.is_snapshot,
+            'time': revision.time_created.isoformat()}
+    if with_content:
+        data['content'] = revision.content
+    return data
+
+
+# The revisions of the description before number before (all if None), the latest first and at most limit of them.
+# Keyset paginated: the next page is before the number of the last one.
+def get_history(description, before=None, limit=DESCRIPTION_REVISION_PAGE_SIZE):
+    revisions = description.revisions.order_by('-number').only('number', 'title', 'is_snapshot', 'time_created')
+    if before is not None:
+        revisions = revisions.filter(number__lt=before)
+    revisions = list(revisions[:limit + 1])
+    return {'revisions': [serialize_revision(revision) for revision in revisions[:limit]],
+            'has_more': len(revisions) > limit}
+
+
+# Deletes the revisions of the description older than days and not among the latest keep. Returns how many.
+def prune(description_id, using, keep=DESCRIPTION_REVISION_KEEP, days=DESCRIPTION_REVISION_KEEP_DAYS):
+    revisions = DescriptionRevision.objects.using(using).filter(description_id=description_id)
+    with transaction.atomic(using=using):
+        latest = revisions.aggregate(number=Max('number'))['number'] or 0
+        last_pruned = revisions.filter(number__lte=latest - max(keep, 1),
+                                       time_created__lt=timezone.now() - timedelta(days=days)) \
+            .aggregate(number=Max('number'))['number']
+        if last_pruned is None:
+            return 0
+        chain = get_chain(revisions, last_pruned + 1)
+        oldest = chain[-1]
+        if not oldest.is_snapshot:  # What the ones after it are rebuilt from
+            text = rebuild(chain)
+            if text is not None:
+                oldest.blob_id = get_blob_hash(text)
+                DescriptionBlob.objects.ensure([oldest.blob_id], using, lambda missing: [
+                    DescriptionBlob(hash=oldest.blob_id, content=text)])
+            oldest.is_snapshot, oldest.delta = True, None
+            oldest.save(using=using, update_fields=['is_snapshot', 'blob', 'delta'])
+        return revisions.filter(number__lte=last_pruned).delete()[0]
+
+
+# prune() for every description with revisions older than days on the database. Returns the revisions deleted.
+def prune_all(using, keep=DESCRIPTION_REVISION_KEEP, days=DESCRIPTION_REVISION_KEEP_DAYS):
+    description_ids = DescriptionRevision.objects.using(using).filter(
+        time_created__lt=timezone.now() - timedelta(days=days)).order_by().values_list('description', flat=True).distinct()
+    return sum(prune(description_id, using, keep, days) for description_id in list(description_ids))
@@ -1,7 +1,9 @@
+from django.db.models import Prefetch
 from rest_framework.fields import Field
 from rest_framework import serializers
 
 from novelrecorder.models import Description
+from novelrecorder.query_utils import apply_query_plan
 
 
 class ReadOnlyMixin(Field):
@@ -15,6 +17,14 @@ class ReadOnlyMixin(Field):
 
 
 class YDSerializerMixin(object):
+    # The relations followed when serializing, loaded up front by setup_eager_loading() to avoid N+1 queries.
+    _select_related = []
+    _prefetch_related = []
+
+    @classmethod
+    def setup_eager_loading(cls, queryset):
+        return apply_query_plan(queryset, select_related=cls._select_related, prefetch_related=cls._prefetch_related)
+
     @property
     def safe_errors(self):
         if hasattr(self, '_errors'):
@@ -31,20 +41,43 @@ class SlaveSerializerMixin(object):
         return obj.pk
 
 
-# Need to include 'primary_description_title', 'primary_description_content' in the serializer fields in Meta
+# Need to include 'primary_description_title', 'primary_description_excerpt' (and/or 'primary_description_excerpt_html')
+# in the serializer fields in Meta
 class PrimaryDescriptionMixin(object):
     # Note: Still need to declare the SerializerMethodField(s) in the descendant.
+    # getPrimaryDescription() reads from the prefetched descriptions when available - only the primary ones
+    # (through the partial indexes on is_primary), as that's all it needs. Their content (blob) isn't loaded.
+    _prefetch_related = [Prefetch('description_set', queryset=Description.objects.filter(is_primary=True))]
+
     def get_primary_description_object(self, obj) -> Description:
         return obj.getPrimaryDescription()
 
     def get_primary_description_title(self, obj):
         return self.get_primary_description_object(obj).title
 
-    def get_primary_description_content(self, obj):
-        return self.get_primary_description_object(obj).content
+    def get_primary_description_excerpt(self, obj):
+        return self.get_primary_description_object(obj).excerpt
+
+    def get_primary_description_excerpt_html(self, obj):
+        return self.get_primary_description_object(obj).excerpt_html
 
 
 class PartialUpdateMixin(object):
     def __init__(self, *args, **kwargs):
         kwargs['partial'] = True
         super().__init__(*args, **kwargs)
+
+
+# ?fields=a,b limits the output of a GET to these fields.
+class SparseFieldsetMixin(object):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        request = self.context.get('request')
+        if request is None or request.method != 'GET':
+            return
+        requested = request.query_params.get('fields')
+        if requested:
+            requested = set(requested.split(','))
+            for field_name in list(self.fields):
+                if field_name not in requested:
+                    self.fields.pop(field_name)
@@ -2,16 +2,20 @@ from django.contrib.auth.models import Group
 from rest_framework import serializers
 from rest_framework import fields
 
+from novelrecorder.middleware import timing_serialization
 from novelrecorder.yd_fields import HiddenInitialContextField, HiddenContextField
 from rest_framework.generics import get_object_or_404
 from novelrecorder.serializer_utils import ReadOnlyMixin, SlaveSerializerMixin, PrimaryDescriptionMixin, \
-    PartialUpdateMixin, YDSerializerMixin
+    PartialUpdateMixin, YDSerializerMixin, SparseFieldsetMixin
 
 from novelrecorder.models import NovelUser, Novel, Character, NovelUserPermissionModel, Description, Relationship
 
 
 class YDModelSerializer(serializers.ModelSerializer, YDSerializerMixin):
-    pass
+    # Timed as the serialization of the request, see novelrecorder.middleware
+    def to_representation(self, instance):
+        with timing_serialization():
+            return super().to_representation(instance)
 
 
 # Accounts
@@ -148,7 +152,7 @@ class NovelReadOnlySerializer(ReadOnlyMixin, NovelSerializer):
 class DescriptionSerializer(CustomNovelSerializer):
     author = serializers.HiddenField(default=serializers.CreateOnlyDefault(DefaultFieldCurrentUser()))
     character = HiddenContextField(choices=Character.objects.all(), allow_null=True, required=False)
-    relationship = HiddenContextField(choices=Relationship.objects.all(), allow_null=True, required=False)
+    relationship = HiddenContextField(choices=Relationship.objects.select_related('character1', 'character2'), allow_null=True, required=False)
     content = serializers.CharField(style={'base_template': 'textarea.html'}, allow_blank=True, required=False)
 
     def validate(self, attrs):
@@ -179,9 +183,11 @@ class DescriptionPartialUpdateSerializer(PartialUpdateMixin, DescriptionSerializ
 
 
 class DescriptionSlaveSerializer(DescriptionSerializer, SlaveSerializerMixin):
+    _select_related = ['character', 'relationship__character1', 'relationship__character2']
+
     class Meta:
         model = Description
-        fields = ['author', 'character', 'relationship', 'title', 'content', 'pk']
+        fields = ['author', 'character', 'relationship', 'title', 'excerpt', 'excerpt_html', 'word_count', 'pk']
 
 
 class DescriptionReadOnlySerializer(ReadOnlyMixin, DescriptionSerializer):
@@ -195,7 +201,7 @@ class DescriptionCreateSerializer(DescriptionSerializer):
                                           initial=FieldQueryParamObject(param_class=Character,
                                                                         param_key_field_name='character_id'),
                                           allow_null=True, required=False)
-    relationship = HiddenInitialContextField(choices=Relationship.objects.all(),
+    relationship = HiddenInitialContextField(choices=Relationship.objects.select_related('character1', 'character2'),
                                              initial=FieldQueryParamObject(param_class=Relationship,
                                                                            param_key_field_name='relationship_id'),
                                              allow_null=True, required=False)
@@ -221,17 +227,20 @@ class CharacterReadOnlySerializer(ReadOnlyMixin, CharacterSerializer):
 # Lookup primary description. Read only.
 class CharacterWithPrimaryDescriptionSerializer(PrimaryDescriptionMixin, CharacterReadOnlySerializer):
     primary_description_title = serializers.SerializerMethodField()
-    primary_description_content = serializers.SerializerMethodField()
+    primary_description_excerpt = serializers.SerializerMethodField()
+    primary_description_excerpt_html = serializers.SerializerMethodField()
 
     class Meta:
         model = Character
-        fields = ['name', 'primary_description_title', 'primary_description_content']
+        fields = ['name', 'primary_description_title', 'primary_description_excerpt',
+                  'primary_description_excerpt_html']
 
 
 class CharacterWithPrimaryDescriptionSlaveSerializer(CharacterWithPrimaryDescriptionSerializer, SlaveSerializerMixin):
     class Meta:
         model = Character
-        fields = ['name', 'primary_description_title', 'primary_description_content', 'pk']
+        fields = ['name', 'primary_description_title', 'primary_description_excerpt',
+                  'primary_description_excerpt_html', 'pk']
 
 
 class CharacterCreateSerializer(CharacterSerializer):
@@ -286,17 +295,19 @@ class RelationshipReadOnlySerializer(ReadOnlyMixin, RelationshipSerializer):
 # Lookup primary description. Read only.
 class RelationshipWithPrimaryDescriptionSerializer(PrimaryDescriptionMixin, RelationshipReadOnlySerializer):
     primary_description_title = serializers.SerializerMethodField()
-    primary_description_content = serializers.SerializerMethodField()
+    primary_description_excerpt = serializers.SerializerMethodField()
+    primary_description_excerpt_html = serializers.SerializerMethodField()
     character2_id = serializers.SerializerMethodField()
     character2_name = serializers.SerializerMethodField()
     relationship_display = serializers.SerializerMethodField()
+    _select_related = ['character1', 'character2']
 
     class Meta:
         model = Relationship
-        fields = ['character2', 'relationship_display', 'character2_id', 'character2_name', 'primary_description_title', 'primary_description_content']
+        fields = ['character2', 'relationship_display', 'character2_id', 'character2_name', 'primary_description_title', 'primary_description_excerpt', 'primary_description_excerpt_html']
 
     def get_character2_id(self, obj: Relationship):
-        return obj.character2.id
+        return obj.character2_id
 
     def get_character2_name(self, obj: Relationship):
         return obj.character2.name
@@ -308,7 +319,7 @@ class RelationshipWithPrimaryDescriptionSerializer(PrimaryDescriptionMixin, Rela
 class RelationshipWithPrimaryDescriptionSlaveSerializer(RelationshipWithPrimaryDescriptionSerializer, SlaveSerializerMixin):
     class Meta:
         model = Relationship
-        fields = ['character2', 'relationship_display', 'character2_id', 'character2_name', 'primary_description_title', 'primary_description_content', 'pk']
+        fields = ['character2', 'relationship_display', 'character2_id', 'character2_name', 'primary_description_title', 'primary_description_excerpt', 'primary_description_excerpt_html', 'pk']
 
 
 class RelationshipCreateSerializer(RelationshipSerializer):
@@ -341,3 +352,89 @@ class NovelUserPermissionModelSerializer(CustomNovelSerializer):
     class Meta:
         model = NovelUserPermissionModel
         fields = ['novel', 'user', 'permission']
+
+
+# API
+# The JSON API refers to the related objects by id rather than the form choices of the HTML serializers,
+# which load every character and relationship.
+class NovelApiSerializer(SparseFieldsetMixin, NovelSerializer):
+    author = serializers.HiddenField(default=serializers.CreateOnlyDefault(DefaultFieldCurrentUser()))
+    author_id = serializers.IntegerField(read_only=True)
+
+    class Meta:
+        model = Novel
+        fields = ['id', 'author', 'author_id', 'name', 'is_public']
+
+
+class CharacterApiSerializer(SparseFieldsetMixin, CharacterSerializer):
+    novel = serializers.PrimaryKeyRelatedField(read_only=True)
+
+    class Meta:
+        model = Character
+        fields = ['id', 'novel', 'name']
+
+
+class CharacterCreateApiSerializer(CharacterCreateSerializer):
+    novel = serializers.PrimaryKeyRelatedField(queryset=Novel.objects.all())
+    des_title = serializers.CharField(write_only=True)
+    des_content = serializers.CharField(write_only=True, allow_blank=True)
+
+    class Meta:
+        model = Character
+        fields = ['id', 'name', 'novel', 'des_title', 'des_content']
+
+
+class RelationshipApiSerializer(SparseFieldsetMixin, RelationshipSerializer):
+    character1 = serializers.PrimaryKeyRelatedField(read_only=True)
+    character2 = serializers.PrimaryKeyRelatedField(read_only=True)
+
+    class Meta:
+        model = Relationship
+        fields = ['id', 'character1', 'character2']
+
+
+class RelationshipCreateApiSerializer(RelationshipCreateSerializer):
+    character1 = serializers.PrimaryKeyRelatedField(queryset=Character.objects.all())
+    character2 = serializers.PrimaryKeyRelatedField(queryset=Character.objects.all())
+    des_title = serializers.CharField(write_only=True)
+    des_content = serializers.CharField(write_only=True, allow_blank=True)
+
+    class Meta:
+        model = Relationship
+        fields = ['id', 'character1', 'character2', 'des_title', 'des_content']
+
+    def validate(self, attrs):
+        if attrs['character1'].novel_id != attrs['character2'].novel_id:
+            raise serializers.ValidationError('The characters of a relationship must be in the same novel.')
+        return super().validate(attrs)
+
+
+class DescriptionApiSerializer(SparseFieldsetMixin, DescriptionSerializer):
+    character = serializers.PrimaryKeyRelatedField(queryset=Character.objects.all(), allow_null=True, required=False)
+    relationship = serializers.PrimaryKeyRelatedField(queryset=Relationship.objects.all(), allow_null=True, required=False)
+    author_id = serializers.IntegerField(read_only=True)
+
+    class Meta:
+        model = Description
+        fields = ['id', 'author', 'author_id', 'character', 'relationship', 'title', 'content', 'excerpt',
+                  'word_count', 'sort_order', 'is_primary', 'time_created', 'time_modified']
+        read_only_fields = ['excerpt', 'word_count', 'sort_order', 'is_primary', 'time_created', 'time_modified']
+
+
+class DescriptionUpdateApiSerializer(PartialUpdateMixin, DescriptionApiSerializer):
+    fields_to_exclude = ['author', 'character', 'relationship']
+
+
+class NovelUserPermissionModelApiSerializer(SparseFieldsetMixin, NovelUserPermissionModelSerializer):
+    novel = serializers.PrimaryKeyRelatedField(queryset=Novel.objects.all())
+    user = serializers.PrimaryKeyRelatedField(queryset=NovelUser.objects.all())
+
+    class Meta:
+        model = NovelUserPermissionModel
+        fields = ['id', 'novel', 'user', 'permission']
+
+
+# Only the permission changes: a row moved to another novel would grant it without its write permission being checked.
+class NovelUserPermissionModelUpdateApiSerializer(PartialUpdateMixin, NovelUserPermissionModelApiSerializer):
+    novel = serializers.PrimaryKeyRelatedField(read_only=True)
+    user = serializers.PrimaryKeyRelatedField(read_only=True)
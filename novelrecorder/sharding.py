@@ -0,0 +1,408 @@
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction, IntegrityError
+from django.db.models import Count, F, Max, Q
+from django.db.models.signals import pre_save, post_save, pre_delete
+from django.dispatch import receiver
+
+from novelrecorder.constants import SHARD_ID_BLOCK_SIZE, SHARD_MAP_CACHE_SECONDS, SHARD_MOVE_ATTEMPTS
+from novelrecorder.models import Novel, Character, Relationship, Description, DescriptionBlob, DescriptionRevision, \
+    NovelUserPermissionModel, ShardIdBlock
+from novelrecorder.yd_exceptions import DataErrorException, ShardMovedException
+
+# Horizontal sharding by novel: the characters, relationships, descriptions and permissions of a novel live in the
+# database of its shard, one of settings.DATABASE_SHARDS ('default' being one of them). Everything else - the
+# users, the novels themselves (the shard map: Novel.shard), the change log - stays in 'default'. Each shard also
+# holds a copy of the rows of its novels, for the joins (select_related('novel')) and foreign keys of their content.
+#
+# Routing: an object loaded from a shard stays on it, a new one goes to the shard of its novel. Queries with nothing
+# to tell the novel from (Character.objects.filter(...)) go to the shard activated for the request, which the views
+# find from the object or the novel they are about (activate_for_request). The API therefore refuses the lists of
+# their content that aren't filtered by a novel (or a character, a relationship).
+#
+# The ids of the sharded models are reserved in blocks from ShardIdBlock in 'default', so they are unique across the
+# shards: an id alone finds its object (locate) and a novel moves between shards (move_novel) without renumbering.
+#
+# Nothing of this happens while DATABASE_SHARDS is empty.
+
+PRIMARY = 'default'
+SHARDED_MODELS = (Character, Relationship, Description, DescriptionRevision, NovelUserPermissionModel)
+# Not of a novel, but with the sharded objects referring to them (on the same shard as the object of the query).
+SHARD_LOCAL_MODELS = (DescriptionBlob,)
+# The novel of an object of each sharded model, by the first of these fields that isn't null.
+NOVEL_ID_FIELDS = {
+    Character: ['novel_id'],
+    Relationship: ['character1__novel_id'],
+    Description: ['character__novel_id', 'relationship__character1__novel_id'],
+    DescriptionRevision: ['description__character__novel_id', 'description__relationship__character1__novel_id'],
+    NovelUserPermissionModel: ['novel_id'],
+}
+# The rows of a novel, per sharded model, in the order they are copied (and the reverse of which they are deleted).
+NOVEL_ROW_FILTERS = [
+    (Character, lambda novel_id: Q(novel_id=novel_id)),
+    (Relationship, lambda novel_id: Q(character1__novel_id=novel_id)),
+    (Description, lambda novel_id: Q(character__novel_id=novel_id) | Q(relationship__character1__novel_id=novel_id)),
+    (DescriptionRevision, lambda novel_id: Q(description__character__novel_id=novel_id) |
+                                           Q(description__relationship__character1__novel_id=novel_id)),
+    (NovelUserPermissionModel, lambda novel_id: Q(novel_id=novel_id)),
+]
+# The request parameters (URL kwargs, query params) that tell the novel of a request, besides its pk.
+ROUTING_PARAMS = [
+    ('novel_id', Novel), ('novel', Novel),
+    ('character_id', Character), ('character', Character), ('character1_id', Character), ('character1', Character),
+    ('relationship_id', Relationship), ('relationship', Relationship),
+]
+COPY_BATCH_SIZE = 1000
+
+# A context variable like db_routers._read_from_replica, so query_utils.run_concurrently carries it over.
+_active_shard = contextvars.ContextVar('novelrecorder_active_shard', default=None)
+_shard_map = {}  # novel id -> (shard, time it expires), the cache of Novel.shard in this process
+
+
+def get_shards():
+    return getattr(settings, 'DATABASE_SHARDS', [])
+
+
+def is_enabled():
+    return bool(get_shards())
+
+
+# The shard of a novel, given the novel or its id.
+def shard_for_novel(novel):
+    if isinstance(novel, Novel):
+        return novel.shard
+    cached = _shard_map.get(novel)
+    if cached is not None and cached[1] > time.monotonic():
+        return cached[0]
+    shard = Novel.objects.using(PRIMARY).filter(pk=novel).values_list('shard', flat=True).first() or PRIMARY
+    _shard_map[novel] = (shard, time.monotonic() + SHARD_MAP_CACHE_SECONDS)
+    return shard
+
+
+def forget_shard(novel_id):
+    _shard_map.pop(novel_id, None)
+
+
+# The database to query the content of the novel on, or None (the routers decide) if there are no shards.
+def db_for_novel(novel):
+    return shard_for_novel(novel) if is_enabled() else None
+
+
+# The shard of the object with this id, or None if there is no such object. Looks in every shard the first time,
+# then remembers the novel of the object (which doesn't change, unlike its shard).
+def locate(model_class, pk):
+    if model_class is Novel:
+        return shard_for_novel(pk)
+    key = 'novelrecorder_shard_locate:%s:%s' % (model_class._meta.label_lower, pk)
+    novel_id = cache.get(key)
+    if novel_id is None:
+        for alias in get_shards():
+            novel_ids = model_class.objects.using(alias).filter(pk=pk).values_list(*NOVEL_ID_FIELDS[model_class]).first()
+            if novel_ids is not None:
+                novel_id = next((value for value in novel_ids if value is not None), None)
+                break
+        if novel_id is None:
+            return None
+        cache.set(key, novel_id, None)
+    return shard_for_novel(novel_id)
+
+
+def get_active_shard():
+    return _active_shard.get()
+
+
+# Makes the queries with nothing else to route them by go to the shard, until reset(token) or the end of the request.
+def activate(shard):
+    return _active_shard.set(shard)
+
+
+def reset(token):
+    _active_shard.reset(token)
+
+
+@contextmanager
+def using_shard(shard):
+    token = activate(shard)
+    try:
+        yield
+    finally:
+        reset(token)
+
+
+# E.g. for a management command writing the content of a novel.
+def using_novel(novel):
+    return using_shard(shard_for_novel(novel) if is_enabled() else None)
+
+
+# Activates the shard of the object the request is about: the pk of the view's model, else the first routing
+# parameter found in the URL kwargs or the params (query params, or the data of the API requests).
+def activate_for_request(model_class, kwargs, *params):
+    if not is_enabled():
+        return
+    candidates = [(kwargs.get('pk'), model_class)] + [(kwargs.get(name), cls) for name, cls in ROUTING_PARAMS]
+    for values in params:
+        if hasattr(values, 'get'):
+            candidates += [(values.get(name), cls) for name, cls in ROUTING_PARAMS]
+    for value, cls in candidates:
+        try:
+            pk = int(value)
+        except (TypeError, ValueError):
+            continue
+        shard = locate(cls, pk)
+        if shard is not None:
+            activate(shard)  # Reset by ShardRoutingMiddleware
+            return
+
+
+# The number of objects of a model, across the shards.
+def count(model_class):
+    if model_class not in SHARDED_MODELS or not is_enabled():
+        return model_class.objects.count()
+    return sum(model_class.objects.using(alias).count() for alias in get_shards())
+
+
+class ShardRouter(object):
+    # Comes before ReplicaRouter, which routes what isn't sharded.
+    def db_for_read(self, model, **hints):
+        if (model in SHARDED_MODELS or model in SHARD_LOCAL_MODELS) and is_enabled():
+            return self.get_shard(model, hints.get('instance'))
+        return None
+
+    def db_for_write(self, model, **hints):
+        return self.db_for_read(model, **hints)
+
+    @staticmethod
+    def get_shard(model, instance):
+        if isinstance(instance, Novel):
+            return instance.shard
+        if isinstance(instance, SHARDED_MODELS):
+            if instance._state.db and not instance._state.adding:
+                return instance._state.db
+            if isinstance(instance, model):
+                return shard_for_novel(instance.getNovelId())
+            if instance._state.db:
+                return instance._state.db
+        return get_active_shard()
+
+
+class ShardRoutingMiddleware(object):
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        token = _active_shard.set(None)
+        try:
+            return self.get_response(request)
+        finally:
+            _active_shard.reset(token)
+
+
+# Ids
+# The ids of a block are reserved in the transaction of the write needing the first of them, the rest are only
+# handed out once it has committed (and forgotten if it rolls back, with the reservation).
+class IdAllocator(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.free = {}  # model label -> [next id, end]
+
+    def allocate(self, model_class, number=1):
+        label = model_class._meta.label_lower
+        with self.lock:
+            free = self.free.get(label)
+            if free is not None and free[1] - free[0] >= number:
+                free[0] += number
+                return list(range(free[0] - number, free[0]))
+        start = self.reserve(model_class, label, max(number, SHARD_ID_BLOCK_SIZE))
+        end = start + max(number, SHARD_ID_BLOCK_SIZE)
+        if end > start + number:
+            transaction.on_commit(lambda: self.release(label, start + number, end), using=PRIMARY)
+        return list(range(start, start + number))
+
+    def release(self, label, start, end):
+        with self.lock:
+            free = self.free.get(label)
+            if free is None or free[0] >= free[1]:
+                self.free[label] = [start, end]
+
+    # Returns the first id of the size ids reserved.
+    @staticmethod
+    def reserve(model_class, label, size):
+        blocks = ShardIdBlock.objects.using(PRIMARY)
+        with transaction.atomic(using=PRIMARY):
+            if not blocks.filter(model_label=label).update(next_id=F('next_id') + size):
+                # The first block starts after the ids given before the sharding
+                start = max([model_class.objects.using(alias).aggregate(max_id=Max('id'))['max_id'] or 0
+                             for alias in get_shards()] + [0]) + 1
+                try:
+                    with transaction.atomic(using=PRIMARY):
+                        blocks.create(model_label=label, next_id=start + size)
+                        return start
+                except IntegrityError:  # Another process got there first
+                    blocks.filter(model_label=label).update(next_id=F('next_id') + size)
+            return blocks.values_list('next_id', flat=True).get(model_label=label) - size
+
+
+id_allocator = IdAllocator()
+
+
+# Gives the objects ids from the allocator before a bulk_create. Returns False, giving none, if there are no shards.
+def assign_ids(objs):
+    if not objs or not is_enabled():
+        return False
+    for obj, id in zip(objs, id_allocator.allocate(objs[0].__class__, len(objs))):
+        obj.pk = id
+    return True
+
+
+@receiver(pre_save, sender=Character, dispatch_uid="shard_character_save")
+@receiver(pre_save, sender=Relationship, dispatch_uid="shard_relationship_save")
+@receiver(pre_save, sender=Description, dispatch_uid="shard_description_save")
+@receiver(pre_save, sender=NovelUserPermissionModel, dispatch_uid="shard_permission_save")
+def shardSave(sender, instance, raw=False, using=None, **kwargs):
+    if raw or not is_enabled():
+        return
+    shard = shard_for_novel(instance.getNovelId())
+    if using != shard:
+        raise DataErrorException('%s %s of novel %s is saved to %s rather than its shard %s - is the shard activated '
+                                 '(novelrecorder.sharding.using_novel)?' % (sender.__name__, instance.pk,
+                                                                            instance.getNovelId(), using, shard))
+    if instance.pk is None:
+        instance.pk = id_allocator.allocate(sender)[0]
+
+
+# New novels go to the shard with the fewest novels - but the ones given theirs (keep_shard), e.g. a clone next to
+# its original.
+@receiver(pre_save, sender=Novel, dispatch_uid="shard_novel_place")
+def placeNovel(sender, instance, raw=False, using=None, **kwargs):
+    if raw or using != PRIMARY or not is_enabled() or not instance._state.adding or \
+            getattr(instance, 'keep_shard', False):
+        return
+    counts = dict(Novel.objects.using(PRIMARY).values_list('shard').annotate(novels=Count('id')))
+    instance.shard = min(get_shards(), key=lambda shard: counts.get(shard, 0))
+
+
+@receiver(post_save, sender=Novel, dispatch_uid="shard_novel_copy")
+def copyNovel(sender, instance, raw=False, using=None, **kwargs):
+    if not raw and using == PRIMARY and is_enabled() and instance.shard != PRIMARY:
+        save_novel_copy(instance, instance.shard)
+
+
+# The content of the novel on its shard goes with it (or protects it, like the characters do in 'default').
+@receiver(pre_delete, sender=Novel, dispatch_uid="shard_novel_delete")
+def deleteNovelCopy(sender, instance, using=None, **kwargs):
+    if using == PRIMARY and is_enabled() and instance.shard != PRIMARY:
+        Novel.objects.using(instance.shard).filter(pk=instance.pk).delete()
+
+
+def save_novel_copy(novel, shard):
+    fields = {field.attname: getattr(novel, field.attname) for field in Novel._meta.concrete_fields
+              if not field.primary_key}
+    if not Novel.objects.using(shard).filter(pk=novel.pk).update(**fields):
+        Novel.objects.using(shard).bulk_create([Novel(pk=novel.pk, **fields)])
+
+
+# Rebalancing
+def get_novel_rows(model_class, row_filter, novel_id, shard):
+    return model_class.objects.using(shard).filter(row_filter(novel_id)).order_by('pk')
+
+
+def copy_novel(novel, source, target):
+    with transaction.atomic(using=target):
+        if target != PRIMARY:
+            save_novel_copy(novel, target)
+        for model_class, row_filter in NOVEL_ROW_FILTERS:
+            rows = []
+            for row in get_novel_rows(model_class, row_filter, novel.pk, source).iterator(chunk_size=COPY_BATCH_SIZE):
+                rows.append(row)
+                if len(rows) == COPY_BATCH_SIZE:
+                    copy_rows(model_class, rows, source, target)
+                    rows = []
+            copy_rows(model_class, rows, source, target)
+
+
+def copy_rows(model_class, rows, source, target):
+    get_missing = lambda missing: list(DescriptionBlob.objects.using(source).filter(hash__in=missing))
+    if model_class is Description:  # Their blobs go first, unless the target has them already
+        DescriptionBlob.objects.retain([row.blob_id for row in rows if row.blob_id is not None], target, get_missing)
+    elif model_class is DescriptionRevision:  # Which don't count as references
+        DescriptionBlob.objects.ensure({row.blob_id for row in rows if row.blob_id is not None}, target, get_missing)
+    model_class.objects.using(target).bulk_create(rows)
+
+
+# Without the signals: the rows are moved, not deleted (and the change log isn't told).
+def delete_novel(novel, shard):
+    with transaction.atomic(using=shard):
+        for model_class, row_filter in reversed(NOVEL_ROW_FILTERS):
+            rows = get_novel_rows(model_class, row_filter, novel.pk, shard).order_by()
+            if model_class is Description:
+                DescriptionBlob.objects.release(dict(rows.filter(blob__isnull=False).values_list('blob').annotate(
+                    count=Count('pk'))), shard)
+            rows._raw_delete(shard)
+        if shard != PRIMARY:
+            Novel.objects.using(shard).filter(pk=novel.pk)._raw_delete(shard)
+
+
+# Moves the content of the novel to the target shard: copies it, switches Novel.shard if nothing was written to the
+# novel meanwhile (its change_seq is the same), else undoes the copy and tries again. Then waits for the processes
+# to stop reading from the source (their caches of the shard map to expire) before deleting it there. The writes
+# routed to the source after the switch are refused (see changelog.write_changes) and can be retried.
+def move_novel(novel, target, wait=SHARD_MAP_CACHE_SECONDS):
+    assert target in get_shards(), '%s is not one of the shards %s.' % (target, get_shards())
+    novel = Novel.objects.using(PRIMARY).get(pk=novel.pk)
+    source = novel.shard
+    if source == target:
+        return False
+    for attempt in range(SHARD_MOVE_ATTEMPTS):
+        copy_novel(novel, source, target)
+        with transaction.atomic(using=PRIMARY):
+            locked = Novel.objects.using(PRIMARY).select_for_update().get(pk=novel.pk)
+            if locked.shard != source:
+                raise ShardMovedException('Novel %s has been moved to %s meanwhile.' % (novel.pk, locked.shard))
+            moved = locked.change_seq == novel.change_seq
+            if moved:
+                Novel.objects.using(PRIMARY).filter(pk=novel.pk).update(shard=target)
+        if moved:
+            break
+        delete_novel(novel, target)
+        novel = locked
+    else:
+        raise ShardMovedException('Novel %s kept being written to while it was copied to %s.' % (novel.pk, target))
+    forget_shard(novel.pk)
+    time.sleep(wait)
+    delete_novel(novel, source)
+    return True
+
+
+# The novels to move to even out the number of objects per shard: the largest novel of the fullest shard that
+# makes it closer to the emptiest, until there is none. Returns [(novel id, source, target, size)].
+def plan_rebalance():
+    sizes = {}  # novel id -> number of objects
+    for alias in get_shards():
+        for model_class, row_filter in NOVEL_ROW_FILTERS:
+            fields = NOVEL_ID_FIELDS[model_class]
+            for row in model_class.objects.using(alias).order_by().values(*fields).annotate(objects=Count('pk')):
+                novel_id = next((row[field] for field in fields if row[field] is not None), None)
+                sizes[novel_id] = sizes.get(novel_id, 0) + row['objects']
+    novels = {shard: [] for shard in get_shards()}
+    for novel_id, shard in Novel.objects.using(PRIMARY).values_list('id', 'shard'):
+        if shard in novels:
+            novels[shard].append((sizes.get(novel_id, 0), novel_id))
+    loads = {shard: sum(size for size, novel_id in shard_novels) for shard, shard_novels in novels.items()}
+    moves = []
+    while True:
+        source = max(loads, key=loads.get)
+        target = min(loads, key=loads.get)
+        candidates = [(size, novel_id) for size, novel_id in novels[source] if 0 < size < loads[source] - loads[target]]
+        if not candidates:
+            return moves
+        size, novel_id = max(candidates)
+        novels[source].remove((size, novel_id))
+        novels[target].append((size, novel_id))
+        loads[source] -= size
+        loads[target] += size
+        moves.append((novel_id, source, target, size))
@@ -1,9 +1,45 @@
+from datetime import timedelta
+
 from django.contrib.auth.models import Group
-from django.test import TestCase, override_settings
-from novelrecorder.models import NovelUser, Novel, Character, Description, Relationship
-from django.urls import reverse_lazy
-from django.test import Client
+from django.db import connection, connections, transaction
+from django.db.models import Q
+from django.test import TestCase, TransactionTestCase, LiveServerTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from novelrecorder.models import NovelUser, Novel, Character, Description, DescriptionBlob, DescriptionRevision, \
+    Relationship, NovelUserPermissionModel, NovelUserToken, Job
+from novelrecorder.constants import NUP_MINIMAL, NUP_VIEW_ONLY, NUP_DESCRIPTION_ONLY, NUP_COEDITOR, JOB_QUEUED, \
+    JOB_RUNNING, JOB_DONE, JOB_FAILED
+from django.urls import reverse_lazy, reverse, resolve
+from django.test import Client, RequestFactory
+from django.http import HttpResponse
 from django.contrib.auth.hashers import make_password
+from unittest import skipUnless
+from unittest.mock import patch
+from io import StringIO
+from contextlib import ExitStack
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management import call_command
+from django.utils import timezone
+import asyncio
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from novelrecorder import caching, changelog, compression, jobs, metrics, profiling, rendering, revisions, sharding
+from novelrecorder.loadtest import HTTPClient, LoadTestStats, run_scenario, parse_access_log
+from novelrecorder.benchmarks.generator import NovelGenerator, PRESETS
+from novelrecorder.benchmarks.harness import run_benchmarks, compare, pick_objects
+from novelrecorder.benchmarks.query_plans import check_query_plans, get_hot_queries, explain, get_sequential_scans
+from novelrecorder.db_routers import ReplicaRouter, ReplicaRoutingMiddleware, STICKY_COOKIE_NAME
+from novelrecorder.middleware import QueryRecorder
+from novelrecorder.permissions import NovelUserPermission
+from novelrecorder.query_utils import run_concurrently
+
+from novelrecorder.yd_exceptions import QueryBudgetExceededException, DataErrorException, ShardMovedException
 
 # Note: Currently need to do this hack (very bad) to do any test:
 #
@@ -14,9 +50,13 @@ from django.contrib.auth.hashers import make_password
 #         if name.startswith('mysite.'):
 #             name = name[7:]
 
-class NovelRecorderTestCase(TestCase):
+# Unsharded even if shards are configured - see ShardingTestCase.
+@override_settings(QUERY_BUDGET_STRICT=True, METRICS_DIRECTORY=os.path.join(tempfile.gettempdir(), 'novelrecorder_test_metrics'),
+                   DATABASE_SHARDS=[])
+class NovelRecorderTestBase(TestCase):
 
     def setUp(self):
+        cache.clear()  # The ids are given again after each test, e.g. to the cached permissions
         # TODO: When possible do them in RESTful way.
         group = Group.objects.create(name="Test Group")
         user1 = NovelUser.objects.create(username="TestUser", email="test@example.com", password=make_password("Test"))
@@ -77,6 +117,9 @@ class NovelRecorderTestCase(TestCase):
         client.post(reverse_lazy('novelrecorder:relationship_detail_create'), data=data)
         return Relationship.objects.get(character1=character1, character2=character2)
 
+
+class NovelRecorderTestCase(NovelRecorderTestBase):
+
     # Tests
     def test_sanity(self):
         self.assertEqual(True, True)
@@ -130,3 +173,1389 @@ class NovelRecorderTestCase(TestCase):
         self.assertEqual(Description.objects.count(), 4)
 
 
+# Each route has a fixed query budget declared on its view (query_budgets), which must hold no matter how many
+# characters, relationships and descriptions the novel has -- i.e. no N+1 queries.
+class QueryBudgetTestCase(NovelRecorderTestBase):
+    routes = [
+        'novelrecorder:public_novel_list',
+        'novelrecorder:my_novel_list',
+        'novelrecorder:novel_detail',
+        'novelrecorder:character_detail',
+        'novelrecorder:relationship_detail',
+        'novelrecorder:description_detail',
+    ]
+
+    def createCast(self, novel, size):
+        author = novel.author
+        characters = []
+        for index in range(size):
+            character = Character.objects.create(novel=novel, name='Budget Character %s' % index)
+            Description.objects.create(author=author, character=character, title='Primary %s' % index, content='Content')
+            Description.objects.create(author=author, character=character, title='Extra %s' % index, content='Content')
+            characters.append(character)
+        for character1 in characters:
+            for character2 in characters:
+                if character1 != character2:
+                    relationship = Relationship.objects.create(character1=character1, character2=character2)
+                    Description.objects.create(author=author, relationship=relationship, title='Relation', content='Content')
+        return characters
+
+    def getRouteKwargs(self, novel):
+        character = Character.objects.filter(novel=novel).first()
+        relationship = Relationship.objects.filter(character1=character).first()
+        description = Description.objects.filter(character=character).first()
+        return {
+            'novelrecorder:novel_detail': {'pk': novel.pk},
+            'novelrecorder:character_detail': {'pk': character.pk},
+            'novelrecorder:relationship_detail': {'pk': relationship.pk},
+            'novelrecorder:description_detail': {'pk': description.pk},
+        }
+
+    def countQueries(self, client, url):
+        with CaptureQueriesContext(connection) as context:
+            response = client.get(url)
+        self.assertEqual(response.status_code, 200, url)
+        self.assertIn('Server-Timing', response)
+        return len(context)
+
+    def assertQueryBudgets(self, cast_size):
+        c = self.login()
+        novel = self.createNovel(c, 1)
+        self.createCast(novel, cast_size)
+        route_kwargs = self.getRouteKwargs(novel)
+        for route_name in self.routes:
+            url = reverse(route_name, kwargs=route_kwargs.get(route_name))
+            budget = resolve(url).func.view_class.query_budgets['GET']
+            count = self.countQueries(c, url)
+            self.assertLessEqual(count, budget, '%s ran %s queries, over its budget of %s.' % (route_name, count, budget))
+
+    def test_queryBudgetSmallCast(self):
+        self.assertQueryBudgets(2)
+
+    def test_queryBudgetLargeCast(self):
+        self.assertQueryBudgets(8)
+
+    def test_queryBudgetExceeded(self):
+        c = self.login()
+        novel = self.createNovel(c, 1)
+        with patch('novelrecorder.views.NovelDetailView.query_budgets', {'GET': 1}):
+            with self.assertRaises(QueryBudgetExceededException):
+                c.get(reverse('novelrecorder:novel_detail', kwargs={'pk': novel.pk}))
+            with override_settings(QUERY_BUDGET_STRICT=False), self.assertLogs('novelrecorder.instrumentation', 'WARNING'):
+                response = c.get(reverse('novelrecorder:novel_detail', kwargs={'pk': novel.pk}))
+        self.assertEqual(response.status_code, 200)
+
+    def test_serializationTimed(self):
+        c = self.login()
+        novel = self.createNovel(c, 1)
+        with self.assertLogs('novelrecorder.instrumentation', 'DEBUG') as logs:
+            response = c.get(reverse('api_v1:novel-detail', kwargs={'pk': novel.pk}))
+        self.assertIn('serialize;dur=', response['Server-Timing'])
+        record = json.loads(logs.records[-1].getMessage())
+        self.assertGreater(record['serialize_ms'], 0)
+        self.assertLessEqual(record['serialize_ms'], record['view_ms'])
+
+
+class ProfilingTestCase(NovelRecorderTestBase):
+    def setUp(self):
+        super().setUp()
+        self.profile_directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.profile_directory)
+
+    def test_profileWithSignedHeader(self):
+        c = self.login()
+        with override_settings(PROFILER={'DIRECTORY': self.profile_directory}):
+            c.get(reverse('novelrecorder:index'), HTTP_X_NOVELRECORDER_PROFILE='not signed')
+            self.assertEqual(profiling.list_profiles(), [])
+            c.get(reverse('novelrecorder:index'), HTTP_X_NOVELRECORDER_PROFILE=profiling.make_profile_token())
+            profiles = profiling.list_profiles()
+            self.assertEqual(len(profiles), 1)
+            self.assertEqual(profiles[0]['url_name'], 'novelrecorder:index')
+            for extension in ['prof', 'collapsed']:
+                self.assertTrue(os.path.isfile(os.path.join(self.profile_directory, '%s.%s' % (profiles[0]['id'], extension))))
+
+            NovelUser.objects.create(username="StaffUser", password=make_password("Staff"), is_staff=True)
+            staff_client = Client()
+            staff_client.login(username="StaffUser", password='Staff')
+            response = staff_client.get(reverse('novelrecorder:profile_list'))
+            self.assertContains(response, profiles[0]['id'])
+            self.assertNotEqual(c.get(reverse('novelrecorder:profile_list')).status_code, 200)
+
+    def test_profileSampled(self):
+        with override_settings(PROFILER={'DIRECTORY': self.profile_directory, 'ENABLED': True, 'SAMPLE_RATE': 1.0}):
+            self.client.get(reverse('novelrecorder:index'))
+            self.assertEqual(len(profiling.list_profiles()), 1)
+
+
+class MetricsTestCase(NovelRecorderTestBase):
+    def test_metrics(self):
+        c = self.login()
+        novel = self.createNovel(c, 1)
+        c.get(reverse('novelrecorder:novel_detail', kwargs={'pk': novel.pk}))
+        self.assertEqual(c.get(reverse('metrics')).status_code, 403)  # For staff only without the token
+        NovelUser.objects.filter(username='TestUser').update(is_staff=True)
+        response = c.get(reverse('metrics'))
+        self.assertEqual(response.status_code, 200)
+        content = response.content.decode()
+        self.assertIn('# TYPE novelrecorder_request_duration_seconds histogram', content)
+        self.assertIn('novelrecorder_request_duration_seconds_bucket{url_name="novelrecorder:novel_detail",le="+Inf"}', content)
+        self.assertIn('novelrecorder_objects{model="Novel"} 1', content)
+        self.assertIn('novelrecorder_permission_checks_total{result="allowed"}', content)
+
+    def test_metricsToken(self):
+        with override_settings(METRICS_TOKEN='secret'):
+            self.assertEqual(self.client.get(reverse('metrics')).status_code, 403)
+            self.assertEqual(self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer secret').status_code, 200)
+
+    def test_metricsOfEndedProcesses(self):
+        directory = metrics.get_metrics_directory()
+        os.makedirs(directory, exist_ok=True)
+        ended_path = os.path.join(directory, 'metrics_%s.json' % (2 ** 22 + 1))  # Above any pid
+        with open(ended_path, 'w') as f:
+            json.dump({'counters': {metrics.MetricsStore.key('novelrecorder_test_total', None): 3}, 'histograms': {}}, f)
+        self.addCleanup(os.remove, os.path.join(directory, metrics.ARCHIVE_FILENAME))
+        for _ in range(2):  # Counted once it's archived too
+            self.assertEqual(metrics.collect()[0][metrics.MetricsStore.key('novelrecorder_test_total', None)], 3)
+        self.assertFalse(os.path.exists(ended_path))
+
+    def test_metricsFlushedFromThreads(self):
+        store = metrics.MetricsStore()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        store.get_path = lambda: os.path.join(directory, 'metrics_test.json')  # Not the file of the process' store
+        errors = []
+
+        def flush():
+            try:
+                store.inc('novelrecorder_test_total')
+                store.flush()
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=flush) for _ in range(16)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        data = metrics.read_metrics_file(store.get_path())
+        self.assertEqual(data['counters'][metrics.MetricsStore.key('novelrecorder_test_total', None)], 16)
+        # Nor does a directory that can't be written to fail the caller
+        with tempfile.NamedTemporaryFile() as f, self.assertLogs('novelrecorder.metrics', 'WARNING'):
+            store.get_path = lambda: os.path.join(f.name, 'metrics_test.json')
+            store.last_flush = 0
+            store.inc('novelrecorder_test_total')
+
+
+class BenchmarkTestCase(NovelRecorderTestBase):
+    def test_generatorAndHarness(self):
+        NovelGenerator('tiny', seed=1).generate()
+        sizes = PRESETS['tiny']
+        self.assertEqual(Description.objects.count(), sizes['descriptions'])
+        self.assertEqual(Character.objects.count(), sizes['characters'])
+        self.assertEqual(Description.objects.filter(is_primary=True).count(), Character.objects.count() + Relationship.objects.count())
+
+        with override_settings(QUERY_BUDGET_STRICT=False):
+            results = run_benchmarks(iterations=1)
+        self.assertEqual(results['unlisted_routes'], [])
+        for name, result in results['routes'].items():
+            self.assertEqual(result['status'], 200, name)
+        self.assertEqual(compare(results, results), [])
+        slower = json.loads(json.dumps(results))
+        slower['routes']['index']['queries'] += 1
+        self.assertEqual(len(compare(results, slower)), 1)
+
+
+@override_settings(METRICS_DIRECTORY=os.path.join(tempfile.gettempdir(), 'novelrecorder_test_metrics'), DATABASE_SHARDS=[])
+class LoadTestTestCase(LiveServerTestCase):
+    def test_loadTestScenario(self):
+        user = NovelUser.objects.create(username="TestUser", password=make_password("Test"))
+        novel = Novel.objects.create(author=user, name='Load Test Novel', is_public=True)
+        character = Character.objects.create(novel=novel, name='Load Test Character')
+        Description.objects.create(author=user, character=character, title='Primary', content='Content')
+
+        # A single client, as concurrent writes can hit "database is locked" on SQLite.
+        stats = LoadTestStats()
+        asyncio.run(run_scenario(self.live_server_url, stats, concurrency=1, iterations=3,
+                                 username='TestUser', password='Test', write_ratio=1.0, seed=0))
+        summary = stats.summary()
+        self.assertEqual(summary['errors'], 0, summary)
+        self.assertEqual(summary['routes']['novelrecorder:character_detail']['requests'], 3)
+        self.assertEqual(Description.objects.filter(title__startswith='Load test').count(), 3)
+
+    def test_parseAccessLog(self):
+        lines = [
+            '127.0.0.1 - - [19/Oct/2026:10:00:00 +1300] "GET /novelrecorder/novel_detail/1/ HTTP/1.1" 200 512 "-" "curl"',
+            'not a request line',
+            '127.0.0.1 - - [19/Oct/2026:10:00:01 +1300] "POST /accounts/login/ HTTP/1.1" 302 0 "-" "curl"',
+        ]
+        self.assertEqual(list(parse_access_log(lines)), [('GET', '/novelrecorder/novel_detail/1/'), ('POST', '/accounts/login/')])
+
+    def test_httpClient(self):
+        self.assertEqual(HTTPClient('https://example.com/').get_url('/a/'), 'https://example.com/a/')
+        client = HTTPClient(self.live_server_url)
+        self.assertEqual(client.get_url('/a/'), '%s/a/' % self.live_server_url)  # With the port
+
+        # A response without a body (a 204 here) isn't read up to the end of the connection, which is kept
+        async def respond(reader, writer):
+            for response in [b'HTTP/1.1 204 No Content\r\n\r\n', b'HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok']:
+                while (await reader.readline()) not in (b'\r\n', b''):
+                    pass
+                writer.write(response)
+                await writer.drain()
+            writer.close()
+
+        async def requests():
+            server = await asyncio.start_server(respond, '127.0.0.1', 0)
+            client = HTTPClient('http://127.0.0.1:%s' % server.sockets[0].getsockname()[1], timeout=5)
+            try:
+                return [await client.request('POST', '/'), await client.request('GET', '/')]
+            finally:
+                client.close()
+                server.close()
+        responses = asyncio.run(requests())
+        self.assertEqual([(status, content) for status, headers, content in responses], [(204, ''), (200, 'ok')])
+
+
+class TokenAuthenticationTestCase(NovelRecorderTestBase):
+    def createPrivateNovel(self):
+        c = self.login()
+        novel = self.createNovel(c, 1)
+        novel.is_public = False
+        novel.save()
+        return novel
+
+    def test_tokenAuthentication(self):
+        novel = self.createPrivateNovel()
+        token, key = NovelUserToken.create_token(NovelUser.objects.get(username="TestUser"), 'Test', ['read'])
+        url = reverse('novelrecorder:novel_detail', kwargs={'pk': novel.pk})
+        self.assertEqual(self.client.get(url).status_code, 401)
+        self.assertEqual(self.client.get(url, HTTP_AUTHORIZATION='Token %s' % key).status_code, 200)
+        self.assertEqual(self.client.get(url, HTTP_AUTHORIZATION='Token %s' % key[::-1]).status_code, 401)
+
+        # The second time the token comes from the cache.
+        with CaptureQueriesContext(connection) as context:
+            self.client.get(url, HTTP_AUTHORIZATION='Token %s' % key)
+        self.assertFalse([query for query in context.captured_queries if 'novelrecorder_novelusertoken' in query['sql']])
+
+        # The user isn't cached with it: deactivating them, in another process say (no signal), counts at once
+        NovelUser.objects.filter(username='TestUser').update(is_active=False)
+        self.assertEqual(self.client.get(url, HTTP_AUTHORIZATION='Token %s' % key).status_code, 401)
+        NovelUser.objects.filter(username='TestUser').update(is_active=True)
+        # Nor does saving the user (e.g. its last_login on each login) look up its tokens
+        with CaptureQueriesContext(connection) as context:
+            self.login()
+        self.assertFalse([query for query in context.captured_queries if 'novelrecorder_novelusertoken' in query['sql']])
+
+        token.revoke()
+        self.assertEqual(self.client.get(url, HTTP_AUTHORIZATION='Token %s' % key).status_code, 401)
+
+    def test_tokenScopes(self):
+        novel = self.createPrivateNovel()
+        user = NovelUser.objects.get(username="TestUser")
+        url = reverse('novelrecorder:novel_detail', kwargs={'pk': novel.pk})
+        data = {'name': 'Renamed', 'is_public': False}
+        read_token, read_key = NovelUserToken.create_token(user, 'Read', ['read'])
+        self.assertEqual(self.client.post(url, data, HTTP_AUTHORIZATION='Token %s' % read_key).status_code, 403)
+        write_token, write_key = NovelUserToken.create_token(user, 'Write', ['read', 'write'])
+        self.client.post(url, data, HTTP_AUTHORIZATION='Token %s' % write_key)
+        self.assertEqual(Novel.objects.get(pk=novel.pk).name, 'Renamed')
+
+
+class ApiTestCase(NovelRecorderTestBase):
+    def test_apiReadAndSparseFields(self):
+        c = self.login()
+        novel = self.createNovel(c, 1)
+        character = self.createCharacter(c, novel, 1, 1)
+        response = c.get(reverse('api_v1:character-detail', kwargs={'pk': character.pk}))
+        self.assertEqual(response.json(), {'id': character.pk, 'novel': novel.pk, 'name': character.name})
+        response = c.get(reverse('api_v1:character-list'), {'novel': novel.pk, 'fields': 'id'})
+        self.assertEqual(response.json()['results'], [{'id': character.pk}])
+
+    def test_apiCursorPagination(self):
+        c = self.login()
+        novel = self.createNovel(c, 1)
+        Character.objects.bulk_create([Character(novel=novel, name='Character %s' % i) for i in range(5)])
+        url = reverse('api_v1:character-list')
+        names = []
+        response = c.get(url, {'page_size': 2}).json()
+        while True:
+            names += [character['name'] for character in response['results']]
+            if not response['next']:
+                break
+            response = c.get(response['next']).json()
+        self.assertEqual(names, ['Character %s' % i for i in range(5)])
+
+    def test_apiPermissions(self):
+        c = self.login()
+        novel = self.createNovel(c, 1)
+        novel.is_public = False
+        novel.save()
+        another = Client()
+        another.login(username="AnotherUser", password='Another')
+        self.assertEqual(another.get(reverse('api_v1:novel-list')).json()['results'], [])
+        self.assertEqual(another.get(reverse('api_v1:novel-detail', kwargs={'pk': novel.pk})).status_code, 404)
+        data = {'novel': novel.pk, 'name': 'Intruder', 'des_title': 'Title', 'des_content': 'Content'}
+        self.assertEqual(another.post(reverse('api_v1:character-list'), data).status_code, 403)
+        self.assertEqual(Client().post(reverse('api_v1:novel-list'), {'name': 'Anonymous'}).status_code, 401)
+
+    def test_apiPermissionCantBeMoved(self):
+        c = self.login()
+        victim = self.createNovel(c, 1)
+        victim.is_public = False
+        victim.save()
+        another = Client()
+        another.login(username="AnotherUser", password='Another')
+        own = another.post(reverse('api_v1:novel-list'), {'name': 'Own Novel'}).json()['id']
+        friend = NovelUser.objects.get(username='TestUser')
+        response = another.post(reverse('api_v1:permission-list'), {'novel': own, 'user': friend.pk,
+                                                                    'permission': NUP_VIEW_ONLY})
+        self.assertEqual(response.status_code, 201, response.content)
+        url = reverse('api_v1:permission-detail', kwargs={'pk': response.json()['id']})
+        response = another.patch(url, {'novel': victim.pk, 'user': NovelUser.objects.get(username='AnotherUser').pk,
+                                       'permission': NUP_COEDITOR}, content_type='application/json')
+        self.assertEqual(response.status_code, 200, response.content)
+        # Only the permission changed
+        self.assertEqual(list(NovelUserPermissionModel.objects.values_list('novel', 'user', 'permission')),
+                         [(own, friend.pk, NUP_COEDITOR)])
+        self.assertEqual(another.get(reverse('api_v1:novel-detail', kwargs={'pk': victim.pk})).status_code, 404)
+
+    def test_apiPermissionsListedToManagers(self):
+        c = self.login()
+        novel = self.createNovel(c, 1)  # Public
+        another = NovelUser.objects.get(username='AnotherUser')
+        third = NovelUser.objects.create(username='ThirdUser', email='third@example.com', password=make_password('Third'))
+        granted = NovelUserPermissionModel.objects.create(novel=novel, user=another, permission=NUP_VIEW_ONLY)
+        url = reverse('api_v1:permission-list')
+        self.assertEqual(Client().get(url).json()['results'], [])
+        c3 = Client()
+        c3.login(username='ThirdUser', password='Third')
+        self.assertEqual(c3.get(url).json()['results'], [])
+        self.assertEqual(c3.get(reverse('api_v1:permission-detail', kwargs={'pk': granted.pk})).status_code, 404)
+        # The granted user sees their own row, the author and the co-editors all of them
+        c2 = Client()
+        c2.login(username='AnotherUser', password='Another')
+        self.assertEqual([row['id'] for row in c2.get(url).json()['results']], [granted.pk])
+        self.assertEqual([row['id'] for row in c.get(url).json()['results']], [granted.pk])
+        coeditor = NovelUserPermissionModel.objects.create(novel=novel, user=third, permission=NUP_COEDITOR)
+        self.assertEqual([row['id'] for row in c3.get(url).json()['results']], [granted.pk, coeditor.pk])
+        self.assertEqual([row['id'] for row in c2.get(url).json()['results']], [granted.pk])
+
+    def test_apiCreateCharacter(self):
+        c = self.login()
+        novel = self.createNovel(c, 1)
+        data = {'novel': novel.pk, 'name': 'Api Character', 'des_title': 'Title', 'des_content': 'Content'}
+        response = c.post(reverse('api_v1:character-list'), data)
+        self.assertEqual(response.status_code, 201)
+        character = Character.objects.get(pk=response.json()['id'])
+        self.assertEqual(character.getPrimaryDescription().title, 'Title')
+        description = character.getPrimaryDescription()
+        url = reverse('api_v1:description-detail', kwargs={'pk': description.pk})
+        self.assertEqual(c.delete(url).status_code, 400)
+
+
+class BatchTestCase(NovelRecorderTestBase):
+    def postBatch(self, client, novel, operations):
+        return client.post(reverse('api_v1:novel-batch', kwargs={'pk': novel.pk}), json.dumps({'operations': operations}),
+                           content_type='application/json')
+
+    def test_batch(self):
+        c = self.login()
+        novel = self.createNovel(c, 1)
+        character1 = self.createCharacter(c, novel, 1, 1)
+        character2 = self.createCharacter(c, novel, 2, 2)
+        old_relationship = self.createRelationship(c, character1, character2, 3)
+        description = self.createCharacterDescription(c, character1, 4)
+        operations = [
+            {'op': 'create', 'type': 'character', 'ref': 'new', 'data': {'name': 'New', 'des_title': 'New Title'}},
+            {'op': 'create', 'type': 'relationship', 'ref': 'rel', 'data': {'character1': '$new', 'character2': character1.pk,
+                                                                            'des_title': 'Rel Title'}},
+            {'op': 'create', 'type': 'description', 'data': {'relationship': '$rel', 'title': 'Second', 'content': 'C'}},
+            {'op': 'update', 'type': 'character', 'id': character2.pk, 'data': {'name': 'Renamed'}},
+            {'op': 'update', 'type': 'description', 'id': description.pk, 'data': {'content': 'Edited'}},
+            {'op': 'delete', 'type': 'relationship', 'id': old_relationship.pk},
+        ]
+        with CaptureQueriesContext(connection) as context:
+            response = self.postBatch(c, novel, operations)
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertLess(len(context.captured_queries), 40)  # A few of them for the blobs of the text and the revisions
+        results = response.json()['results']
+        self.assertEqual([result['status'] for result in results], ['created'] * 3 + ['updated'] * 2 + ['deleted'])
+
+        new = Character.objects.get(pk=results[0]['id'])
+        self.assertEqual(new.getPrimaryDescription().title, 'New Title')
+        self.assertTrue(new.getPrimaryDescription().is_primary)
+        relationship = Relationship.objects.get(pk=results[1]['id'])
+        self.assertEqual((relationship.character1, relationship.character2), (new, character1))
+        self.assertEqual([d.title for d in relationship.description_set.all()], ['Rel Title', 'Second'])
+        self.assertEqual([d.is_primary for d in relationship.description_set.all()], [True, False])
+        self.assertEqual(Character.objects.get(pk=character2.pk).name, 'Renamed')
+        self.assertEqual(Description.objects.get(pk=description.pk).content, 'Edited')
+        self.assertFalse(Relationship.objects.filter(pk=old_relationship.pk).exists())
+
+    def test_batchValidation(self):
+        c = self.login()
+        novel = self.createNovel(c, 1)
+        character1 = self.createCharacter(c, novel, 1, 1)
+        character2 = self.createCharacter(c, novel, 2, 2)
+        self.createRelationship(c, character1, character2, 3)
+        operations = [
+            {'op': 'create', 'type': 'character', 'data': {'name': 'Fine', 'des_title': 'Title'}},
+            {'op': 'create', 'type': 'character', 'data': {'name': character1.name, 'des_title': 'Title'}},
+            {'op': 'delete', 'type': 'character', 'id': character2.pk},
+            {'op': 'delete', 'type': 'description', 'id': character1.getPrimaryDescription().pk},
+            {'op': 'create', 'type': 'description', 'data': {'character': '$missing', 'title': 'Title'}},
+        ]
+        response = self.postBatch(c, novel, operations)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(sorted(response.json()['errors']), ['1', '2', '3', '4'])
+        self.assertFalse(Character.objects.filter(name='Fine').exists())
+
+        another = Client()
+        another.login(username="AnotherUser", password='Another')
+        response = self.postBatch(another, novel, operations[:1])
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('permission', str(response.json()['errors']))
+
+    # The blobs and revisions of the bulk writes go where the descriptions are written, even when reads would go to
+    # a replica (which isn't configured here, so using it would fail)
+    def test_batchWritesNotToReplica(self):
+        from novelrecorder.batch import DescriptionFormset
+        c = self.login()
+        novel = self.createNovel(c, 1)
+        character = self.createCharacter(c, novel, 1, 1)
+        description = character.getPrimaryDescription()
+        formset = DescriptionFormset(character, novel.author, [{'id': description.pk, 'content': 'Edited'}])
+        self.assertTrue(formset.is_valid(), formset.errors)
+        with patch.object(ReplicaRouter, 'db_for_read', return_value='replica1'):
+            self.assertEqual(Description.objects.db, 'replica1')
+            formset.save()
+        self.assertEqual(Description.objects.get(pk=description.pk).content, 'Edited')
+        self.assertEqual(description.revisions.count(), 2)
+
+
+class ChangeLogTestCase(NovelRecorderTestBase):
+    def getChanges(self, client, novel, since, **params):
+        url = reverse('api_v1:novel-changes', kwargs={'pk': novel.pk})
+        return client.get(url, dict(params, since=since)).json()
+
+    # All the snapshot pages of the novel merged, and the seq of the first
+    def getSnapshot(self, client, novel, **params):
+        url = reverse('api_v1:novel-snapshot', kwargs={'pk': novel.pk})
+        page = client.get(url, params).json()
+        seq, data = page['seq'], {}
+        while True:
+            for object_type, objects in page['data'].items():
+                if object_type == 'blob':
+                    data.setdefault('blob', {}).update(objects)
+                else:
+                    data.setdefault(object_type, []).extend(objects)
+            if page['next'] is None:
+                return seq, data
+            page = client.get(url, dict(params, after=page['next'])).json()
+
+    def test_changeLog(self):
+        c = self.login()
+        novel = self.createNovel(c, 1)
+        character1 = self.createCharacter(c, novel, 1, 1)
+        response = self.getChanges(c, novel, 0)
+        self.assertEqual([(change['seq'], change['type'], change['action']) for change in response['changes']],
+                         [(1, 'character', 'create'), (2, 'description', 'create')])
+        self.assertEqual(response['changes'][1]['data']['sort_order'], response['changes'][1]['id'])
+        self.assertEqual(response['seq'], 2)
+
+        character2 = self.createCharacter(c, novel, 2, 2)
+        relationship = self.createRelationship(c, character1, character2, 3)
+        c.delete(reverse('api_v1:relationship-detail', kwargs={'pk': relationship.pk}))
+        response = self.getChanges(c, novel, 2)
+        self.assertEqual([(change['type'], change['action']) for change in response['changes']],
+                         [('character', 'create'), ('description', 'create'), ('relationship', 'create'),
+                          ('description', 'create'), ('relationship', 'delete'), ('description', 'delete')])
+        self.assertEqual(self.getChanges(c, novel, 2, limit=2)['has_more'], True)
+
+        # The batch endpoint is logged as well
+        c.post(reverse('api_v1:novel-batch', kwargs={'pk': novel.pk}), json.dumps({'operations': [
+            {'op': 'update', 'type': 'character', 'id': character1.pk, 'data': {'name': 'Renamed'}}]}),
+            content_type='application/json')
+        change = self.getChanges(c, novel, 8)['changes'][0]
+        self.assertEqual((change['seq'], change['action'], change['data']['name']), (9, 'update', 'Renamed'))
+
+    def test_changeLogCompaction(self):
+        c = self.login()
+        novel = self.createNovel(c, 1)
+        for index in range(1, 3):
+            self.createCharacter(c, novel, index, index)
+        self.assertEqual(changelog.compact(novel, keep=1), 3)
+        self.assertEqual(novel.snapshots.get().compacted_seq, 3)
+        response = self.getChanges(c, novel, 0)
+        self.assertEqual(response['snapshot'], {'seq': 4, 'compacted_seq': 3})
+        self.assertEqual(response['changes'], [])
+        # Which the client syncs from the snapshot pages instead, however small
+        seq, data = self.getSnapshot(c, novel, limit=1)
+        self.assertEqual(seq, 4)
+        self.assertEqual(sorted(character['name'] for character in data['character']),
+                         ['Test Character 1', 'Test Character 2'])
+        self.assertEqual(len(data['description']), 2)
+        self.assertEqual(self.getSnapshot(c, novel), (seq, data))
+        url = reverse('api_v1:novel-snapshot', kwargs={'pk': novel.pk})
+        self.assertEqual(c.get(url, {'after': 'novel:1'}).status_code, 400)
+        # Clients which are recent enough still get the changes
+        response = self.getChanges(c, novel, 3)
+        self.assertEqual((response['snapshot'], len(response['changes'])), (None, 1))
+
+    def test_changeLogPermissionsHidden(self):
+        c = self.login()
+        novel = self.createNovel(c, 1)  # Public
+        self.createCharacter(c, novel, 1, 1)
+        another = NovelUser.objects.get(username='AnotherUser')
+        NovelUserPermissionModel.objects.create(novel=novel, user=another, permission=NUP_VIEW_ONLY)
+        self.assertEqual([change['type'] for change in self.getChanges(c, novel, 0)['changes']],
+                         ['character', 'description', 'permission'])
+        self.assertEqual(self.getSnapshot(c, novel)[1]['permission'][0]['user'], another.pk)
+        # Nor to who merely reads the novel, though they count towards the limit
+        another_client = Client()
+        another_client.login(username='AnotherUser', password='Another')
+        for client in [Client(), another_client]:
+            response = self.getChanges(client, novel, 2, limit=1)
+            self.assertEqual((response['changes'], response['next_since'], response['has_more']), ([], 3, False))
+            self.assertEqual([change['type'] for change in self.getChanges(client, novel, 0)['changes']],
+                             ['character', 'description'])
+            self.assertNotIn('permission', self.getSnapshot(client, novel, limit=1)[1])
+
+
+@override_settings(EVENT_STREAM={'MAX_DURATION': 0.3, 'POLL_INTERVAL': 0.1})
+class EventStreamTestCase(NovelRecorderTestBase):
+    def readEvents(self, response):
+        return [event for event in b''.join(response.streaming_content).decode().split('\n\n') if event]
+
+    def test_eventStream(self):
+        c = self.login()
+        novel = self.createNovel(c, 1)
+        self.createCharacter(c, novel, 1, 1)
+        url = reverse('novelrecorder:novel_events', kwargs={'pk': novel.pk})
+        response = c.get(url, {'since': 0})
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        events = self.readEvents(response)
+        self.assertEqual(events[0], 'retry: 3000')
+        self.assertTrue(events[1].startswith('id: 1\nevent: character.create\ndata: '))
+        self.assertTrue(events[2].startswith('id: 2\nevent: description.create\n'))
+        # Resumes from Last-Event-ID, and without it from now on
+        self.assertEqual(len(self.readEvents(c.get(url, HTTP_LAST_EVENT_ID='1'))), 2)
+        self.assertEqual(len(self.readEvents(c.get(url))), 1)
+        detail_url = reverse('novelrecorder:novel_detail', kwargs={'pk': novel.pk})
+        self.assertContains(c.get(detail_url), 'EventSource')
+
+        # Only for those who can write to the novel, not its readers
+        self.assertNotContains(Client().get(detail_url), 'EventSource')
+        another = Client()
+        another.login(username="AnotherUser", password='Another')
+        self.assertEqual(another.get(url).status_code, 403)
+
+    def test_changeNotifier(self):
+        notifier = changelog.ChangeNotifier()
+        self.assertFalse(notifier.wait(1, 0, 0.01))
+        notifier.notify(1, 3)
+        self.assertTrue(notifier.wait(1, 2, 0.01))
+        self.assertFalse(notifier.wait(1, 3, 0.01))
+
+
+# The ASGI handler runs the views on other threads, which only see committed data.
+@override_settings(EVENT_STREAM={'MAX_DURATION': 0.3, 'POLL_INTERVAL': 0.1},
+                   METRICS_DIRECTORY=os.path.join(tempfile.gettempdir(), 'novelrecorder_test_metrics'), DATABASE_SHARDS=[])
+class AsgiTestCase(TransactionTestCase):
+    def setUp(self):
+        from django.core.wsgi import get_wsgi_application
+        from novelrecorder.asgi import ASGIHandler
+        self.application = ASGIHandler(get_wsgi_application(), threads=4)
+        author = NovelUser.objects.create(username="TestUser", email="test@example.com", password=make_password("Test"))
+        self.novel = Novel.objects.create(author=author, name='Test Novel', is_public=True)
+        character = Character.objects.create(novel=self.novel, name='Test Character')
+        Description.objects.create(author=author, character=character, title='Title', content='Content')
+
+    def request(self, path, query_string=b'', user=None):
+        messages = []
+
+        async def receive():
+            if not messages:
+                messages.append({'type': 'http.request', 'body': b'', 'more_body': False})
+                return messages[0]
+            await asyncio.sleep(3600)  # Never disconnects
+
+        sent = []
+
+        async def send(message):
+            sent.append(message)
+
+        headers = []
+        if user is not None:
+            client = Client()
+            client.force_login(user)
+            headers.append((b'cookie', ('%s=%s' % (settings.SESSION_COOKIE_NAME, client.cookies[
+                settings.SESSION_COOKIE_NAME].value)).encode('latin-1')))
+        scope = {'type': 'http', 'method': 'GET', 'path': path, 'query_string': query_string, 'headers': headers,
+                 'http_version': '1.1'}
+        asyncio.run(self.application(scope, receive, send))
+        return sent[0]['status'], b''.join(message.get('body', b'') for message in sent[1:]).decode()
+
+    def test_asgiView(self):
+        status, body = self.request(reverse('novelrecorder:novel_detail', kwargs={'pk': self.novel.pk}))
+        self.assertEqual(status, 200)
+        self.assertIn('Test Character', body)
+
+    def test_asgiEventStream(self):
+        status, body = self.request(reverse('novelrecorder:novel_events', kwargs={'pk': self.novel.pk}), b'since=0',
+                                    self.novel.author)
+        self.assertEqual(status, 200)
+        self.assertIn('event: character.create', body)
+        self.assertIn('event: description.create', body)
+
+        # Reading the novel isn't enough
+        status, body = self.request(reverse('novelrecorder:novel_events', kwargs={'pk': self.novel.pk}))
+        self.assertEqual(status, 403)
+
+    @override_settings(DATA_UPLOAD_MAX_MEMORY_SIZE=10)
+    def test_asgiBodyLimited(self):
+        received = []
+
+        async def receive():
+            received.append(1)
+            return {'type': 'http.request', 'body': b'123456', 'more_body': True}  # Never ends
+
+        sent = []
+
+        async def send(message):
+            sent.append(message)
+
+        scope = {'type': 'http', 'method': 'POST', 'path': reverse('novelrecorder:novel_detail_create'),
+                 'query_string': b'', 'headers': [], 'http_version': '1.1'}
+        asyncio.run(self.application(scope, receive, send))
+        self.assertEqual((sent[0]['status'], len(received)), (413, 2))
+
+    @override_settings(CONCURRENT_QUERIES=True)
+    def test_runConcurrently(self):
+        recorder = QueryRecorder()
+        with connection.execute_wrapper(recorder):
+            results = run_concurrently(lambda: (threading.current_thread().name, Novel.objects.count()),
+                                       lambda: (threading.current_thread().name, Character.objects.count()))
+        self.assertEqual([count for name, count in results], [1, 1])
+        self.assertTrue(all(name.startswith('novelrecorder-query') for name, count in results))
+        self.assertEqual(recorder.count, 2)
+        # On every database, from the threads at once
+        with ExitStack() as stack:
+            for alias_connection in connections.all():
+                stack.enter_context(alias_connection.execute_wrapper(recorder))
+            results = run_concurrently(*[lambda: {alias_connection.alias: recorder in alias_connection.execute_wrappers
+                                                  for alias_connection in connections.all()}] * 2)
+        self.assertEqual(results, [{alias: True for alias in connections}] * 2)
+        recorder = QueryRecorder()
+        threads = [threading.Thread(target=lambda: [recorder(lambda *args: None, 'SELECT %s' % (index % 5), (), False, {})
+                                                    for index in range(1000)]) for thread in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual((recorder.count, sum(entry['count'] for entry in recorder.fingerprints.values())), (8000, 8000))
+        # In a transaction the other connections wouldn't see its data
+        with transaction.atomic():
+            self.assertEqual(run_concurrently(lambda: threading.current_thread().name)[0], threading.current_thread().name)
+
+
+@override_settings(DATABASE_REPLICAS=['replica1'])
+class ReplicaRouterTestCase(NovelRecorderTestBase):
+    # The database the reads of a request would be routed to, without running any query on the replica
+    def routeRead(self, method, path, cookies=None):
+        factory = RequestFactory()
+        for name, value in (cookies or {}).items():
+            factory.cookies[name] = value
+        request = getattr(factory, method.lower())(path)
+        request.resolver_match = resolve(path)
+        routed = []
+
+        def get_response(request):
+            middleware.process_view(request, request.resolver_match.func, (), {})
+            routed.append(router.db_for_read(Novel))
+            return HttpResponse()
+
+        middleware = ReplicaRoutingMiddleware(get_response)
+        router = ReplicaRouter()
+        response = middleware(request)
+        self.assertEqual(router.db_for_read(Novel), 'default')  # Reset after the request
+        self.assertEqual(router.db_for_write(Novel), 'default')
+        return routed[0], response
+
+    def test_replicaRouting(self):
+        self.assertEqual(self.routeRead('GET', reverse('novelrecorder:public_novel_list'))[0], 'replica1')
+        self.assertEqual(self.routeRead('GET', reverse('api_v1:novel-list'))[0], 'replica1')
+        self.assertEqual(self.routeRead('GET', reverse('login'))[0], 'default')
+        routed, response = self.routeRead('POST', reverse('novelrecorder:novel_detail_create'))
+        self.assertEqual(routed, 'default')
+        # Read-after-write: the client's reads stay on the primary for a while after a write
+        cookie = response.cookies[STICKY_COOKIE_NAME]
+        routed, response = self.routeRead('GET', reverse('novelrecorder:public_novel_list'),
+                                          {STICKY_COOKIE_NAME: cookie.value})
+        self.assertEqual(routed, 'default')
+
+
+# Needs a second database: NOVELRECORDER_SHARD_URLS=sqlite:////tmp/shard1.sqlite3 for example.
+@skipUnless('shard1' in settings.DATABASES, 'No shard1 database configured.')
+@override_settings(DATABASE_SHARDS=['default', 'shard1'])
+class ShardingTestCase(NovelRecorderTestBase):
+    databases = {'default', 'shard1'}
+
+    def setUp(self):
+        super().setUp()
+        sharding._shard_map.clear()
+
+    def createShardedNovels(self, c):
+        novel0 = self.createNovel(c, 0)
+        novel1 = self.createNovel(c, 1)
+        self.assertEqual([novel0.shard, novel1.shard], ['default', 'shard1'])  # Placed on the emptiest shard
+        self.assertTrue(Novel.objects.using('shard1').filter(pk=novel1.pk).exists())  # The copy for joins
+        return novel0, novel1
+
+    def test_shardRouting(self):
+        c = self.login()
+        novel0, novel1 = self.createShardedNovels(c)
+        data = {'name': 'Sharded', 'des_title': 'Title', 'des_content': 'Content'}
+        id0 = c.post(reverse('api_v1:character-list'), dict(data, novel=novel0.pk)).json()['id']
+        id1 = c.post(reverse('api_v1:character-list'), dict(data, novel=novel1.pk)).json()['id']
+        self.assertNotEqual(id0, id1)  # The ids are unique across the shards
+        self.assertEqual(list(Character.objects.using('shard1').values_list('id', flat=True)), [id1])
+        self.assertEqual(Description.objects.using('shard1').get(character_id=id1).title, 'Title')
+        response = c.get(reverse('novelrecorder:character_detail', kwargs={'pk': id1}))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['character'].pk, id1)
+        response = c.get(reverse('api_v1:character-list'), {'novel': novel1.pk})
+        self.assertEqual([character['id'] for character in response.json()['results']], [id1])
+        self.assertEqual(c.get(reverse('novelrecorder:index')).context['num_characters'], 2)
+        # The HTML forms post to the shard of the object in their query string
+        url = reverse('novelrecorder:description_detail_create') + '?character_id=%s' % id1
+        c.post(url, {'character': 'Sharded', 'title': 'Second', 'content': 'Content'})
+        self.assertEqual(Description.objects.using('shard1').filter(character_id=id1).count(), 2)
+        # A write to the wrong shard is refused
+        with sharding.using_shard('default'), self.assertRaises(DataErrorException):
+            Character.objects.create(novel=novel1, name='Misrouted')
+
+    def test_shardMove(self):
+        c = self.login()
+        novel0, novel1 = self.createShardedNovels(c)
+        data = {'novel': novel1.pk, 'name': 'Moving', 'des_title': 'Title', 'des_content': 'Content'}
+        characterId = c.post(reverse('api_v1:character-list'), data).json()['id']
+        c.post(reverse('api_v1:character-list'), dict(data, novel=novel0.pk))
+        # A writer still routed to the old shard after the switch is rolled back
+        with self.assertRaises(ShardMovedException), sharding.using_shard('shard1'), changelog.recording_changes():
+            Character.objects.create(novel=novel1, name='Late')
+            Novel.objects.filter(pk=novel1.pk).update(shard='default')
+        self.assertFalse(Character.objects.using('shard1').filter(name='Late').exists())
+
+        self.assertTrue(sharding.move_novel(novel1, 'default', wait=0))
+        self.assertEqual(Novel.objects.get(pk=novel1.pk).shard, 'default')
+        self.assertFalse(Character.objects.using('shard1').exists())
+        self.assertFalse(Novel.objects.using('shard1').filter(pk=novel1.pk).exists())
+        self.assertEqual(Character.objects.using('default').get(pk=characterId).name, 'Moving')
+        self.assertEqual(c.get(reverse('novelrecorder:character_detail', kwargs={'pk': characterId})).status_code, 200)
+        # The blob of the text went along, the one on shard1 is left for the garbage collection
+        blob = Character.objects.using('default').get(pk=characterId).getPrimaryDescription().blob
+        self.assertEqual((blob.content, blob.ref_count), ('Content', 2))
+        self.assertEqual(DescriptionBlob.objects.using('shard1').get(hash=blob.hash).ref_count, 0)
+        self.assertEqual(DescriptionRevision.objects.using('default').filter(description__character=characterId).count(), 1)
+        self.assertFalse(DescriptionRevision.objects.using('shard1').exists())
+        # Both novels are on 'default' now, the rebalancing moves one back
+        out = StringIO()
+        call_command('rebalance_shards', '--apply', '--wait', '0', stdout=out)
+        self.assertIn('-> shard1', out.getvalue())
+        self.assertEqual(sorted(Novel.objects.values_list('shard', flat=True)), ['default', 'shard1'])
+
+    def test_shardClone(self):
+        c = self.login()
+        novel0, novel1 = self.createShardedNovels(c)
+        data = {'name': 'Sharded', 'des_title': 'Title', 'des_content': 'Content'}
+        c.post(reverse('api_v1:character-list'), dict(data, novel=novel1.pk))
+        response = c.post(reverse('api_v1:novel-clone', kwargs={'pk': novel1.pk}))
+        self.assertEqual(response.status_code, 201, response.content)
+        clone = Novel.objects.get(pk=response.json()['id'])
+        self.assertEqual(clone.shard, 'shard1')
+        copy = Character.objects.using('shard1').get(novel=clone)
+        self.assertEqual((copy.name, copy.getPrimaryDescription().title), ('Sharded', 'Title'))
+        self.assertEqual(DescriptionRevision.objects.using('shard1').filter(description__character=copy).count(), 1)
+        # Its ids from the allocator, which the next character doesn't get again
+        id2 = c.post(reverse('api_v1:character-list'), dict(data, novel=novel0.pk)).json()['id']
+        self.assertNotEqual(id2, copy.pk)
+
+    def test_shardReadableLists(self):
+        c = self.login()
+        novel0, novel1 = self.createShardedNovels(c)
+        data = {'name': 'Sharded', 'des_title': 'Title', 'des_content': 'Content'}
+        id1 = c.post(reverse('api_v1:character-list'), dict(data, novel=novel1.pk)).json()['id']
+        novel1 = Novel.objects.get(pk=novel1.pk)
+        novel1.is_public = False
+        novel1.save()  # The copy on shard1 too, which the list is filtered through
+        another = Client()
+        another.login(username='AnotherUser', password='Another')
+        url = reverse('api_v1:character-list')
+        self.assertEqual(another.get(url, {'novel': novel1.pk}).json()['results'], [])
+        self.assertEqual(Client().get(url, {'novel': novel1.pk}).json()['results'], [])
+        self.assertEqual([character['id'] for character in c.get(url, {'novel': novel1.pk}).json()['results']], [id1])
+        with sharding.using_novel(novel1):
+            NovelUserPermissionModel.objects.create(novel=novel1, user=NovelUser.objects.get(username='AnotherUser'),
+                                                    permission=NUP_VIEW_ONLY)
+        self.assertEqual([character['id'] for character in another.get(url, {'novel': novel1.pk}).json()['results']],
+                         [id1])
+        response = another.get(reverse('api_v1:description-list'), {'character': id1})
+        self.assertEqual([description['title'] for description in response.json()['results']], ['Title'])
+        response = another.get(reverse('api_v1:novel-list'))
+        self.assertEqual(sorted(novel['id'] for novel in response.json()['results']), [novel0.pk, novel1.pk])
+        # Not filtered by a novel, the list would be of one shard only
+        response = c.get(url)
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('filter the list by novel', response.json()['detail'])
+
+
+class QueryPlanTestCase(NovelRecorderTestBase):
+    def test_hotQueriesUseIndexes(self):
+        NovelGenerator('tiny', seed=1).generate()
+        objects = pick_objects()
+        self.assertEqual(check_query_plans(objects), {name: [] for name in get_hot_queries(objects)})
+        # Whereas a query no index is for reads the whole table
+        self.assertEqual(get_sequential_scans(explain(Novel.objects.filter(name='Benchmark')), connection.vendor),
+                         ['novelrecorder_novel'])
+
+
+class DescriptionExcerptTestCase(NovelRecorderTestBase):
+    def test_excerptMaintained(self):
+        c = self.login()
+        novel = self.createNovel(c, 1)
+        character = self.createCharacter(c, novel, 1, 1)
+        description = character.getPrimaryDescription()
+        self.assertEqual((description.excerpt, description.word_count), (self.getDescContent(1), 4))
+
+        description.content = ' '.join(['word'] * 100)
+        description.save(update_fields=['content'])
+        description.refresh_from_db()
+        self.assertEqual(description.word_count, 100)
+        self.assertTrue(description.excerpt.endswith('word…'))
+        self.assertLessEqual(len(description.excerpt), 201)
+
+        # The bulk writes of the batches too
+        response = c.post(reverse('api_v1:novel-batch', kwargs={'pk': novel.pk}), json.dumps({'operations': [
+            {'op': 'update', 'type': 'description', 'id': description.pk, 'data': {'content': 'Short again'}},
+        ]}), content_type='application/json')
+        self.assertEqual(response.status_code, 200, response.content)
+        description.refresh_from_db()
+        self.assertEqual((description.excerpt, description.word_count), ('Short again', 2))
+
+    def test_listsLeaveContent(self):
+        c = self.login()
+        novel = self.createNovel(c, 1)
+        character = self.createCharacter(c, novel, 1, 1)
+        self.createCharacterDescription(c, character, 2)
+        urls = [reverse('novelrecorder:character_detail', kwargs={'pk': character.pk}),
+                reverse('novelrecorder:novel_detail', kwargs={'pk': novel.pk})]
+        for url in urls:
+            with CaptureQueriesContext(connection) as queries:
+                response = c.get(url)
+            self.assertEqual(response.status_code, 200, url)
+            self.assertContains(response, self.getDescContent(1), msg_prefix=url)  # The excerpt of it
+            self.assertFalse([query['sql'] for query in queries if 'novelrecorder_descriptionblob' in query['sql']], url)
+
+
+@override_settings(CONTENT_COMPRESSION={'THRESHOLD': 100})
+class CompressionTestCase(NovelRecorderTestBase):
+    def getStored(self, description):
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT content FROM novelrecorder_descriptionblob WHERE hash = %s', [description.blob_id])
+            return cursor.fetchone()[0]
+
+    def createLongDescription(self, c, character, content):
+        c.post(reverse('novelrecorder:description_detail_create'), {'character': character, 'title': 'Long', 'content': content})
+        return Description.objects.get(title='Long')
+
+    def test_compressedContent(self):
+        c = self.login()
+        novel = self.createNovel(c, 1)
+        character = self.createCharacter(c, novel, 1, 1)
+        content = 'Chapter one. ' * 100 + 'Ünïcode ✓'
+        description = self.createLongDescription(c, character, content)
+        self.assertTrue(compression.is_compressed(self.getStored(description)))
+        self.assertLess(len(self.getStored(description)), len(content) / 5)
+        self.assertEqual(''.join(compression.iter_decompressed(self.getStored(description), chunk_size=10)), content)
+        self.assertContains(c.get(reverse('novelrecorder:description_detail', kwargs={'pk': description.pk})), 'Chapter one.')
+
+        # Decompressed when it's read, and copied (e.g. to another shard) without being
+        blob = DescriptionBlob.objects.get(hash=description.blob_id)
+        self.assertTrue(compression.is_unread(blob, 'content'))
+        blob.hash = 'copy'
+        DescriptionBlob.objects.bulk_create([blob])
+        self.assertTrue(compression.is_unread(blob, 'content'))
+        copy = DescriptionBlob.objects.get(hash='copy')
+        self.assertEqual(copy.content, content)
+        self.assertFalse(compression.is_unread(copy, 'content'))
+
+        # Short texts, and those that could be taken for a stored value
+        for text in ['Short', compression.MARKER + 'z not compressed', '']:
+            description.content = text
+            description.save()
+            self.assertEqual(Description.objects.get(pk=description.pk).content, text)
+
+    def test_compressDescriptionsCommand(self):
+        c = self.login()
+        novel = self.createNovel(c, 1)
+        character = self.createCharacter(c, novel, 1, 1)
+        content = ' '.join(['Written before the compression.'] * 20)
+        with self.settings(CONTENT_COMPRESSION={'THRESHOLD': 10 ** 6}):
+            description = self.createLongDescription(c, character, content)
+        self.assertEqual(self.getStored(description), content)
+
+        call_command('compress_descriptions', batch_size=1, stdout=StringIO())
+        self.assertTrue(compression.is_compressed(self.getStored(description)))
+        self.assertEqual(Description.objects.get(pk=description.pk).content, content)
+        call_command('compress_descriptions', decompress=True, stdout=StringIO())
+        self.assertEqual(self.getStored(description), content)
+
+
+class DescriptionBlobTestCase(NovelRecorderTestBase):
+    def test_blobsShared(self):
+        c = self.login()
+        novel = self.createNovel(c, 1)
+        character1 = self.createCharacter(c, novel, 1, 1)
+        character2 = self.createCharacter(c, novel, 2, 1)  # The same text
+        description1, description2 = character1.getPrimaryDescription(), character2.getPrimaryDescription()
+        self.assertEqual(description1.blob_id, description2.blob_id)
+        self.assertEqual((DescriptionBlob.objects.count(), description1.blob.ref_count), (1, 2))
+
+        description2.content = 'Changed'
+        description2.save()
+        self.assertEqual(dict(DescriptionBlob.objects.values_list('content', 'ref_count')),
+                         {self.getDescContent(1): 1, 'Changed': 1})
+        # Exported once per text
+        snapshot = self.client.get(reverse('api_v1:novel-snapshot', kwargs={'pk': novel.pk})).json()
+        self.assertEqual(snapshot['data']['blob'], {description1.blob_id: self.getDescContent(1), description2.blob_id: 'Changed'})
+        self.assertEqual(sorted(description['blob'] for description in snapshot['data']['description']),
+                         sorted([description1.blob_id, description2.blob_id]))
+
+        c.delete(reverse('api_v1:character-detail', kwargs={'pk': character2.pk}))
+        self.assertEqual(DescriptionBlob.objects.get(hash=description2.blob_id).ref_count, 0)
+        DescriptionBlob.objects.filter(hash=description1.blob_id).update(ref_count=0)  # E.g. a failed write
+        out = StringIO()
+        call_command('collect_blobs', recount=True, stdout=out)
+        self.assertIn('default: 1 blobs deleted', out.getvalue())
+        self.assertEqual(list(DescriptionBlob.objects.values_list('hash', 'ref_count')), [(description1.blob_id, 1)])
+
+
+class DescriptionRevisionTestCase(NovelRecorderTestBase):
+    def getVersion(self, version):
+        return '\n'.join('Line %s of version %s' % (line, version if line == version % 5 else 0) for line in range(5))
+
+    def createEditedDescription(self, c, versions):
+        novel = self.createNovel(c, 1)
+        description = self.createCharacter(c, novel, 1, 1).getPrimaryDescription()
+        for version in range(2, versions + 1):
+            description.content = self.getVersion(version)
+            description.save()
+        description.title = 'Retitled'
+        description.save()
+        return description
+
+    def test_revisionsRebuilt(self):
+        c = self.login()
+        description = self.createEditedDescription(c, 45)
+        self.assertEqual(description.revisions.count(), 46)
+        self.assertEqual(list(description.revisions.filter(is_snapshot=True).values_list('number', flat=True)),
+                         [41, 21, 1])
+        # Each from its snapshot, in one query
+        for number, content in [(1, self.getDescContent(1)), (20, self.getVersion(20)), (44, self.getVersion(44)),
+                                (45, self.getVersion(45))]:
+            with CaptureQueriesContext(connection) as queries:
+                self.assertEqual(revisions.get_revision(description, number).content, content)
+            self.assertEqual(len(queries), 1)
+        response = c.get(reverse('api_v1:description-revision', kwargs={'pk': description.pk, 'number': 46})).json()
+        self.assertEqual((response['title'], response['content']), ('Retitled', self.getVersion(45)))
+        self.assertEqual(c.get(reverse('api_v1:description-revision', kwargs={'pk': description.pk, 'number': 47}))
+                         .status_code, 404)
+        # Keyset paginated, the latest first
+        url = reverse('api_v1:description-history', kwargs={'pk': description.pk})
+        page = c.get(url, {'limit': 40}).json()
+        self.assertEqual([revision['number'] for revision in page['revisions']], list(range(46, 6, -1)))
+        self.assertTrue(page['has_more'])
+        page = c.get(url, {'limit': 40, 'before': 7}).json()
+        self.assertEqual(([revision['number'] for revision in page['revisions']], page['has_more']),
+                         ([6, 5, 4, 3, 2, 1], False))
+
+    def test_pruneRevisions(self):
+        c = self.login()
+        description = self.createEditedDescription(c, 30)
+        description.revisions.update(time_created=timezone.now() - timedelta(days=100))
+        out = StringIO()
+        call_command('prune_revisions', keep=15, days=30, stdout=out)
+        self.assertIn('default: 16 revisions deleted', out.getvalue())
+        # The oldest one kept is a snapshot now, with a blob of its own
+        self.assertEqual(list(description.revisions.filter(is_snapshot=True).values_list('number', flat=True)),
+                         [21, 17])
+        DescriptionBlob.objects.collect_garbage('default')
+        for number in range(17, 31):
+            self.assertEqual(revisions.get_revision(description, number).content, self.getVersion(number))
+        # Only the ones older than --days
+        self.createCharacterDescription(c, description.character, 2)
+        call_command('prune_revisions', keep=0, days=30, stdout=out)
+        self.assertEqual(Description.objects.get(title=self.getDescTitle(2)).revisions.count(), 1)
+        self.assertEqual(description.revisions.count(), 1)
+
+
+class RenderingTestCase(NovelRecorderTestBase):
+    content = '# Heading\n\nSome **bold** text, <script>escaped</script>\n\n- one\n- two'
+
+    def test_markdownRendered(self):
+        c = self.login()
+        novel = self.createNovel(c, 1)
+        data = {'name': 'Rendered', 'novel': novel, 'des_title': 'Title', 'des_content': self.content}
+        c.post(reverse_lazy('novelrecorder:character_detail_create'), data=data)
+        description = Description.objects.get(title='Title')
+        self.assertEqual(description.blob.html_version, rendering.RENDERER_VERSION)
+        self.assertEqual(description.excerpt_html, 'Heading Some <strong>bold</strong> text, '
+                                                   '&lt;script&gt;escaped&lt;/script&gt; one two')
+        # Rendered when saved, not per request
+        with patch('novelrecorder.rendering.render_markdown', side_effect=AssertionError('Rendered again')):
+            response = c.get(reverse('novelrecorder:description_detail', kwargs={'pk': description.pk}))
+            self.assertContains(response, '<h1>Heading</h1>\n<p>Some <strong>bold</strong> text, '
+                                          '&lt;script&gt;escaped&lt;/script&gt;</p>\n<ul>\n<li>one</li>')
+            response = c.get(reverse('novelrecorder:character_detail', kwargs={'pk': description.character_id}))
+            self.assertContains(response, '<td>Heading Some <strong>bold</strong> text,')
+        self.assertEqual(rendering.render_markdown('[link](javascript:alert(1)) [ok](https://example.com/?a=1&b=2)'),
+                         '<p>[link](javascript:alert(1)) '
+                         '<a href="https://example.com/?a=1&amp;b=2" rel="nofollow">ok</a></p>')
+
+    def test_emphasisRenderedInOnePass(self):
+        self.assertEqual(rendering.render_markdown('**a** _b_ *c **d** e*'),
+                         '<p><strong>a</strong> <em>b</em> <em>c <strong>d</strong> e</em></p>')
+        # Opening marks with no closing one aren't each searched to the end of the line
+        text = '*a ' * 100000
+        start = time.monotonic()
+        self.assertEqual(rendering.render_markdown(text), '<p>%s</p>' % text.strip())
+        self.assertLess(time.monotonic() - start, 5)
+
+    def test_nestedQuotesRendered(self):
+        self.assertEqual(rendering.render_markdown('> a\n> > b'),
+                         '<blockquote>\n<p>a</p>\n<blockquote>\n<p>b</p>\n</blockquote>\n</blockquote>')
+        # Deeper than QUOTE_MAX_DEPTH, the marks are text
+        c = self.login()
+        novel = self.createNovel(c, 1)
+        data = {'name': 'Quoted', 'novel': novel, 'des_title': 'Title', 'des_content': '> ' * 1000 + 'x'}
+        c.post(reverse_lazy('novelrecorder:character_detail_create'), data=data)
+        html = Description.objects.get(title='Title').content_html
+        self.assertEqual(html.count('<blockquote>'), rendering.QUOTE_MAX_DEPTH)
+        self.assertIn('<p>%sx</p>' % ('&gt; ' * (1000 - rendering.QUOTE_MAX_DEPTH)), html)
+
+    def test_renderDescriptionsCommand(self):
+        c = self.login()
+        novel = self.createNovel(c, 1)
+        description = self.createCharacter(c, novel, 1, 1).getPrimaryDescription()
+        DescriptionBlob.objects.update(html=None)
+        Description.objects.update(excerpt_html='')
+        out = StringIO()
+        call_command('render_descriptions', excerpts=True, stdout=out)
+        self.assertIn('default: 1 blobs rendered', out.getvalue())
+        self.assertIn('default: 1 excerpts rendered', out.getvalue())
+        description.refresh_from_db()
+        self.assertEqual((description.blob.html, description.excerpt_html),
+                         ('<p>%s</p>' % self.getDescContent(1), self.getDescContent(1)))
+        # Or, for an older version, as it's read
+        DescriptionBlob.objects.update(html='Old', html_version=rendering.RENDERER_VERSION - 1)
+        description = Description.objects.select_related('blob').get(pk=description.pk)
+        self.assertEqual(description.content_html, '<p>%s</p>' % self.getDescContent(1))
+        self.assertEqual(DescriptionBlob.objects.get().html_version, rendering.RENDERER_VERSION)
+
+
+class CloneTestCase(NovelRecorderTestBase):
+    def test_cloneNovel(self):
+        c = self.login()
+        novel = self.createNovel(c, 1)
+        character1 = self.createCharacter(c, novel, 1, 1)
+        character2 = self.createCharacter(c, novel, 2, 2)
+        relationship = self.createRelationship(c, character1, character2, 3)
+        description = self.createCharacterDescription(c, character1, 4)
+        Description.objects.filter(pk=description.pk).update(sort_order=0)  # Before the primary one now
+        another = NovelUser.objects.get(username='AnotherUser')
+        third = NovelUser.objects.create(username='ThirdUser', email='third@example.com')
+        NovelUserPermissionModel.objects.create(novel=novel, user=another, permission=NUP_VIEW_ONLY)
+        NovelUserPermissionModel.objects.create(novel=novel, user=third, permission=NUP_COEDITOR)
+
+        response = c.post(reverse('api_v1:novel-clone', kwargs={'pk': novel.pk}))
+        self.assertEqual(response.status_code, 201, response.content)
+        clone = Novel.objects.get(pk=response.json()['id'])
+        self.assertEqual(clone.name, 'Test Novel 1 (copy)')
+        characters = {character.name: character for character in Character.objects.filter(novel=clone)}
+        self.assertEqual(sorted(characters), ['Test Character 1', 'Test Character 2'])
+        self.assertEqual(list(Relationship.objects.filter(character1__novel=clone).values_list('character1', 'character2')),
+                         [(characters['Test Character 1'].pk, characters['Test Character 2'].pk)])
+        # The descriptions in the same order, sharing the blobs
+        copied = characters['Test Character 1'].description_set.all()
+        self.assertEqual([(d.title, d.content, d.is_primary) for d in copied],
+                         [(self.getDescTitle(4), self.getDescContent(4), False),
+                          (self.getDescTitle(1), self.getDescContent(1), True)])
+        self.assertEqual(DescriptionBlob.objects.get(hash=description.blob_id).ref_count, 2)
+        self.assertEqual(DescriptionRevision.objects.filter(description__in=copied).count(), 2)
+        self.assertEqual(list(NovelUserPermissionModel.objects.filter(novel=clone).order_by('user')
+                              .values_list('user', 'permission')),
+                         [(another.pk, NUP_VIEW_ONLY), (third.pk, NUP_COEDITOR)])
+        # A client syncing the copy starts from the snapshot pages of it
+        changes = c.get(reverse('api_v1:novel-changes', kwargs={'pk': clone.pk}), {'since': 0}).json()
+        self.assertEqual((changes['snapshot'], changes['changes']), ({'seq': 1, 'compacted_seq': 1}, []))
+        snapshot = c.get(reverse('api_v1:novel-snapshot', kwargs={'pk': clone.pk})).json()
+        self.assertEqual((snapshot['seq'], len(snapshot['data']['description'])), (1, 4))
+        # Who can read the novel can clone it, from the HTML too
+        another.set_password('Another')
+        another.save()
+        c2 = Client()
+        c2.login(username='AnotherUser', password='Another')
+        response = c2.post(reverse('novelrecorder:novel_clone', kwargs={'pk': clone.pk}))
+        self.assertRedirects(response, reverse('novelrecorder:novel_detail', kwargs={'pk': clone.pk + 1}),
+                             fetch_redirect_response=False)
+        self.assertEqual(Novel.objects.get(author=another).name, 'Test Novel 1 (copy) (copy)')
+        # Without the grants of the original, which only its author and co-editors can give
+        self.assertFalse(NovelUserPermissionModel.objects.filter(novel__author=another).exists())
+        out = StringIO()
+        call_command('clone_novel', novel.pk, 'TestUser', stdout=out)
+        self.assertIn('(Test Novel 1 (copy 2))', out.getvalue())
+
+
+class DeletionTestCase(NovelRecorderTestBase):
+    def test_deleteCharacterAndNovel(self):
+        c = self.login()
+        novel = self.createNovel(c, 1)
+        character1 = self.createCharacter(c, novel, 1, 1)
+        character2 = self.createCharacter(c, novel, 2, 2)
+        relationship = self.createRelationship(c, character1, character2, 3)
+        description = self.createRelationshipDescription(c, relationship, 4)
+        deleted = {('character', character1.pk), ('relationship', relationship.pk)} | \
+            {('description', pk) for pk in Description.objects.filter(
+                Q(character=character1) | Q(relationship=relationship)).values_list('pk', flat=True)}
+
+        # The relationships and descriptions go with the character, without protecting it
+        response = c.post(reverse('novelrecorder:character_detail_delete', kwargs={'pk': character1.pk}),
+                          {'novel_id': novel.pk})
+        self.assertRedirects(response, reverse('novelrecorder:novel_detail', kwargs={'pk': novel.pk}),
+                             fetch_redirect_response=False)
+        self.assertEqual(list(Character.objects.filter(novel=novel)), [character2])
+        self.assertFalse(Relationship.objects.exists())
+        self.assertEqual(list(Description.objects.values_list('title', flat=True)), [self.getDescTitle(2)])
+        self.assertEqual(DescriptionRevision.objects.count(), 1)
+        self.assertEqual(DescriptionBlob.objects.get(hash=description.blob_id).ref_count, 0)
+        changes = c.get(reverse('api_v1:novel-changes', kwargs={'pk': novel.pk}), {'since': 0}).json()['changes']
+        self.assertEqual({(change['type'], change['id']) for change in changes if change['action'] == 'delete'},
+                         deleted)
+
+        # A novel by its author only, with the counts of what's deleted
+        url = reverse('api_v1:novel-detail', kwargs={'pk': novel.pk})
+        another = NovelUser.objects.get(username='AnotherUser')
+        NovelUserPermissionModel.objects.create(novel=novel, user=another, permission=NUP_COEDITOR)
+        another.set_password('Another')
+        another.save()
+        c2 = Client()
+        c2.login(username='AnotherUser', password='Another')
+        self.assertEqual(c2.delete(url).status_code, 403)
+        response = c.delete(url)
+        self.assertEqual(response.status_code, 200, response.content)
+        objects = response.json()['objects']
+        self.assertEqual((objects['novelrecorder.Character'], objects['novelrecorder.Description'],
+                          objects['novelrecorder.NovelUserPermissionModel'], objects['novelrecorder.Novel']),
+                         (1, 1, 1, 1))
+        self.assertFalse(Novel.objects.filter(pk=novel.pk).exists())
+        self.assertEqual(set(DescriptionBlob.objects.values_list('ref_count', flat=True)), {0})
+
+
+class DescriptionBulkEditTestCase(NovelRecorderTestBase):
+    def test_bulkEditDescriptions(self):
+        c = self.login()
+        novel = self.createNovel(c, 1)
+        character = self.createCharacter(c, novel, 1, 1)
+        description1 = character.getPrimaryDescription()
+        description2 = self.createCharacterDescription(c, character, 2)
+        url = reverse('novelrecorder:description_bulk_edit_character', kwargs={'pk': character.pk})
+        response = c.get(url)
+        self.assertContains(response, 'name="%s-content"' % description2.pk)
+        self.assertContains(response, self.getDescContent(2))
+
+        # Nothing is written unless everything is valid
+        seq = Novel.objects.get(pk=novel.pk).change_seq
+        response = c.post(url, {'%s-title' % description1.pk: 'New Title 1', '%s-title' % description2.pk: ''})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(Description.objects.get(pk=description1.pk).title, self.getDescTitle(1))
+
+        # One bulk_update, one change_seq bump (for two changes) and a revision of each description changed
+        with CaptureQueriesContext(connection) as context:
+            response = c.post(url, {'%s-title' % description1.pk: 'New Title 1',
+                                    '%s-content' % description1.pk: 'New Content 1',
+                                    '%s-title' % description2.pk: self.getDescTitle(2),
+                                    '%s-content' % description2.pk: self.getDescContent(2)})
+        self.assertRedirects(response, reverse('novelrecorder:character_detail', kwargs={'pk': character.pk}),
+                             fetch_redirect_response=False)
+        updates = [query['sql'] for query in context.captured_queries if query['sql'].startswith('UPDATE')]
+        self.assertEqual(len([sql for sql in updates if 'novelrecorder_description"' in sql.split('SET')[0]]), 1)
+        self.assertEqual(len([sql for sql in updates if 'novelrecorder_novel"' in sql.split('SET')[0]]), 1)
+        self.assertEqual(Novel.objects.get(pk=novel.pk).change_seq, seq + 1)
+        description1.refresh_from_db()
+        self.assertEqual((description1.title, description1.content, description1.excerpt),
+                         ('New Title 1', 'New Content 1', 'New Content 1'))
+        self.assertEqual(description1.revisions.count(), 2)
+        self.assertEqual(description2.revisions.count(), 1)
+
+        # And through the API, for the descriptions of a relationship too
+        character2 = Character.objects.create(novel=novel, name='Test Character 2')
+        relationship = self.createRelationship(c, character, character2, 3)
+        url = reverse('api_v1:relationship-edit-descriptions', kwargs={'pk': relationship.pk})
+        primary = relationship.getPrimaryDescription()
+        response = c.post(url, {'descriptions': [{'id': primary.pk, 'content': 'Api Content'}, {'id': description1.pk}]},
+                          content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(list(response.json()['errors']), ['1'])
+        response = c.post(url, {'descriptions': [{'id': primary.pk, 'content': 'Api Content'}]},
+                          content_type='application/json')
+        self.assertEqual(response.json(), {'updated': [primary.pk]})
+        self.assertEqual(Description.objects.get(pk=primary.pk).content, 'Api Content')
+
+    def test_bulkEditDescriptionsOnly(self):
+        c = self.login()
+        novel = self.createNovel(c, 1)
+        character = self.createCharacter(c, novel, 1, 1)
+        description = character.getPrimaryDescription()
+        another = NovelUser.objects.get(username='AnotherUser')
+        c2 = Client()
+        c2.login(username='AnotherUser', password='Another')
+        url = reverse('api_v1:character-edit-descriptions', kwargs={'pk': character.pk})
+        data = {'descriptions': [{'id': description.pk, 'content': 'Edited'}]}
+        response = c2.post(url, data, content_type='application/json')
+        self.assertEqual(response.status_code, 400)  # Readable, but not the description
+        self.assertIn('no permission', response.json()['errors']['0'][0])
+        # Granted the descriptions only, not the character
+        NovelUserPermissionModel.objects.create(novel=novel, user=another, permission=NUP_DESCRIPTION_ONLY)
+        self.assertEqual(c2.post(url, data, content_type='application/json').json(), {'updated': [description.pk]})
+        url = reverse('novelrecorder:description_bulk_edit_character', kwargs={'pk': character.pk})
+        response = c2.post(url, {'%s-title' % description.pk: 'Edited Title', '%s-content' % description.pk: 'Edited'})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(Description.objects.get(pk=description.pk).title, 'Edited Title')
+
+
+class JobQueueTestCase(NovelRecorderTestBase):
+    def test_backgroundJobs(self):
+        c = self.login()
+        novel = self.createNovel(c, 1)
+        self.createCharacter(c, novel, 1, 1)
+        response = c.post(reverse('api_v1:novel-clone', kwargs={'pk': novel.pk}) + '?background=1')
+        self.assertEqual(response.status_code, 202, response.content)
+        job_id = response.json()['id']
+        self.assertEqual((response.json()['name'], response.json()['status']), ('clone_novel', JOB_QUEUED))
+
+        out = StringIO()
+        call_command('runworker', '--once', '--concurrency', '1', stdout=out)
+        self.assertIn('clone_novel #%s: done' % job_id, out.getvalue())
+        status = c.get(reverse('api_v1:job-detail', kwargs={'pk': job_id})).json()
+        self.assertEqual((status['status'], status['progress'], status['attempts']), (JOB_DONE, 1, 1))
+        clone = Novel.objects.get(pk=status['result']['novel'])
+        self.assertEqual(clone.name, 'Test Novel 1 (copy)')
+        self.assertEqual(Character.objects.filter(novel=clone).count(), 1)
+        self.assertEqual([job['id'] for job in c.get(reverse('api_v1:job-list'), {'status': JOB_DONE}).json()['results']],
+                         [job_id])
+        # Only its user sees a job
+        another = NovelUser.objects.get(username='AnotherUser')
+        c2 = Client()
+        c2.force_login(another)
+        self.assertEqual(c2.get(reverse('api_v1:job-detail', kwargs={'pk': job_id})).status_code, 404)
+
+        # A task that raises is run again later, until it has been run max_attempts times
+        runs = []
+
+        @jobs.task('test_failing')
+        def failing(report, number):
+            runs.append(number)
+            report(0.5, 'Halfway')
+            raise ValueError('Failed')
+        self.addCleanup(jobs.TASKS.pop, 'test_failing')
+        job = jobs.enqueue('test_failing', {'number': 7}, max_attempts=2)
+        self.assertEqual(jobs.run_worker(concurrency=1, once=True), 1)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts, job.progress, job.locked_by), (JOB_QUEUED, 1, 0.5, ''))
+        self.assertIn('ValueError: Failed', job.error)
+        self.assertGreater(job.run_after, timezone.now())
+        Job.objects.filter(pk=job.pk).update(run_after=timezone.now())
+        jobs.run_worker(concurrency=1, once=True)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts, runs), (JOB_FAILED, 2, [7, 7]))
+
+        # A job is claimed by one worker, and again by another once the lease of the first has run out
+        job = jobs.enqueue('test_failing', {'number': 8})
+        self.assertEqual(jobs.claim('worker1'), [job])
+        self.assertEqual(jobs.claim('worker2'), [])
+        Job.objects.filter(pk=job.pk).update(locked_until=timezone.now() - timedelta(seconds=1))
+        self.assertEqual([(claimed.locked_by, claimed.attempts) for claimed in jobs.claim('worker2')], [('worker2', 2)])
+        # The first one's reports and result don't apply any more
+        self.assertEqual(jobs.run(job, 'worker1'), JOB_RUNNING)
+        self.assertEqual(Job.objects.get(pk=job.pk).locked_by, 'worker2')
+
+
+class SharedCacheTestCase(NovelRecorderTestBase):
+    def getCache(self, path, **options):
+        return caching.SQLiteCache(path, {'OPTIONS': options})
+
+    def test_sqliteCache(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'cache.sqlite3')
+        cache1, cache2 = self.getCache(path), self.getCache(path)  # As two processes would have
+        cache1.set('a', {'value': 1})
+        self.assertEqual(cache2.get('a'), {'value': 1})
+        self.assertFalse(cache2.add('a', 2))
+        self.assertTrue(cache2.add('b', 2))
+        self.assertEqual(cache1.get_many(['a', 'b', 'c']), {'a': {'value': 1}, 'b': 2})
+        # The counters are shared
+        self.assertEqual([cache1.incr('b'), cache2.incr('b', 10), cache1.get('b')], [3, 13, 13])
+        with self.assertRaises(ValueError):
+            cache1.incr('a')
+        cache2.delete('a')
+        self.assertIsNone(cache1.get('a'))
+        # Expired entries are gone, and can be added again
+        cache1.set('c', 'c', 60)
+        with patch('novelrecorder.caching.time.time', return_value=time.time() + 61):
+            self.assertIsNone(cache1.get('c'))
+            self.assertFalse(cache1.has_key('c'))
+            self.assertTrue(cache2.add('c', 'again'))
+        cache1.set('d', 'd', 0)
+        self.assertIsNone(cache1.get('d'))
+
+        # Past the byte budget, the least recently used entries are evicted
+        small = self.getCache(os.path.join(directory, 'small.sqlite3'), MAX_BYTES=4000, ACCESS_RESOLUTION=0)
+        for index in range(3):
+            small.set('key%s' % index, 'x' * 1000)
+        small.get('key0')  # Used since key1 and key2 were written
+        small.set('key3', 'x' * 1000)
+        self.assertEqual(sorted(small.get_many(['key0', 'key1', 'key2', 'key3'])), ['key0', 'key2', 'key3'])
+        self.assertLessEqual(small.get_connection().execute('SELECT bytes FROM cache_size').fetchone()[0], 4000)
+        small.clear()
+        self.assertEqual(small.get_connection().execute('SELECT bytes FROM cache_size').fetchone()[0], 0)
+
+        # Bumping the version of a namespace invalidates its keys
+        key = caching.get_namespaced_key('novel', 'user:1', cache1)
+        cache1.set(key, 'cached')
+        self.assertEqual(caching.get_namespaced_key('novel', 'user:1', cache2), key)
+        caching.invalidate_namespace('novel', cache2)
+        self.assertNotEqual(caching.get_namespaced_key('novel', 'user:1', cache1), key)
+
+    def test_permissionCache(self):
+        c = self.login()
+        novel = self.createNovel(c, 1)
+        another = NovelUser.objects.get(username='AnotherUser')
+        permission = NovelUserPermission()
+        self.assertEqual(permission.get_permission_group(another, novel), NUP_MINIMAL)
+        with self.assertNumQueries(0):
+            self.assertEqual(permission.get_permission_group(another, novel), NUP_MINIMAL)
+        # Granting it invalidates the cached permissions of the novel
+        granted = NovelUserPermissionModel.objects.create(novel=novel, user=another, permission=NUP_VIEW_ONLY)
+        self.assertEqual(permission.get_permission_group(another, novel), NUP_VIEW_ONLY)
+        # Moved to another novel, the cached permissions of both
+        novel0 = self.createNovel(c, 0)
+        self.assertEqual(permission.get_permission_group(another, novel0), NUP_MINIMAL)
+        granted = NovelUserPermissionModel.objects.get(pk=granted.pk)
+        granted.novel = novel0
+        granted.save()
+        self.assertEqual(permission.get_permission_group(another, novel), NUP_MINIMAL)
+        self.assertEqual(permission.get_permission_group(another, novel0), NUP_VIEW_ONLY)
+        granted.delete()
+        self.assertEqual(permission.get_permission_group(another, novel0), NUP_MINIMAL)
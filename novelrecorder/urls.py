@@ -11,6 +11,8 @@ urlpatterns = [
     path('my_novel_list/', views.UserNovelListView.as_view(), name='my_novel_list'),
     path('novel_detail/<int:pk>/', views.NovelDetailView.as_view(), name='novel_detail'),
     path('novel_detail_create/', views.NovelDetailCreateView.as_view(), name='novel_detail_create'),
+    path('novel_events/<int:pk>/', views.novel_events, name='novel_events'),
+    path('novel_clone/<int:pk>/', views.novel_clone, name='novel_clone'),
     # Character
     path('character_detail/<int:pk>/', views.CharacterDetailView.as_view(), name='character_detail'),
     path('character_detail_delete/<int:pk>/', views.CharacterDetailDeleteView.as_view(), name='character_detail_delete'),
@@ -25,4 +27,9 @@ urlpatterns = [
     path('description_detail/<int:pk>/', views.DescriptionDetailView.as_view(), name='description_detail'),
     path('description_detail_delete/<int:pk>/', views.DescriptionDetailDeleteView.as_view(), name='description_detail_delete'),
     path('description_detail_create/', views.DescriptionDetailCreateView.as_view(), name='description_detail_create'),
+    path('description_bulk_edit_character/<int:pk>/', views.DescriptionBulkEditCharacterView.as_view(), name='description_bulk_edit_character'),
+    path('description_bulk_edit_relationship/<int:pk>/', views.DescriptionBulkEditRelationshipView.as_view(), name='description_bulk_edit_relationship'),
+    # Profiling
+    path('profile_list/', views.profile_list, name='profile_list'),
+    path('profile_download/<str:profile_id>/<str:extension>/', views.profile_download, name='profile_download'),
 ]
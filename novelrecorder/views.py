@@ -1,17 +1,25 @@
-from django.http import Http404
+import os
+import re
+
+from django.http import Http404, FileResponse, HttpResponse, HttpResponseForbidden, StreamingHttpResponse
+from django.contrib.admin.views.decorators import staff_member_required
 from rest_framework import status, serializers
 from django.contrib.auth.decorators import login_required
 from django.utils.decorators import method_decorator
+from django.views.decorators.http import require_POST
 from django.shortcuts import render, redirect
 
 from django.shortcuts import get_object_or_404
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.crypto import constant_time_compare
 import django.urls
 from django.views.generic import ListView
 from rest_framework import generics
 from rest_framework.renderers import TemplateHTMLRenderer
 from rest_framework.response import Response
 
-from novelrecorder.models import NovelUser, Relationship
+from novelrecorder.models import NovelUser, Relationship, NovelUserPermissionModel
 from novelrecorder.models import Novel
 from novelrecorder.models import Character
 from novelrecorder.models import Description
@@ -24,6 +32,10 @@ from novelrecorder.serializers import NovelSerializer, NovelReadOnlySerializer,
     RelationshipWithPrimaryDescriptionSlaveSerializer, UserRegisterSerializer, DescriptionPartialUpdateSerializer, \
     RelationshipPartialUpdateSerializer
 
+from novelrecorder import changelog, cloning, deletion, events, metrics, profiling, sharding
+from novelrecorder.batch import DescriptionFormset
+from novelrecorder.query_utils import apply_query_plan, run_concurrently
+from novelrecorder.constants import METRICS_GAUGE_CACHE_SECONDS
 from novelrecorder.yd_exceptions import DataErrorException
 
 
@@ -31,6 +43,8 @@ from novelrecorder.yd_exceptions import DataErrorException
 class CustomHTMLViewMixin(object):
     renderer_classes = [TemplateHTMLRenderer]
     style = {'template_pack': 'rest_framework/vertical/'}
+    # Max number of queries per HTTP method for a whole request - see QueryInstrumentationMiddleware.
+    query_budgets = {}
 
     def get_queryset(self):
         return self.model_class.objects.all()
@@ -43,6 +57,10 @@ class CustomNovelMixin(CustomHTMLViewMixin):
     _data_name_plural = ''
     _writable_serializer = None
     _read_only_serializer = None
+    # Eager loading plan for the view's queryset, declared by the "Model"ViewMixins.
+    _select_related = []
+    _prefetch_related = []
+    _only = []
 
     def get_model_class(self):
         assert self._model_class, 'Class %s._model_class is not set.' % self.__class__.__name__
@@ -64,6 +82,28 @@ class CustomNovelMixin(CustomHTMLViewMixin):
         assert self._read_only_serializer, 'Class %s._read_only_serializer is not set.' % self.__class__.__name__
         return self._read_only_serializer
 
+    def get_base_queryset(self):
+        return self.model_class.objects.all()
+
+    def get_queryset(self):
+        return apply_query_plan(self.get_base_queryset(), select_related=self._select_related,
+                                prefetch_related=self._prefetch_related, only=self._only)
+
+    # The content of the request's novel is on its shard - see novelrecorder.sharding.
+    def initial(self, request, *args, **kwargs):
+        sharding.activate_for_request(self.model_class, kwargs, request.query_params)
+        super().initial(request, *args, **kwargs)
+
+    # Memoised as the permission checks and the serializer context ask for it several times per request.
+    def get_object(self):
+        if not hasattr(self, '_object'):
+            self._object = super().get_object()
+        return self._object
+
+    # Serializes the queryset of slave objects with the eager loading plan of the serializer applied.
+    def get_slave_data(self, serializer_class, queryset):
+        return serializer_class(serializer_class.setup_eager_loading(queryset), many=True).data
+
     def has_write_permission(self):
         return True
 
@@ -128,7 +168,8 @@ class CustomHTMLUpdateMixin(CustomHTMLRedirectMixin):
         serializer = self.get_serializer(instance, data=request.data)
         if not serializer.is_valid():
             return Response({'serializer': serializer, self.data_name_single: instance})
-        serializer.save()
+        with changelog.recording_changes():
+            serializer.save()
         return self.do_redirect(serializer)
 
 
@@ -143,7 +184,8 @@ class CustomHTMLCreateMixin(CustomHTMLRedirectMixin):
     def post(self, request):
         serializer = self.get_serializer(data=request.data)
         if serializer.is_valid():
-            serializer.save()
+            with changelog.recording_changes():
+                serializer.save()
             return self.do_redirect(serializer)
         else:
             return Response({'serializer': serializer}, status=status.HTTP_400_BAD_REQUEST)
@@ -164,7 +206,8 @@ class CustomHTMLDeleteMixin(CustomHTMLRedirectMixin):
             self.pre_delete(serializer)
         except Exception as e:
             return self.do_redirect(serializer) # TODO: redirect back without any error message for now.
-        super().delete(self, request)
+        with changelog.recording_changes():
+            super().delete(self, request)
         return self.do_redirect(serializer)
 
 
@@ -192,9 +235,6 @@ class CustomNovelRUDDetailView(CustomNovelRetrieveMixin, CustomNovelUpdateMixin,
                     return False
         return True
 
-    def get_queryset(self):
-        return self.model_class.objects.all()
-
 
 class CustomNovelListCreateView(CustomNovelListMixin, generics.ListCreateAPIView):
     query_param_names = [] # The query param names need to be passed to the GET request for the create page
@@ -213,8 +253,8 @@ class CustomNovelListCreateView(CustomNovelListMixin, generics.ListCreateAPIView
                     return False
         return True
 
-    def get_queryset(self):
-        raise NotImplementedError('Class %s.get_queryset is not implemented.' % self.__class__.__name__)
+    def get_base_queryset(self):
+        raise NotImplementedError('Class %s.get_base_queryset is not implemented.' % self.__class__.__name__)
 
     def get_serializer_context(self):
         context = super(CustomNovelListCreateView, self).get_serializer_context()
@@ -249,9 +289,9 @@ class UserRegisterView(CustomHTMLCreateMixin, generics.CreateAPIView):
 def index(request):
     # Generate dynamic contents
     num_novels = Novel.objects.all().count()
-    num_characters = Character.objects.all().count()
-    num_descriptions = Description.objects.count()
-    num_relationships = Relationship.objects.count()
+    num_characters = sharding.count(Character)
+    num_descriptions = sharding.count(Description)
+    num_relationships = sharding.count(Relationship)
     num_authors = NovelUser.objects.all().count()  # TODO: Return num of users who owns at least 1 novel only.
 
     context = {
@@ -271,12 +311,76 @@ def redirect_novelRecorder(request):
     return response
 
 
+# Profiling
+@staff_member_required
+def profile_list(request):
+    profiles = sorted(profiling.list_profiles(), key=lambda p: p['duration_ms'], reverse=True)
+    return render(request, 'novelrecorder/profile_list.html', context={'profiles': profiles[:50]})
+
+
+@staff_member_required
+def profile_download(request, profile_id, extension):
+    if extension not in ['prof', 'collapsed'] or not all(c.isalnum() or c == '-' for c in profile_id):
+        raise Http404('No such profile.')
+    path = os.path.join(profiling.get_profiler_setting('DIRECTORY'), '%s.%s' % (profile_id, extension))
+    if not os.path.isfile(path):
+        raise Http404('No such profile.')
+    return FileResponse(open(path, 'rb'), as_attachment=True, filename=os.path.basename(path))
+
+
+# Metrics
+# For staff, or a scraper with the settings.METRICS_TOKEN. The counts of the objects are cached for
+# METRICS_GAUGE_CACHE_SECONDS, as they're a COUNT(*) per model (and shard).
+def metrics_view(request):
+    token = getattr(settings, 'METRICS_TOKEN', None)
+    has_token = token and constant_time_compare(request.META.get('HTTP_AUTHORIZATION', ''), 'Bearer %s' % token)
+    if not has_token and not request.user.is_staff:
+        return HttpResponseForbidden()
+    gauges = cache.get(metrics.GAUGE_CACHE_KEY)
+    if gauges is None:
+        gauges = [('novelrecorder_objects', {'model': model.__name__}, sharding.count(model))
+                  for model in [Novel, Character, Relationship, Description, NovelUserPermissionModel, NovelUser]]
+        cache.set(metrics.GAUGE_CACHE_KEY, gauges, METRICS_GAUGE_CACHE_SECONDS)
+    return HttpResponse(metrics.render_metrics(gauges), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+# Events
+# The changes of a novel as Server-Sent Events, from Last-Event-ID (or ?since=) or else from now on, for those who can
+# write to it. Served by novelrecorder.asgi but when denied, see novelrecorder.events.
+def novel_events(request, pk):
+    novel = get_object_or_404(Novel, pk=pk)
+    permission = novelrecorder.permissions.NovelUserPermission()
+    if not permission.custom_has_object_permission(request.user, True, novel):
+        return HttpResponseForbidden()
+    since = events.get_last_event_id(request)
+    response = StreamingHttpResponse(
+        events.stream_events(novel, novel.change_seq if since is None else since,
+                             permission.may_manage_permissions(request.user, novel)),
+        content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'  # Stop proxies from buffering the stream
+    return response
+
+
+# Cloning
+# A copy of the novel as a new novel of the user, who only needs to be able to read it - see novelrecorder.cloning.
+@login_required
+@require_POST
+def novel_clone(request, pk):
+    novel = get_object_or_404(Novel, pk=pk)
+    if not novelrecorder.permissions.NovelUserPermission().custom_has_object_permission(request.user, False, novel):
+        return HttpResponseForbidden()
+    clone = cloning.clone_novel(novel, request.user)
+    return redirect(django.urls.reverse_lazy('novelrecorder:novel_detail', kwargs={'pk': clone.pk}))
+
+
 class PublicNovelListView(ListView):
     template_name = 'novelrecorder/public_novel_list.html'
     context_object_name = 'public_novel_list'
+    query_budgets = {'GET': 3}
 
     def get_queryset(self):
-        return Novel.objects.filter(is_public=True)
+        return Novel.objects.filter(is_public=True).select_related('author')
 
 
 # Novel
@@ -286,15 +390,17 @@ class NovelViewMixin(object):
     _read_only_serializer = NovelReadOnlySerializer
     _data_name_single = 'novel'
     _data_name_plural = 'novels'
+    _select_related = ['author']
 
 
 class NovelDetailView(NovelViewMixin, CustomNovelRUDDetailView):
     template_name = 'novelrecorder/novel_detail.html'
+    query_budgets = {'GET': 8}
 
     def get_serializer_context(self):
         context = super().get_serializer_context()
         charactersObject = Character.objects.filter(novel=self.get_object())
-        characterSerializer = CharacterWithPrimaryDescriptionSlaveSerializer(charactersObject, many=True).data
+        characterSerializer = self.get_slave_data(CharacterWithPrimaryDescriptionSlaveSerializer, charactersObject)
         context.update({'characters': characterSerializer})
         return context
 
@@ -308,11 +414,12 @@ class NovelDetailCreateView(NovelViewMixin, CustomNovelCreateView):
 @method_decorator(login_required, name='dispatch')
 class UserNovelListView(NovelViewMixin, CustomNovelListCreateView):
     template_name = 'novelrecorder/my_novel_list.html'
+    query_budgets = {'GET': 3}
 
     def get_filter_object(self):
         return self.request.user
 
-    def get_queryset(self):
+    def get_base_queryset(self):
         user = self.get_filter_object()
         return Novel.objects.filter(author=user)
 
@@ -327,6 +434,7 @@ class CharacterViewMixin(object):
     _read_only_serializer = CharacterReadOnlySerializer
     _data_name_single = 'character'
     _data_name_plural = 'characters'
+    _select_related = ['novel']
 
 
 class CharacterListNovelView(CharacterViewMixin, CustomNovelListCreateView):
@@ -334,11 +442,12 @@ class CharacterListNovelView(CharacterViewMixin, CustomNovelListCreateView):
     _writable_serializer = CharacterWithPrimaryDescriptionSerializer
     _read_only_serializer = CharacterWithPrimaryDescriptionSerializer
     query_param_names = ['novel_id']
+    _prefetch_related = CharacterWithPrimaryDescriptionSerializer._prefetch_related
 
     def get_filter_object(self):
         return get_object_or_404(Novel, id=self.kwargs['novel_id'])
 
-    def get_queryset(self):
+    def get_base_queryset(self):
         novelObj = self.get_filter_object()
         return Character.objects.filter(novel=novelObj)
 
@@ -353,16 +462,20 @@ class CharacterCreateUpdateOnRedirectMixin(object):
 
 class CharacterDetailView(CharacterCreateUpdateOnRedirectMixin, CharacterViewMixin, CustomNovelRUDDetailView):
     template_name = 'novelrecorder/character_detail.html'
+    query_budgets = {'GET': 14}
 
     def get_serializer_context(self):
         context = super().get_serializer_context()
-        descriptionsObject = Description.objects.filter(character=self.get_object())
-        descriptionSerializer = DescriptionSlaveSerializer(descriptionsObject, many=True).data
-        relationshipObject = Relationship.objects.filter(character1=self.get_object())
-        relationshipSerializer = RelationshipWithPrimaryDescriptionSlaveSerializer(relationshipObject, many=True).data
-        charactersWithRelationshipIDs = list(map(lambda r: r.character2.id, relationshipObject)) + [self.get_object().id]
-        charactersWithoutRelationshipObject = Character.objects.filter(novel=self.get_object().getNovel()).exclude(id__in=charactersWithRelationshipIDs)
-        charactersWithoutRelationshipSerializer = CharacterWithPrimaryDescriptionSlaveSerializer(charactersWithoutRelationshipObject, many=True).data
+        character = self.get_object()
+        descriptionsObject = Description.objects.filter(character=character)
+        relationshipObject = Relationship.objects.filter(character1=character)
+        # A subquery rather than the ids of relationshipObject, so the three don't depend on each other
+        charactersWithoutRelationshipObject = Character.objects.filter(novel_id=character.novel_id).exclude(
+            id__in=relationshipObject.values('character2_id')).exclude(id=character.id)
+        descriptionSerializer, relationshipSerializer, charactersWithoutRelationshipSerializer = run_concurrently(
+            lambda: self.get_slave_data(DescriptionSlaveSerializer, descriptionsObject),
+            lambda: self.get_slave_data(RelationshipWithPrimaryDescriptionSlaveSerializer, relationshipObject),
+            lambda: self.get_slave_data(CharacterWithPrimaryDescriptionSlaveSerializer, charactersWithoutRelationshipObject))
         context.update({
             'descriptions': descriptionSerializer,
             'relationships': relationshipSerializer,
@@ -379,6 +492,10 @@ class CharacterDetailCreateView(CharacterCreateUpdateOnRedirectMixin, CharacterV
 class CharacterDetailDeleteView(CharacterViewMixin, CustomNovelDeleteView):
     template_name = 'novelrecorder/character_detail_delete.html'
 
+    # With its relationships and the descriptions of both, see novelrecorder.deletion
+    def perform_destroy(self, instance):
+        deletion.delete_character(instance)
+
     def on_redirect(self, serializer):
         if self.request.POST.get('novel_id'):
             return redirect(django.urls.reverse_lazy('novelrecorder:novel_detail', kwargs={'pk':self.request.POST.get('novel_id')}))
@@ -392,6 +509,7 @@ class RelationshipViewMixin(object):
     _read_only_serializer = RelationshipReadOnlySerializer
     _data_name_single = 'relationship'
     _data_name_plural = 'relationships'
+    _select_related = ['character1__novel', 'character2']
 
 
 class RelationshipListCharacterView(RelationshipViewMixin, CustomNovelListCreateView):
@@ -399,11 +517,12 @@ class RelationshipListCharacterView(RelationshipViewMixin, CustomNovelListCreate
     _writable_serializer = RelationshipWithPrimaryDescriptionSerializer
     _read_only_serializer = RelationshipWithPrimaryDescriptionSerializer
     query_param_names = ['character1_id', 'character2_id']
+    _prefetch_related = RelationshipWithPrimaryDescriptionSerializer._prefetch_related
 
     def get_filter_object(self):
         return get_object_or_404(Character, id=self.kwargs['character1_id'])
 
-    def get_queryset(self):
+    def get_base_queryset(self):
         characterObj = self.get_filter_object()
         return Relationship.objects.filter(character1=characterObj)
 
@@ -418,11 +537,12 @@ class RelationshipCreateUpdateOnRedirectMixin(object):
 class RelationshipDetailView(RelationshipCreateUpdateOnRedirectMixin, RelationshipViewMixin, CustomNovelRUDDetailView):
     _writable_serializer = RelationshipPartialUpdateSerializer
     template_name = 'novelrecorder/relationship_detail.html'
+    query_budgets = {'GET': 11}
 
     def get_serializer_context(self):
         context = super().get_serializer_context()
         descriptionsObject = Description.objects.filter(relationship=self.get_object())
-        descriptionSerializer = DescriptionSlaveSerializer(descriptionsObject, many=True).data
+        descriptionSerializer = self.get_slave_data(DescriptionSlaveSerializer, descriptionsObject)
         context.update({'descriptions': descriptionSerializer})
         return context
 
@@ -448,7 +568,8 @@ class DescriptionViewMixin(object):
     _read_only_serializer = DescriptionReadOnlySerializer
     _data_name_single = 'description'
     _data_name_plural = 'descriptions'
-    
+    _select_related = ['character__novel', 'relationship__character1__novel', 'relationship__character2']
+
 
 class DescriptionListCharacterView(DescriptionViewMixin, CustomNovelListCreateView):
     template_name = 'novelrecorder/description_list_character.html'
@@ -457,7 +578,7 @@ class DescriptionListCharacterView(DescriptionViewMixin, CustomNovelListCreateVi
     def get_filter_object(self):
         return get_object_or_404(Character, id=self.kwargs['character_id'])
 
-    def get_queryset(self):
+    def get_base_queryset(self):
         characterObj = self.get_filter_object()
         return Description.objects.filter(character=characterObj)
 
@@ -469,7 +590,7 @@ class DescriptionListRelationshipView(DescriptionViewMixin, CustomNovelListCreat
     def get_filter_object(self):
         return get_object_or_404(Relationship, id=self.kwargs['relationship_id'])
 
-    def get_queryset(self):
+    def get_base_queryset(self):
         relationshipObj = self.get_filter_object()
         return Description.objects.filter(relationship=relationshipObj)
 
@@ -488,6 +609,8 @@ class DescriptionCreateUpdateOnRedirectMixin(object):
 class DescriptionDetailView(DescriptionCreateUpdateOnRedirectMixin, DescriptionViewMixin, CustomNovelRUDDetailView):
     _writable_serializer = DescriptionPartialUpdateSerializer
     template_name = 'novelrecorder/description_detail.html'
+    _select_related = DescriptionViewMixin._select_related + ['blob']  # The content
+    query_budgets = {'GET': 8}
 
 
 class DescriptionDetailCreateView(DescriptionCreateUpdateOnRedirectMixin, DescriptionViewMixin, CustomNovelCreateView):
@@ -519,3 +642,50 @@ class DescriptionDetailDeleteView(DescriptionViewMixin, CustomNovelDeleteView):
         elif self.request.POST.get('relationship_id'):
             return redirect(django.urls.reverse_lazy('novelrecorder:relationship_detail', kwargs={'pk':self.request.POST.get('relationship_id')}))
         raise Http404('The description is deleted but couldn''t find the information to redirect to the proper list page.')
+
+
+# The descriptions of a character or a relationship edited on one page, see batch.DescriptionFormset. The fields of
+# each are named <description id>-title and <description id>-content.
+class DescriptionBulkEditView(CustomNovelMixin, generics.GenericAPIView):
+    template_name = 'novelrecorder/description_bulk_edit.html'
+    owner_url_name = ''
+
+    # Reading the owner is enough, DescriptionFormset checks the edit of each description (which a user granted
+    # NUP_DESCRIPTION_ONLY can make).
+    def check_object_permissions(self, request, obj):
+        if not novelrecorder.permissions.NovelUserPermission().custom_has_object_permission(request.user, False, obj):
+            self.permission_denied(request)
+
+    def get_formset(self, data=None):
+        return DescriptionFormset(self.get_object(), self.request.user, data)
+
+    def get_formset_data(self):
+        items = {}
+        for key, value in self.request.data.items():
+            match = re.match(r'^(\d+)-(title|content)$', key)
+            if match:
+                items.setdefault(int(match.group(1)), {'id': int(match.group(1))})[match.group(2)] = value
+        return list(items.values())
+
+    def get_response(self, formset, response_status=status.HTTP_200_OK):
+        return Response({'formset': formset, 'owner': formset.owner,
+                         'owner_url': django.urls.reverse(self.owner_url_name, kwargs={'pk': formset.owner.pk})},
+                        status=response_status)
+
+    def get(self, request, pk):
+        return self.get_response(self.get_formset())
+
+    def post(self, request, pk):
+        formset = self.get_formset(self.get_formset_data())
+        if not formset.is_valid():
+            return self.get_response(formset, status.HTTP_400_BAD_REQUEST)
+        formset.save()
+        return redirect(django.urls.reverse_lazy(self.owner_url_name, kwargs={'pk': pk}))
+
+
+class DescriptionBulkEditCharacterView(CharacterViewMixin, DescriptionBulkEditView):
+    owner_url_name = 'novelrecorder:character_detail'
+
+
+class DescriptionBulkEditRelationshipView(RelationshipViewMixin, DescriptionBulkEditView):
+    owner_url_name = 'novelrecorder:relationship_detail'
@@ -17,6 +17,14 @@ class SchemeErrorException(CustomException):
     """Indicating we are attempting to do something not expected due to a design flaw."""
     pass
 
+class QueryBudgetExceededException(CustomErrorException):
+    """Indicating a view ran more queries than its declared query budget."""
+    pass
+
+class ShardMovedException(CustomException):
+    """Indicating the novel written to has been moved to another shard meanwhile; the write is rolled back."""
+    pass
+
 def custom_exception_handler(exc, context):
     # Call REST framework's default exception handler first,
     # to get the standard error response.